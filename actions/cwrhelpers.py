@@ -16,13 +16,38 @@ from charmhelpers.core import hookenv  # noqa: E402
 from jenkins import NotFoundException  # noqa: E402
 from theblues.charmstore import CharmStore  # noqa: E402
 from theblues.errors import EntityNotFound, ServerError  # noqa: E402
-from utils import get_fname  # noqa: E402
+from jenkinsjobs import JobSpec  # noqa: E402
+from storecache import StoreCache  # noqa: E402
+from utils import (  # noqa: E402
+    REST_PORT,
+    TRIGGER_PERIODICALLY,
+    get_badge_path,
+    get_fname,
+    get_hook_token,
+    get_progressive_console,
+    get_rest_path,
+)
 
 
 # if you update this path, make sure to update the same path in cwr-helpers.sh
 HOME = "/var/lib/jenkins"
 CONFIG_DIR = 'configuration'
 CONTAINER_HOME = "/root"
+# Polling of the builds actions wait for
+MIN_POLL_SECS = 0.5
+MAX_POLL_SECS = 10
+# Characters of console output returned by wait_result
+CONSOLE_TAIL_CHARS = 10000
+
+store_cache = StoreCache()
+
+
+class ActionError(ValueError):
+    """
+    Raised by the helpers when the action's parameters or the unit's setup
+    do not allow it to go on; actions report it with fail_action.
+    """
+    pass
 
 
 class InvalidBundle(Exception):
@@ -37,10 +62,7 @@ class InvalidBundle(Exception):
 def app_from_bundle(bundle_name, charm_name):
     '''Return the app name used in the given bundle for a given charm.'''
     try:
-        cs = CharmStore()
-        bundle_yaml = cs.files(bundle_name,
-                               filename='bundle.yaml',
-                               read_file=True)
+        bundle_yaml = get_store_file(bundle_name, 'bundle.yaml')
         yaml_contents = yaml.safe_load(bundle_yaml)
     except (EntityNotFound, ServerError, yaml.YAMLError) as e:
         raise InvalidBundle(bundle_name, str(e))
@@ -50,11 +72,16 @@ def app_from_bundle(bundle_name, charm_name):
     return None
 
 
+def get_store_file(entity, filename):
+    '''Read a file of a charm or bundle through the shared store cache.'''
+    return store_cache.get_file(
+        entity, filename,
+        lambda: CharmStore().files(entity, filename=filename, read_file=True))
+
+
 def fetch_reference_bundle(charm_name):
     try:
-        tests_yaml = CharmStore().files(charm_name,
-                                        filename='tests/tests.yaml',
-                                        read_file=True)
+        tests_yaml = get_store_file(charm_name, 'tests/tests.yaml')
         tests_yaml = yaml.safe_load(tests_yaml)
         return tests_yaml.get('reference-bundle')
     except EntityNotFound:
@@ -75,11 +102,21 @@ def get_charm_names():
 
 
 def get_reference_bundle():
-    # If we have a reference bundle, determine the app name used for our charm
-    charm_name = hookenv.action_get("charm-name")
-    if hookenv.action_get("reference-bundle"):
-        bundle_name = hookenv.action_get("reference-bundle")
-    else:
+    return resolve_reference_bundle(hookenv.action_get("charm-name"),
+                                    hookenv.action_get("reference-bundle"))
+
+
+def resolve_reference_bundle(charm_name, bundle_name=None):
+    '''
+    Find the bundle to test a charm in, and the app name of the charm in it.
+
+    If no bundle_name is given, the reference bundle from the charm's
+    tests.yaml is used.
+
+    Returns: bundle name, sanitized bundle name and app name, all empty
+    when the charm has no reference bundle.
+    '''
+    if not bundle_name:
         # try to get the reference bundle from tests.yaml
         bundle_name = fetch_reference_bundle(charm_name)
 
@@ -101,6 +138,94 @@ def get_reference_bundle():
         return "", "", ""
 
 
+def charm_commit_job(params, reference_bundle):
+    '''
+    The job testing commits of a charm, as added by cwr-charm-commit.
+
+    params is a callable returning the value of a cwr-charm-commit
+    parameter; reference_bundle is what resolve_reference_bundle returned.
+
+    Returns: a JobSpec
+    '''
+    bundle_name, bundle_fname, bundle_app_name = reference_bundle
+    charm_name = params("charm-name")
+    repo_access = params("repo-access")
+    if repo_access == 'webhooks':
+        trigger = ""
+        skip_builds = ""
+    elif repo_access == 'poll':
+        trigger = TRIGGER_PERIODICALLY
+        skip_builds = 'skip_builds'
+    else:
+        raise ValueError("The repo-access can only be 'webhooks' or 'poll'")
+
+    job_name = "cwr_charm_commit_{}_in_{}".format(get_fname(charm_name),
+                                                  bundle_fname)
+    s3_creds, s3_creds_container = get_s3_creds_filenames(job_name)
+    s3_options = get_s3_options(s3_creds, s3_creds_container, params)
+
+    return JobSpec(
+        name=job_name,
+        template="BuildMyCharm/config.xml",
+        context={
+            "gitrepo": params("repo"),
+            "charm_subdir": params("charm-subdir"),
+            "pushtochannel": params("push-to-channel") or "",
+            "lp_id": params("namespace"),
+            "branch": params("branch"),
+            "charm_name": charm_name,
+            "bundle_name": bundle_name,
+            "app_name_in_bundle": bundle_app_name,
+            "refspec": "",
+            "series": params("series") or "",
+            "controller": params("controller") or "",
+            "trigger": trigger,
+            "skip_builds": skip_builds,
+            "job_name": job_name,
+            "s3_options": s3_options,
+        })
+
+
+def bundle_job(params, charm_home):
+    '''
+    The job testing a bundle, as added by cwr-bundle.
+
+    params is a callable returning the value of a cwr-bundle parameter.
+
+    Returns: a JobSpec
+    '''
+    bundle_name = params("bundle-name")
+    # This job will "build" the bundle aka update, test, push to store
+    job_name = 'cwr_bundle_{}'.format(get_fname(bundle_name))
+    s3_creds, s3_creds_container = get_s3_creds_filenames(job_name)
+    s3_options = get_s3_options(s3_creds, s3_creds_container, params)
+
+    return JobSpec(
+        name=job_name,
+        template="BuildMyBundle/config-build.xml",
+        context={
+            "repo": params("repo"),
+            "bundle_subdir": params("bundle-subdir"),
+            "bundle_name": bundle_name,
+            "controller": params("controller") or "",
+            "branch": params("branch"),
+            "cwr_charm_home": charm_home,
+            "s3_options": s3_options
+        })
+
+
+def get_job_urls(job_name):
+    '''
+    Returns: the webhook URL and the build badge URL of a job
+    '''
+    token = get_hook_token(job_name)
+    url = "http://<cwr-ip>:{}{}/trigger/{}/{}".format(
+        REST_PORT, get_rest_path(), job_name, token)
+    badge_url = "http://<cwr-ip>:{}{}".format(
+        REST_PORT, get_badge_path(job_name))
+    return url, badge_url
+
+
 def fail_action(msg, output=None):
     '''Fail an action with a message and (optionally) additional output.'''
     if output:
@@ -109,25 +234,64 @@ def fail_action(msg, output=None):
     sys.exit()
 
 
-def wait_result(jclient, job_name, build_number, secs_to_wait=60):
-    timeout = time.time() + secs_to_wait
+def wait_result(jclient, job_name, build_number=None, secs_to_wait=600,
+                queue_item=None, tail_chars=CONSOLE_TAIL_CHARS):
+    '''
+    Wait for a build to finish.
+
+    The build is given either by number or by the queue item returned when
+    it was triggered; in the latter case we wait for it to leave the queue
+    first. Polls start fast and back off while nothing happens, and the
+    console is followed incrementally.
+
+    Returns: a tuple of 'success' or 'fail', and the last tail_chars
+    characters of the console output.
+    '''
+    deadline = time.time() + secs_to_wait
+    delay = MIN_POLL_SECS
+
+    def wait(delay):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise Exception("Job timeout: {} #{} did not finish in {}s".format(
+                job_name, build_number or 'queued', secs_to_wait))
+        time.sleep(min(delay, remaining))
+        return min(delay * 2, MAX_POLL_SECS)
+
+    while build_number is None:
+        item = jclient.get_queue_item(queue_item)
+        if item.get('cancelled'):
+            raise Exception("Job {} was cancelled".format(job_name))
+        if item.get('executable'):
+            build_number = item['executable']['number']
+            break
+        print("Jenkins job {} waiting in queue: {}".format(
+            job_name, item.get('why')))
+        delay = wait(delay)
+
+    tail = ''
+    start = 0
+    delay = MIN_POLL_SECS
     while True:
-        time.sleep(5)
-        if time.time() > timeout:
-            raise Exception("Job timeout")
         try:
-            build_info = jclient.get_build_info(job_name, build_number)
-            if build_info["result"] == 'FAILURE':
-                outcome = 'fail'
-            else:
-                outcome = 'success'
-
-            output = jclient.get_build_console_output(job_name, build_number)
-            return outcome, output
+            text, start, more = get_progressive_console(
+                jclient, job_name, build_number, start)
         except NotFoundException:
             print("Jenkins job {} not running yet".format(build_number))
-        except:
-            raise
+            text, more = '', True
+        tail = (tail + text)[-tail_chars:]
+        if not more:
+            break
+        # poll quickly again while the build is producing output
+        delay = wait(MIN_POLL_SECS if text else delay)
+
+    while True:
+        build_info = jclient.get_build_info(job_name, build_number)
+        if not build_info['building'] and build_info['result']:
+            break
+        delay = wait(delay)
+    outcome = 'success' if build_info['result'] == 'SUCCESS' else 'fail'
+    return outcome, tail
 
 
 def get_s3_credentials(cred_name=None):
@@ -139,18 +303,20 @@ def get_s3_credentials(cred_name=None):
       credential name, get the credentials for that name.
 
     Returns: access_key, secret_key
+
+    Raises: ActionError if no credentials can be found
     """
     cmd = ('sudo -H -u jenkins -- juju credentials aws --format yaml '
            '--show-secrets'.split())
     try:
         creds = subprocess.check_output(cmd)
     except subprocess.CalledProcessError as e:
-        fail_action(
-            "Error running 'juju credentials' command: ".format(e.output))
+        raise ActionError(
+            "Error running 'juju credentials' command: {}".format(e.output))
     creds = yaml.load(creds)
     if not creds.get('credentials', {}).get('aws'):
-        fail_action('AWS credentials not found. Set AWS credentials by '
-                    'running "set-credentials" action.')
+        raise ActionError('AWS credentials not found. Set AWS credentials by '
+                          'running "set-credentials" action.')
     if not cred_name:
         cred_name = creds.get('credentials', {}).get('aws', {}).get(
             'default-credential')
@@ -158,8 +324,8 @@ def get_s3_credentials(cred_name=None):
             len(creds.get('credentials', {}).get('aws', {}).keys()) == 1):
         cred_name = list(creds.get('credentials', {}).get('aws', {}).keys())[0]
     if not cred_name:
-        fail_action('Credentials not found. Set AWS credentials by '
-                    'running "set-credentials" action.')
+        raise ActionError('Credentials not found. Set AWS credentials by '
+                          'running "set-credentials" action.')
     access_key = creds['credentials']['aws'][cred_name]['access-key']
     secret_key = creds['credentials']['aws'][cred_name]['secret-key']
     return access_key, secret_key
@@ -184,16 +350,25 @@ def ensure_dir(dirpath):
             raise
 
 
-def get_s3_options(s3_config_filepath, s3_container_filepath):
-    """Generate CWR options to store the test results to S3 storage."""
-    bucket = hookenv.action_get("bucket")
+def get_s3_options(s3_config_filepath, s3_container_filepath, params=None):
+    """
+    Generate CWR options to store the test results to S3 storage.
+
+    The S3 parameters are read from the action, or with the params callable
+    when one is given.
+
+    Raises: ActionError if the parameters or the credentials are missing
+    """
+    params = params or hookenv.action_get
+    bucket = params("bucket")
     if not bucket:
         return ''
-    results_dir = hookenv.action_get("results-dir")
+    results_dir = params("results-dir")
     if not results_dir:
-        fail_action('"results-dir" must be provided if "bucket" name is set.')
-    private = hookenv.action_get("private") or False
-    cred_name = hookenv.action_get("credential-name")
+        raise ActionError(
+            '"results-dir" must be provided if "bucket" name is set.')
+    private = params("private") or False
+    cred_name = params("credential-name")
     access_key, secret_key = get_s3_credentials(cred_name)
     create_s3_config_file(s3_config_filepath, access_key, secret_key)
     private_opt = ""
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Benchmark the bundle checks and builds of bundlebuilder.py.
+
+Each run gets a synthetic bundle of N applications in a local git repo and
+a fake charm CLI (fake-charm) on the PATH, so nothing leaves the machine.
+The tests themselves are dry runs; what is measured is the orchestration
+around them: wall time, subprocesses started and peak RSS.
+
+Results are JSON lines, one per (benchmark, apps, latency). Pass a previous
+result file with --baseline to flag regressions:
+
+    ./benchmarks/bundlebuilder_bench.py --output before.jsonl
+    ./benchmarks/bundlebuilder_bench.py --baseline before.jsonl
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+from contextlib import redirect_stdout
+from shutil import copy, rmtree
+from tempfile import mkdtemp
+from time import monotonic
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCH_DIR, '..', 'scripts'))
+sys.path.append(os.path.join(BENCH_DIR, '..', 'lib'))
+import bundlebuilder  # noqa: E402
+from storecache import StoreCache  # noqa: E402
+
+BENCHMARKS = ('check_bundle', 'test_and_release_bundle')
+SIZES = (5, 50, 500)
+
+
+def make_bundle_repo(path, apps):
+    """
+    Create a git repo with a bundle of apps applications, all marked for
+    upgrade and release.
+
+    Args:
+        path: where to create the repo
+        apps: how many applications the bundle has
+
+    """
+    os.makedirs(path)
+    bundle = {'services': {
+        'app{}'.format(i): {'charm': 'cs:~bench/app{}-0'.format(i),
+                            'num_units': 1}
+        for i in range(apps)}}
+    ci_info = {
+        'bundle': {'namespace': 'bench', 'name': 'synthetic',
+                   'release': True, 'to-channel': 'stable'},
+        'charm-upgrade': {
+            'app{}'.format(i): {'from-channel': 'edge',
+                                'to-channel': 'stable', 'release': True}
+            for i in range(apps)},
+    }
+    with open(os.path.join(path, 'bundle.yaml'), 'w') as fp:
+        bundlebuilder.dump(bundle, fp)
+    with open(os.path.join(path, 'ci-info.yaml'), 'w') as fp:
+        bundlebuilder.dump(ci_info, fp)
+    git = ['git', '-C', path, '-c', 'user.name=bench',
+           '-c', 'user.email=bench@example.com']
+    subprocess.check_call(['git', 'init', '-q', path])
+    subprocess.check_call(git + ['symbolic-ref', 'HEAD', 'refs/heads/master'])
+    subprocess.check_call(git + ['add', '.'])
+    subprocess.check_call(git + ['commit', '-q', '-m', 'Synthetic bundle'])
+
+
+class CountingPopen(bundlebuilder.Popen):
+    """Popen that counts the processes bundlebuilder starts."""
+
+    count = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingPopen.count += 1
+        super().__init__(*args, **kwargs)
+
+
+def run_one(benchmark, apps, latency):
+    """
+    Run a single benchmark in this process.
+
+    Returns: a dict with the measurements
+
+    """
+    workdir = mkdtemp(prefix='bundlebuilder-bench-')
+    try:
+        bin_dir = os.path.join(workdir, 'bin')
+        os.makedirs(bin_dir)
+        copy(os.path.join(BENCH_DIR, 'fake-charm'),
+             os.path.join(bin_dir, 'charm'))
+        os.environ.update({
+            'PATH': '{}:{}'.format(bin_dir, os.environ['PATH']),
+            'FAKE_CHARM_LATENCY': str(latency),
+            'FAKE_CHARM_REVISION': '1',
+            'JOB_NAME': 'bench',
+        })
+        os.environ.pop('OUTPUT_SCENARIO', None)
+        os.environ.pop('BUNDLEBUILDER_LOG', None)
+        repo = os.path.join(workdir, 'repo')
+        make_bundle_repo(repo, apps)
+
+        # Use the shared caches the way a CI unit would, starting cold
+        store_cache_dir = os.path.join(workdir, 'store-cache')
+        os.makedirs(store_cache_dir)
+        bundlebuilder.store_cache = StoreCache(store_cache_dir)
+        bundlebuilder.GIT_MIRROR_DIR = os.path.join(workdir, 'git-mirrors')
+        bundlebuilder.Popen = CountingPopen
+        os.chdir(workdir)
+
+        coordinator = bundlebuilder.Coordinator(CWR_dry_run=True,
+                                                store_push_dry_run=True)
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            start = monotonic()
+            if benchmark == 'check_bundle':
+                coordinator.check_bundle(repo, 'master', '.')
+            else:
+                coordinator.test_and_release_bundle(repo, 'master', '.', 1,
+                                                    ['lxd'])
+            wall_time = monotonic() - start
+    finally:
+        os.chdir('/')
+        rmtree(workdir)
+
+    return {
+        'benchmark': benchmark,
+        'apps': apps,
+        'latency': latency,
+        'wall_time': round(wall_time, 3),
+        'subprocesses': CountingPopen.count,
+        # kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_child_rss_kb':
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def run(benchmark, apps, latency, repeat):
+    """
+    Run a benchmark repeat times, each in a fresh interpreter so that peak
+    RSS is not carried over.
+
+    Returns: the measurements of the fastest run
+
+    """
+    results = []
+    for _ in range(repeat):
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__), '--run-one', benchmark,
+            '--apps', str(apps), '--latency', str(latency)],
+            universal_newlines=True)
+        results.append(json.loads(output.splitlines()[-1]))
+    return min(results, key=lambda result: result['wall_time'])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print how results compare to baseline.
+
+    Returns: the list of regressions, as strings
+
+    """
+    previous = {(r['benchmark'], r['apps'], r['latency']): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(
+            (result['benchmark'], result['apps'], result['latency']))
+        if not before:
+            continue
+        for key in ('wall_time', 'subprocesses', 'peak_rss_kb'):
+            if not before[key]:
+                continue
+            ratio = result[key] / before[key]
+            line = "{} apps={} {}: {} -> {} ({:+.0%})".format(
+                result['benchmark'], result['apps'], key, before[key],
+                result[key], ratio - 1)
+            print(line, file=sys.stderr)
+            if ratio > 1 + tolerance:
+                regressions.append(line)
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--benchmark', action='append', choices=BENCHMARKS,
+        help='Benchmark to run; may be repeated. Defaults to all.')
+    parser.add_argument(
+        '--apps', action='append', type=int,
+        help='Applications in the synthetic bundle; may be repeated. '
+             'Defaults to {}.'.format(', '.join(str(s) for s in SIZES)))
+    parser.add_argument(
+        '--latency', type=float, default=0.05,
+        help='Seconds each fake charm command takes.')
+    parser.add_argument(
+        '--repeat', type=int, default=1,
+        help='Runs of each benchmark; the fastest is reported.')
+    parser.add_argument(
+        '--output', help='File to write the results to, as JSON lines.')
+    parser.add_argument(
+        '--baseline', help='Results of a previous run to compare with.')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='Relative increase over the baseline reported as a regression.')
+    parser.add_argument('--run-one', choices=BENCHMARKS,
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, args.apps[0], args.latency)))
+        sys.exit(0)
+
+    results = []
+    for benchmark in args.benchmark or BENCHMARKS:
+        for apps in args.apps or SIZES:
+            result = run(benchmark, apps, args.latency, args.repeat)
+            print("{benchmark} apps={apps}: {wall_time}s, "
+                  "{subprocesses} subprocesses, "
+                  "{peak_rss_kb} kB peak RSS".format(**result),
+                  file=sys.stderr)
+            results.append(result)
+
+    lines = ''.join(json.dumps(result, sort_keys=True) + '\n'
+                    for result in results)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(lines)
+    else:
+        sys.stdout.write(lines)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = [json.loads(line) for line in fp if line.strip()]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions:", file=sys.stderr)
+            for regression in regressions:
+                print("  " + regression, file=sys.stderr)
+            sys.exit(1)
@@ -1,42 +1,124 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
 from json import dumps, loads
-from flask import Flask, request, abort, make_response
+from flask import (
+    Flask,
+    Response,
+    g,
+    request,
+    abort,
+    make_response,
+    redirect,
+    send_file
+)
 from jenkins import Jenkins
+from jinja2 import Environment, FileSystemLoader
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote
+from urllib3.util.retry import Retry
+import hashlib
 import mimetypes
 import logging
+import os
+import threading
+import time
 
 import sys
 sys.path.append('../lib')
 
-from charmhelpers.core import templating  # noqa: E402
-from utils import (
+from utils import (  # noqa: E402
+    CIGW_PROPERTIES_FILE,
+    METRICS_DIR,
     REST_PORT,
+    WEBHOOK_QUEUE_DIR,
     get_controllers,
+    get_progressive_console,
     get_rest_path,
     get_badge_path,
     validate_hook_token
-)  # noqa: E402
+)
+from artifacts import (  # noqa: E402
+    ARTIFACTS_DIR,
+    build_manifest,
+    get_latest_build,
+    read_manifest,
+    read_offloaded
+)
+from metrics import Metrics  # noqa: E402
+from webhooks import WebhookQueue, WebhookDispatcher  # noqa: E402
 
 
 logging.basicConfig(filename='/var/log/cwr-server/cwr-server.log',
                     level=logging.INFO)
 
 app = Flask(__name__)
+# Serve foo.log.gz in place of foo.log to clients that accept gzip
+app.config['SERVE_PRECOMPRESSED'] = True
 rest_path = get_rest_path()
 
-
-def json_response(data):
+# How often streamed console output is refreshed from Jenkins
+CONSOLE_POLL_SECS = 2
+# Default and largest number of files in a page of an artifact manifest
+MANIFEST_PAGE_SIZE = 100
+MANIFEST_MAX_PAGE_SIZE = 1000
+# Webhook metrics are labelled with the job's prefix, not its full name
+WEBHOOK_JOB_PREFIXES = ['cwr_charm_commit', 'cwr_charm_pr',
+                        'cwr_charm_release', 'cwr_bundle']
+
+metrics = Metrics(METRICS_DIR)
+metrics.describe('cwr_http_requests_total',
+                 'Requests served, by route, method and status.')
+metrics.describe('cwr_http_request_seconds',
+                 'Time to produce a response, by route.')
+metrics.describe('cwr_jenkins_request_seconds',
+                 'Latency of requests to Jenkins, by HTTP method.')
+metrics.describe('cwr_jenkins_errors_total',
+                 'Failed requests to Jenkins, by HTTP method and error.')
+metrics.describe('cwr_badge_cache_total',
+                 'Badge lookups, by cache result (hit or miss).')
+metrics.describe('cwr_artifact_bytes_total',
+                 'Artifact bytes sent to clients.')
+metrics.describe('cwr_webhooks_total',
+                 'Webhook deliveries, by job prefix and outcome.')
+
+
+def json_response(data, status=200):
     return (
         dumps(data, sort_keys=True, separators=(',', ': ')),
+        status,
         {'Content-Type': 'application/json'},
     )
 
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.monotonic()
+
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('cwr_http_requests_total', route=route,
+                method=request.method, status=response.status_code)
+    metrics.observe('cwr_http_request_seconds',
+                    time.monotonic() - g.request_start, route=route)
+    if request.endpoint == 'frontend' and response.status_code in (200, 206):
+        metrics.inc('cwr_artifact_bytes_total', response.content_length or 0)
+    return response
+
+
 @app.route("/ping")
 def ping():
     return "ok"
 
 
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 #
 # Controller operations: list, register, unregister
 #
@@ -85,52 +167,110 @@ def get_build_output(job_name, build_id):
     return dumps(build_info, sort_keys=True, separators=(',', ': '))
 
 
+@app.route(rest_path +
+           "/build-output/<string:job_name>/<int:build_id>/progressive")
+def get_build_output_progressive(job_name, build_id):
+    """
+    Return the console output of a build from the byte offset given in the
+    "start" argument, along with the offset to ask for next time and
+    whether the build may still produce more output.
+    """
+    start = request.args.get("start", 0, type=int)
+    text, next_start, more = get_progressive_console(
+        get_jenkins_client(), job_name, build_id, start)
+    return json_response({'text': text, 'next': next_start, 'more': more})
+
+
+@app.route(rest_path + "/build-output/<string:job_name>/<int:build_id>/stream")
+def stream_build_output(job_name, build_id):
+    """
+    Push the console output of a build as server-sent events until the
+    build is done. Each event carries the offset to resume from as its id,
+    so reconnecting clients only get what they have not seen yet.
+    """
+    start = request.headers.get("Last-Event-ID", type=int)
+    if start is None:
+        start = request.args.get("start", 0, type=int)
+
+    def events(start):
+        jclient = get_jenkins_client()
+        partial = ''
+        while True:
+            text, start, more = get_progressive_console(
+                jclient, job_name, build_id, start)
+            text = partial + text
+            # hold back the line Jenkins is still writing until it is
+            # complete, or the build is done
+            end = text.rfind('\n') + 1 if more else len(text)
+            text, partial = text[:end], text[end:]
+            if text:
+                data = ''.join('data: {}\n'.format(line)
+                               for line in text.splitlines())
+                sent = start - len(partial.encode('utf-8'))
+                yield 'id: {}\n{}\n'.format(sent, data)
+            if not more:
+                yield 'event: end\nid: {}\ndata: \n\n'.format(start)
+                return
+            time.sleep(CONSOLE_POLL_SECS)
+
+    return Response(events(start), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
 @app.route(get_badge_path("<string:job_name>"))
 def get_build_svg_output(job_name):
-    job_path = Path('/srv/artifacts') / job_name
-    report_file = None
-    if job_path.exists():
-        last_build = sorted(d for d in job_path.iterdir() if d.is_dir())[-1]
-        report_file = last_build / 'report.json'
-    templates_dir = str(Path(__file__).parent.parent / 'templates')
-
-    # We might not have a first build yet
-    if not report_file or not report_file.exists():
-        context = {'results': []}
-    else:
-        context = loads(report_file.read_text())
-
     results_args = request.args.get("results")
     if results_args:
-        # allow overriding results for testing
-        context['results'] = []
+        # allow overriding results for testing; never cached
+        context = {'results': []}
         for arg in results_args.split('_'):
             provider, test_outcome = arg.split('-')
             context['results'].append({
                 'provider': provider,
                 'test_outcome': test_outcome})
+        response = make_response(render_badge(context))
+        response.content_type = 'image/svg+xml'
+        return response
 
-    svg = templating.render(source='badge.svg',
-                            target=None,
-                            templates_dir=templates_dir,
-                            context=context)
-
-    response = make_response(svg)
+    badge = badge_cache.get(job_name)
+    response = make_response(badge['svg'])
     response.content_type = 'image/svg+xml'
-    return response
+    response.set_etag(badge['etag'])
+    if badge['last_modified']:
+        response.last_modified = badge['last_modified']
+    # let camo and browsers keep the badge but revalidate it every time
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route(rest_path + "/build-artifacts/<string:job_name>/<int:build_id>/")
 @app.route(rest_path + "/build-artifacts/<string:job_name>/<int:build_id>/"
-           "<string:filename>")
+           "<path:filename>")
 def get_build_artifact(job_name, build_id, filename=None):
-    charm_name = build_id[len('charm-'):]
+    """
+    Serve one artifact of a build or, without a filename, a page of the
+    build's artifact manifest. Use the "offset" and "limit" arguments to
+    page through the manifest. Files only have a sha256 digest once the
+    build is finished.
+    """
     if filename:
-        return frontend('/'.join([charm_name, build_id, filename]))
-    else:
-        files = [p.name for p in
-                 (Path('/srv/artifacts') / charm_name / build_id).iterdir()]
-        return json_response(files)
+        return frontend('/'.join([job_name, str(build_id), filename]))
+
+    manifest = manifest_cache.get(job_name, build_id)
+    if manifest is None:
+        abort(404)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = request.args.get("limit", MANIFEST_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), MANIFEST_MAX_PAGE_SIZE)
+    next_offset = offset + limit
+    return json_response({
+        'files': manifest[offset:next_offset],
+        'total': len(manifest),
+        'offset': offset,
+        'limit': limit,
+        'next': next_offset if next_offset < len(manifest) else None,
+    })
 
 
 #
@@ -160,6 +300,7 @@ def trigger_job():
 def trigger_job_from_webhook(job, token):
 
     if not validate_hook_token(job, token):
+        count_webhook(job, 'rejected')
         abort(400)
 
     if request.headers.get('X-GitHub-Event') == 'ping':
@@ -173,16 +314,18 @@ def trigger_job_from_webhook(job, token):
         tag_name = ""
 
     if request.headers.get('X-GitHub-Event') == 'release' and tag_name == '':
+        count_webhook(job, 'rejected')
         abort(400)
 
-    jclient = get_jenkins_client()
-    next_build_number = jclient.get_job_info(job)['nextBuildNumber']
+    # Jenkins is only contacted by the background dispatcher, so a slow or
+    # restarting Jenkins does not make GitHub deliveries time out.
     if job.startswith("cwr_charm"):
         # RELEASE_TAG is a required param for charm jobs
-        jclient.build_job(job, {'RELEASE_TAG': tag_name})
+        event_id = webhook_queue.put(job, {'RELEASE_TAG': tag_name})
     else:
-        jclient.build_job(job)
-    return str(next_build_number)
+        event_id = webhook_queue.put(job)
+    count_webhook(job, 'accepted')
+    return json_response({'queued': event_id}, 202)
 
 
 #
@@ -193,6 +336,7 @@ def trigger_job_from_webhook(job, token):
 def trigger_pr_job_from_webhook(job, token):
 
     if not validate_hook_token(job, token):
+        count_webhook(job, 'rejected')
         abort(400)
 
     if request.headers.get('X-GitHub-Event') == 'ping':
@@ -201,12 +345,21 @@ def trigger_pr_job_from_webhook(job, token):
     datastr = request.form['payload']
     data = loads(datastr)
     if data['action'] not in ['opened', 'synchronize']:
+        count_webhook(job, 'ignored')
         return "Action {} does not require CWR testing".format(data['action'])
 
-    jclient = get_jenkins_client()
-    next_build_number = jclient.get_job_info(job)['nextBuildNumber']
-    jclient.build_job(job, {'PR_ID': data['number']})
-    return str(next_build_number)
+    event_id = webhook_queue.put(job, {'PR_ID': data['number']})
+    count_webhook(job, 'accepted')
+    return json_response({'queued': event_id}, 202)
+
+
+def count_webhook(job, outcome):
+    for prefix in WEBHOOK_JOB_PREFIXES:
+        if job.startswith(prefix):
+            break
+    else:
+        prefix = 'other'
+    metrics.inc('cwr_webhooks_total', job_prefix=prefix, outcome=outcome)
 
 
 @app.route("/")
@@ -220,28 +373,287 @@ def frontend(filepath=None):
     """
     if not filepath:
         filepath = 'index.html'
-    fullpath = Path('/srv/artifacts') / filepath
-    if not fullpath.is_file():
-        abort(404)
-    fullpath = fullpath.resolve()
-    if not str(fullpath).startswith('/srv/artifacts/'):
-        abort(404)
     content_type, _ = mimetypes.guess_type(filepath)
     if not content_type:
         content_type = 'application/octet-stream'
-    contents = fullpath.read_bytes()
-    return contents, {'Content-Type': content_type}
+
+    if app.config['SERVE_PRECOMPRESSED']:
+        gzipped = None
+        if request.accept_encodings['gzip'] > 0:
+            gzipped = resolve_artifact(filepath + '.gz')
+        if gzipped:
+            response = send_file(str(gzipped), mimetype=content_type,
+                                 conditional=True)
+            response.content_encoding = 'gzip'
+            response.vary.add('Accept-Encoding')
+            return response
+
+    fullpath = resolve_artifact(filepath)
+    if not fullpath:
+        url = resolve_offloaded_artifact(filepath)
+        if not url:
+            abort(404)
+        return redirect(url)
+    # send_file streams the file (or hands it over to sendfile) and takes
+    # care of Range and conditional requests.
+    response = send_file(str(fullpath), mimetype=content_type,
+                         conditional=True)
+    if app.config['SERVE_PRECOMPRESSED']:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def resolve_artifact(filepath):
+    """
+    Return the resolved path of an artifact, or None if it is not a file
+    living under /srv/artifacts.
+    """
+    fullpath = Path(ARTIFACTS_DIR) / filepath
+    if not fullpath.is_file():
+        return None
+    fullpath = fullpath.resolve()
+    if not str(fullpath).startswith(ARTIFACTS_DIR + '/'):
+        return None
+    return fullpath
+
+
+def resolve_offloaded_artifact(filepath):
+    """
+    Return the URL of an artifact of a build that was removed from
+    /srv/artifacts after being offloaded to S3, or None.
+    """
+    parts = filepath.split('/')
+    if (len(parts) < 3 or parts[0].startswith('.') or
+            not parts[1].isdigit() or
+            any(part in ('', '.', '..') for part in parts)):
+        return None
+    location = read_offloaded(parts[0], parts[1])
+    if not location or not location.get('url'):
+        return None
+    return '{}/{}'.format(location['url'], quote('/'.join(parts[2:])))
+
+
+def resolve_artifact_dir(dirpath):
+    """
+    Return the resolved path of an artifacts directory, or None if it is
+    not a directory living under /srv/artifacts.
+    """
+    fullpath = Path(ARTIFACTS_DIR) / dirpath
+    if not fullpath.is_dir():
+        return None
+    fullpath = fullpath.resolve()
+    if not str(fullpath).startswith(ARTIFACTS_DIR + '/'):
+        return None
+    return fullpath
+
+
+class InstrumentedJenkins(Jenkins):
+    """Jenkins client recording the latency and errors of its requests."""
+
+    def jenkins_request(self, req, *args, **kwargs):
+        try:
+            with metrics.timer('cwr_jenkins_request_seconds',
+                               method=req.method):
+                return super().jenkins_request(req, *args, **kwargs)
+        except Exception as e:
+            metrics.inc('cwr_jenkins_errors_total', method=req.method,
+                        error=type(e).__name__)
+            raise
+
+
+class JenkinsClientCache:
+    """
+    Process-wide Jenkins client shared by all the gateway routes.
+
+    The client keeps a pool of keep-alive connections to Jenkins and is
+    only rebuilt when the properties file written by CIGateway.start()
+    changes, so webhook bursts do not pay for a new connection and auth
+    handshake on every request.
+    """
+
+    def __init__(self, properties_path, timeout=30, pool_size=16):
+        self.properties_path = properties_path
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._client = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        mtime = os.stat(self.properties_path).st_mtime_ns
+        with self._lock:
+            if self._client is None or mtime != self._mtime:
+                self._client = self._connect()
+                self._mtime = mtime
+            return self._client
+
+    def _connect(self):
+        with open(self.properties_path, 'r') as properties_file:
+            jenkins_url = properties_file.readline().rstrip('\n')
+            jenkins_user = properties_file.readline().rstrip('\n')
+            jenkins_pass = properties_file.readline().rstrip('\n')
+        logging.info("Connecting to Jenkins at {}".format(jenkins_url))
+        jclient = InstrumentedJenkins(jenkins_url, jenkins_user,
+                                      jenkins_pass, timeout=self.timeout)
+        # python-jenkins talks to the server through a requests session;
+        # give it a connection pool big enough for concurrent workers.
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size,
+                              max_retries=Retry(total=3, backoff_factor=0.1))
+        jclient._session.mount(jclient.server, adapter)
+        return jclient
+
+
+jenkins_clients = JenkinsClientCache(CIGW_PROPERTIES_FILE)
 
 
 def get_jenkins_client():
-    properties_path = "/var/lib/jenkins/CIGWServer.properties"
-    with open(properties_path, 'r') as properties_file:
-        jenkins_url = properties_file.readline().rstrip('\n')
-        jenkins_user = properties_file.readline().rstrip('\n')
-        jenkins_pass = properties_file.readline().rstrip('\n')
-    jclient = Jenkins(jenkins_url, jenkins_user, jenkins_pass)
-    return jclient
+    return jenkins_clients.get()
+
+
+badge_template = Environment(
+    loader=FileSystemLoader(str(Path(__file__).parent.parent / 'templates')),
+).get_template('badge.svg')
+
+
+def render_badge(context):
+    return badge_template.render(context)
+
+
+def get_latest_report(job_name):
+    """
+    Return the report.json of the latest build of a job, or None if the job
+    has no builds yet.
+    """
+    last_build = get_latest_build(job_name)
+    if not last_build:
+        return None
+    return last_build / 'report.json'
+
+
+class BadgeCache:
+    """
+    Rendered build badges keyed on the latest report's path and mtime, most
+    recently used first.
+
+    Badges are hit constantly through GitHub's camo proxy, so a badge that
+    was checked less than recheck_secs ago is served (or revalidated) from
+    memory without looking at /srv/artifacts at all. Only jobs with a
+    report are kept, so made up job names in badge URLs cost no memory.
+    """
+
+    def __init__(self, recheck_secs=10, max_badges=1024):
+        self.recheck_secs = recheck_secs
+        self.max_badges = max_badges
+        self._badges = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, job_name):
+        now = time.monotonic()
+        with self._lock:
+            badge = self._badges.get(job_name)
+            if badge:
+                self._badges.move_to_end(job_name)
+        if badge and now - badge['checked'] < self.recheck_secs:
+            metrics.inc('cwr_badge_cache_total', result='hit')
+            return badge
+
+        report_file = get_latest_report(job_name)
+        try:
+            stat = report_file.stat()
+            key = (str(report_file), stat.st_mtime_ns)
+        except (AttributeError, FileNotFoundError):
+            # We might not have a first build yet
+            stat = key = None
+
+        if badge and badge['key'] == key:
+            metrics.inc('cwr_badge_cache_total', result='hit')
+        else:
+            metrics.inc('cwr_badge_cache_total', result='miss')
+            if key:
+                context = loads(report_file.read_text())
+                last_modified = datetime.fromtimestamp(stat.st_mtime,
+                                                       timezone.utc)
+            else:
+                context = {'results': []}
+                last_modified = None
+            svg = render_badge(context)
+            badge = {
+                'key': key,
+                'svg': svg,
+                'etag': hashlib.sha1(svg.encode('utf-8')).hexdigest(),
+                'last_modified': last_modified,
+            }
+        badge = dict(badge, checked=now)
+        with self._lock:
+            if key is None:
+                self._badges.pop(job_name, None)
+                return badge
+            self._badges[job_name] = badge
+            self._badges.move_to_end(job_name)
+            while len(self._badges) > self.max_badges:
+                self._badges.popitem(last=False)
+        return badge
+
+
+badge_cache = BadgeCache()
+
+
+class ManifestCache:
+    """
+    Artifact manifests of finished builds, most recently used first.
+
+    Finished builds never change, and their manifest is stored on disk when
+    they finish (see update_latest_build), so it is only read once. Running
+    builds, and builds that finished before manifests were stored, are
+    listed on every request without digests: hashing their files for
+    anonymous requests would let anyone keep the server busy.
+    """
+
+    def __init__(self, max_builds=256):
+        self.max_builds = max_builds
+        self._manifests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, job_name, build_id):
+        key = (job_name, build_id)
+        with self._lock:
+            if key in self._manifests:
+                self._manifests.move_to_end(key)
+                return self._manifests[key]
+
+        build_dir = resolve_artifact_dir('{}/{}'.format(job_name, build_id))
+        # the manifest outlives the builds removed after being offloaded,
+        # whose files are redirected to S3
+        if not build_dir and (job_name.startswith('.') or
+                              not read_offloaded(job_name, build_id)):
+            return None
+        manifest = read_manifest(job_name, build_id)
+        if manifest is None:
+            if not build_dir:
+                return None
+            return build_manifest(build_dir, digests=False)
+        with self._lock:
+            self._manifests[key] = manifest
+            while len(self._manifests) > self.max_builds:
+                self._manifests.popitem(last=False)
+        return manifest
+
+
+manifest_cache = ManifestCache()
+webhook_queue = WebhookQueue(WEBHOOK_QUEUE_DIR)
+
+
+def start_background_tasks():
+    """
+    Start the threads of a gateway worker: the metrics snapshots and the
+    webhook dispatcher. Gunicorn calls this once the worker is ready (see
+    cwr-server.conf.py).
+    """
+    metrics.start_snapshots()
+    WebhookDispatcher(webhook_queue, get_jenkins_client).start()
 
 
 if __name__ == "__main__":
+    start_background_tasks()
     app.run(host="0.0.0.0", port=REST_PORT)
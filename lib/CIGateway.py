@@ -1,32 +1,51 @@
+from multiprocessing import cpu_count
 from pathlib import Path
 import subprocess
 
 from jenkins import Jenkins
 from charmhelpers.core import hookenv, host
 from charmhelpers.core import templating
+from utils import (
+    CIGW_PROPERTIES_FILE,
+    METRICS_DIR,
+    REST_PORT,
+    WEBHOOK_QUEUE_DIR
+)
+
+
+GUNICORN_CONFIG_FILE = "/etc/cwr-server/gunicorn.conf.py"
+SERVICE_FILE = "/etc/systemd/system/cwr-server.service"
 
 
 class CIGateway:
 
     @classmethod
     def start(cls, jenkins_url, jenkins_user, jenkins_pass, user='jenkins'):
-        Path("/var/lib/jenkins/CIGWServer.properties").write_text("\n".join([
+        # Write atomically; the gateway reloads its Jenkins client whenever
+        # this file's mtime changes and must never see a partial file.
+        properties = Path(CIGW_PROPERTIES_FILE)
+        tmp_properties = properties.with_suffix('.tmp')
+        tmp_properties.write_text("\n".join([
             jenkins_url,
             jenkins_user,
             jenkins_pass,
         ]))
+        tmp_properties.replace(properties)
 
         host.mkdir("/var/log/cwr-server",
                    owner='ubuntu',
                    group='ubuntu',
                    perms=0o755)
+        host.mkdir(WEBHOOK_QUEUE_DIR,
+                   owner='ubuntu',
+                   group='ubuntu',
+                   perms=0o755)
+        host.mkdir(METRICS_DIR,
+                   owner='ubuntu',
+                   group='ubuntu',
+                   perms=0o755)
 
-        templating.render(
-            source="cwr-server.service",
-            target="/etc/systemd/system/cwr-server.service",
-            context={
-                'charm_dir': hookenv.charm_dir()
-            })
+        cls.render_service()
 
         host.service_resume('cwr-server')
         if host.init_is_systemd():
@@ -44,10 +63,56 @@ class CIGateway:
     def restart(cls):
         host.service_restart('cwr-server')
 
+    @classmethod
+    def reload(cls):
+        """Replace the workers gracefully, with the current settings."""
+        host.service_reload('cwr-server')
+
+    @classmethod
+    def render_service(cls):
+        """
+        Write the systemd unit running the gateway's WSGI server, and the
+        server's settings.
+
+        Returns: True if the unit changed, in which case the server must be
+        restarted; a reload is enough to apply new settings
+
+        """
+        templating.render(
+            source="cwr-server.conf.py",
+            target=GUNICORN_CONFIG_FILE,
+            context=cls.get_server_options(),
+            perms=0o644)
+        unit_hash = host.file_hash(SERVICE_FILE)
+        templating.render(
+            source="cwr-server.service",
+            target=SERVICE_FILE,
+            context=dict(charm_dir=hookenv.charm_dir(),
+                         config_file=GUNICORN_CONFIG_FILE,
+                         port=REST_PORT))
+        if host.file_hash(SERVICE_FILE) == unit_hash:
+            return False
+        if host.init_is_systemd():
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+        return True
+
+    @classmethod
+    def get_server_options(cls):
+        """Worker settings for the gateway's WSGI server, from charm config."""
+        config = hookenv.config()
+        workers = config.get('gateway_workers') or cpu_count() * 2 + 1
+        max_requests = config.get('gateway_max_requests') or 0
+        return {
+            'workers': workers,
+            'threads': max(config.get('gateway_threads') or 1, 1),
+            'max_requests': max_requests,
+            # stagger recycling so workers do not all restart at once
+            'max_requests_jitter': max_requests // 10,
+        }
+
     @classmethod
     def get_current_jenkins(cls):
-        properties_path = "/var/lib/jenkins/CIGWServer.properties"
-        with open(properties_path, 'r') as properties_file:
+        with open(CIGW_PROPERTIES_FILE, 'r') as properties_file:
             jenkins_url = properties_file.readline().rstrip('\n')
             jenkins_user = properties_file.readline().rstrip('\n')
             jenkins_pass = properties_file.readline().rstrip('\n')
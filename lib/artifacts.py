@@ -0,0 +1,266 @@
+from json import dumps, loads
+from pathlib import Path
+import fcntl
+import hashlib
+import os
+import stat
+import time
+import xml.etree.ElementTree as ET
+
+
+ARTIFACTS_DIR = "/srv/artifacts"
+JOBS_INDEX = "jobs.json"
+LATEST_LINK = "latest"
+# The manifest of a finished build is stored next to its directory, as
+# <job>/.<build>.manifest.json
+MANIFEST_SUFFIX = ".manifest.json"
+# Where the artifacts of a build removed after being offloaded to S3 went,
+# as <job>/.<build>.offloaded.json
+OFFLOADED_SUFFIX = ".offloaded.json"
+
+
+def get_latest_build(job_name, root=ARTIFACTS_DIR):
+    """
+    Return the directory of the latest build of a job, or None if the job
+    has no builds yet.
+
+    The 'latest' pointer maintained by update_latest_build is used when
+    present; older jobs fall back to the highest numbered build directory.
+    """
+    job_path = Path(root) / job_name
+    try:
+        return job_path / os.readlink(str(job_path / LATEST_LINK))
+    except OSError:
+        pass
+    if not job_path.is_dir():
+        return None
+    builds = [d for d in job_path.iterdir()
+              if d.name.isdigit() and d.is_dir()]
+    if not builds:
+        return None
+    return max(builds, key=lambda d: int(d.name))
+
+
+def update_latest_build(job_name, build_number, root=ARTIFACTS_DIR):
+    """
+    Store the manifest of the finished build and, unless a later build of
+    the job finished first, point the job's 'latest' link at build_number
+    and record the build's results in the top-level jobs index.
+
+    All three files are replaced atomically, so readers never see them half
+    written, and the link and index are updated under a lock so concurrent
+    jobs do not drop each other's entries.
+    """
+    root = Path(root)
+    job_path = root / job_name
+    build = str(build_number)
+    if not (job_path / build).is_dir():
+        return
+
+    write_manifest(job_name, build, root=str(root))
+
+    report_file = job_path / build / 'report.json'
+    try:
+        results = loads(report_file.read_text()).get('results', [])
+    except (OSError, ValueError):
+        results = []
+
+    with (root / '.{}.lock'.format(JOBS_INDEX)).open('w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            latest = int(os.readlink(str(job_path / LATEST_LINK)))
+        except (OSError, ValueError):
+            latest = None
+        # builds do not always finish in the order they started
+        if latest is not None and latest > int(build):
+            return
+        tmp_link = job_path / '.{}.{}'.format(LATEST_LINK, os.getpid())
+        if os.path.lexists(str(tmp_link)):
+            tmp_link.unlink()
+        os.symlink(build, str(tmp_link))
+        os.replace(str(tmp_link), str(job_path / LATEST_LINK))
+
+        jobs = read_jobs_index(root)
+        jobs[job_name] = {
+            'build': build,
+            'results': results,
+            'updated': int(time.time()),
+        }
+        tmp_index = root / '.{}.{}'.format(JOBS_INDEX, os.getpid())
+        tmp_index.write_text(dumps(jobs, sort_keys=True, indent=2))
+        os.replace(str(tmp_index), str(root / JOBS_INDEX))
+
+
+def is_build_finished(job_name, build_number, root=ARTIFACTS_DIR):
+    """
+    A build is finished once update_latest_build stored its manifest; its
+    artifacts will not change any more. Builds that finished before
+    manifests were stored are not known to be finished.
+    """
+    return get_manifest_path(job_name, build_number, root).is_file()
+
+
+def build_manifest(build_dir, digests=True):
+    """
+    Walk a build's artifacts.
+
+    Returns: a list with the path (relative to build_dir), size, mtime and,
+    if digests is True, sha256 digest of every file, sorted by path
+
+    """
+    build_dir = str(build_dir)
+    files = []
+    for dirpath, dirnames, filenames in os.walk(build_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            entry = {
+                'path': os.path.relpath(path, build_dir),
+                'size': st.st_size,
+                'mtime': int(st.st_mtime),
+            }
+            if digests:
+                entry['sha256'] = file_digest(path)
+            files.append(entry)
+    files.sort(key=lambda f: f['path'])
+    return files
+
+
+def get_manifest_path(job_name, build_number, root=ARTIFACTS_DIR):
+    return Path(root) / job_name / '.{}{}'.format(build_number,
+                                                  MANIFEST_SUFFIX)
+
+
+def write_manifest(job_name, build_number, root=ARTIFACTS_DIR):
+    """
+    Store the manifest of a finished build, so it is only computed once.
+
+    Returns: the manifest
+
+    """
+    manifest = build_manifest(Path(root) / job_name / str(build_number))
+    path = get_manifest_path(job_name, build_number, root)
+    tmp_path = path.with_name('{}.{}'.format(path.name, os.getpid()))
+    tmp_path.write_text(dumps(manifest))
+    os.replace(str(tmp_path), str(path))
+    return manifest
+
+
+def read_manifest(job_name, build_number, root=ARTIFACTS_DIR):
+    """
+    Returns: the stored manifest of a build, or None if the build is not
+    finished or finished before manifests were stored
+
+    """
+    try:
+        return loads(get_manifest_path(job_name, build_number,
+                                       root).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def get_offloaded_path(job_name, build_number, root=ARTIFACTS_DIR):
+    return Path(root) / job_name / '.{}{}'.format(build_number,
+                                                  OFFLOADED_SUFFIX)
+
+
+def write_offloaded(job_name, build_number, location, root=ARTIFACTS_DIR):
+    """
+    Record where the artifacts of a build are kept once its local copy is
+    removed. location holds the bucket, the key prefix of the build and the
+    URL the prefix is served from.
+    """
+    path = get_offloaded_path(job_name, build_number, root)
+    tmp_path = path.with_name('{}.{}'.format(path.name, os.getpid()))
+    tmp_path.write_text(dumps(location, sort_keys=True))
+    os.replace(str(tmp_path), str(path))
+
+
+def read_offloaded(job_name, build_number, root=ARTIFACTS_DIR):
+    """
+    Returns: where the artifacts of an offloaded build are kept, or None if
+    the build was not removed after being offloaded
+
+    """
+    try:
+        return loads(get_offloaded_path(job_name, build_number,
+                                        root).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def merge_reports(build_dir, runs):
+    """
+    Combine the reports of CWR runs made against different controllers
+    into the build's report.json and report.xml.
+
+    Args:
+        build_dir: the build's artifacts directory
+        runs: a list of (controller, directory the run wrote its reports to)
+
+    A run that left no report, because it failed before CWR could write
+    one, is reported as an infrastructure failure of its controller.
+
+    Returns: the merged results, as in report.json
+
+    """
+    build_dir = Path(build_dir)
+    report = None
+    results = []
+    suites = ET.Element('testsuites')
+    for controller, report_dir in runs:
+        report_dir = Path(report_dir)
+        try:
+            run_report = loads((report_dir / 'report.json').read_text())
+            run_suites = ET.parse(str(report_dir / 'report.xml')).getroot()
+        except (OSError, ValueError, ET.ParseError):
+            results.append({'provider': controller, 'test_outcome': 'INFRA',
+                            'tests': []})
+            suite = ET.SubElement(suites, 'testsuite', name=controller,
+                                  tests='1', failures='1')
+            case = ET.SubElement(suite, 'testcase', classname=controller,
+                                 name='cwr')
+            ET.SubElement(case, 'failure',
+                          message='CWR did not report any result')
+            continue
+        if report is None:
+            report = run_report
+        results.extend(run_report.get('results', []))
+        if run_suites.tag == 'testsuite':
+            suites.append(run_suites)
+        else:
+            suites.extend(run_suites)
+
+    report = dict(report or {}, results=results)
+    tmp_json = build_dir / '.report.json.{}'.format(os.getpid())
+    tmp_json.write_text(dumps(report, indent=2))
+    os.replace(str(tmp_json), str(build_dir / 'report.json'))
+    tmp_xml = build_dir / '.report.xml.{}'.format(os.getpid())
+    ET.ElementTree(suites).write(str(tmp_xml), encoding='utf-8',
+                                 xml_declaration=True)
+    os.replace(str(tmp_xml), str(build_dir / 'report.xml'))
+    return results
+
+
+def read_jobs_index(root=ARTIFACTS_DIR):
+    """
+    Returns: a dict with the latest build and results of every job
+
+    """
+    try:
+        return loads((Path(root) / JOBS_INDEX).read_text())
+    except (OSError, ValueError):
+        return {}
@@ -0,0 +1,242 @@
+"""
+Keep a pool of started, network ready cwrbox containers for the jobs.
+
+Creating a container, starting it, waiting for its network and updating
+its packages takes about a minute; the cwr-container-pool service does it
+ahead of time so run_in_container in cwr-helpers.sh only has to claim a
+container and attach the job's workspace. Every ready container is a file
+in the pool's ready directory; claiming one is unlinking that file, which
+only one job can do.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps, loads
+from pathlib import Path
+from uuid import uuid4
+import fcntl
+import logging
+import os
+import re
+import subprocess
+import time
+
+
+POOL_DIR = "/var/lib/jenkins/container-pool"
+IMAGE_ALIAS = "cwrbox"
+CONTAINER_PREFIX = "cwrpool-"
+# Ready containers are replaced after this long, so their package lists
+# stay fresh
+MAX_AGE = 6 * 3600
+NETWORK_TIMEOUT = 30
+
+
+def lxc(*args):
+    return subprocess.check_output(('lxc',) + args,
+                                   universal_newlines=True,
+                                   stderr=subprocess.STDOUT)
+
+
+class ContainerPool:
+    """
+    The ready containers of the pool, made from the image behind the
+    cwrbox alias. The wanted number of containers is read from the pool's
+    size file, written by the charm.
+    """
+
+    def __init__(self, path=POOL_DIR, lxc=lxc, max_age=MAX_AGE):
+        self.path = Path(path)
+        self.ready_dir = self.path / 'ready'
+        self.preparing_dir = self.path / 'preparing'
+        self.lxc = lxc
+        self.max_age = max_age
+
+    def size(self):
+        try:
+            return max(int((self.path / 'size').read_text()), 0)
+        except (OSError, ValueError):
+            return 0
+
+    def image_fingerprint(self):
+        """
+        Returns: the fingerprint of the image behind the cwrbox alias, or
+        None if there is no such image yet
+
+        """
+        try:
+            info = self.lxc('image', 'info', IMAGE_ALIAS)
+        except subprocess.CalledProcessError:
+            return None
+        match = re.search(r'^Fingerprint:\s*(\S+)', info, re.MULTILINE)
+        return match.group(1) if match else None
+
+    def ready(self):
+        """
+        Returns: the names of the ready containers and what is known about
+        them: the image they were made from and when they were ready
+
+        """
+        containers = {}
+        for path in self.ready_dir.glob(CONTAINER_PREFIX + '*'):
+            try:
+                containers[path.name] = loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+        return containers
+
+    def take(self, name):
+        """
+        Remove a container from the pool.
+
+        Returns: True if it was still there, in which case the caller owns it
+
+        """
+        try:
+            (self.ready_dir / name).unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def claim(self, fingerprint=None):
+        """
+        Take a ready container made from the current image out of the pool.
+        Containers made from another image, or too old, are deleted on the
+        way.
+
+        Returns: the name of the container, or None if none is ready
+
+        """
+        ready = self.ready()
+        if not ready:
+            return None
+        fingerprint = fingerprint or self.image_fingerprint()
+        for name, info in sorted(ready.items(),
+                                 key=lambda item: item[1].get('ready', 0)):
+            if not self.take(name):
+                continue
+            if self.is_usable(info, fingerprint):
+                return name
+            self.delete(name)
+        return None
+
+    def is_usable(self, info, fingerprint):
+        return (fingerprint is not None and
+                info.get('image') == fingerprint and
+                info.get('ready', 0) + self.max_age > time.time())
+
+    def delete(self, name):
+        try:
+            self.lxc('delete', '--force', name)
+        except subprocess.CalledProcessError as e:
+            logging.warning("Failed to delete container {}: {}"
+                            .format(name, e.output))
+
+    def prepare(self, fingerprint):
+        """
+        Create a container from the image, with the job independent setup of
+        run_in_container done, and add it to the pool.
+
+        Returns: the name of the container
+
+        """
+        name = CONTAINER_PREFIX + uuid4().hex[:12]
+        marker = self.preparing_dir / name
+        marker.touch()
+        try:
+            self.lxc('init', fingerprint, name, '--ephemeral')
+            # map container's root to jenkins
+            self.lxc('config', 'set', name, 'raw.idmap',
+                     'uid {} 0\ngid {} 0'.format(os.getuid(), os.getgid()))
+            self.lxc('config', 'device', 'add', name, 'artifacts', 'disk',
+                     'source=/srv/artifacts', 'path=/srv/artifacts')
+            self.lxc('start', name)
+            deadline = time.time() + NETWORK_TIMEOUT
+            while not re.search(r'eth0:\sinet\s', self.lxc('info', name)):
+                if time.time() > deadline:
+                    raise RuntimeError('Container does not have network '
+                                       'connectivity')
+                time.sleep(1)
+            self.lxc('exec', name, '--', 'apt', 'update', '-yq')
+
+            tmp_path = self.ready_dir / '.{}'.format(name)
+            tmp_path.write_text(dumps({'image': fingerprint,
+                                       'ready': time.time()}))
+            os.replace(str(tmp_path), str(self.ready_dir / name))
+        except Exception:
+            self.delete(name)
+            raise
+        finally:
+            marker.unlink()
+        return name
+
+    def refill(self, executor):
+        """
+        Replace the ready containers that are not usable any more, because
+        the image changed or they are too old, and start preparing as many
+        containers as the pool is missing.
+
+        Returns: the futures of the containers being prepared
+
+        """
+        fingerprint = self.image_fingerprint()
+        if fingerprint is None:
+            return []
+        usable = 0
+        for name, info in self.ready().items():
+            if self.is_usable(info, fingerprint):
+                usable += 1
+            elif self.take(name):
+                logging.info("Discarding container {}".format(name))
+                self.delete(name)
+        # a shrunk pool is trimmed as containers are claimed
+        missing = self.size() - usable
+        return [executor.submit(self.prepare, fingerprint)
+                for _ in range(missing)]
+
+    def cleanup(self):
+        """
+        Delete the containers left half prepared, and all ready ones if the
+        pool is disabled.
+        """
+        for marker in self.preparing_dir.glob(CONTAINER_PREFIX + '*'):
+            self.delete(marker.name)
+            marker.unlink()
+        if not self.size():
+            for name in self.ready():
+                if self.take(name):
+                    self.delete(name)
+
+    def run(self, poll_secs=5):
+        """
+        Keep the pool full until killed.
+        """
+        self.ready_dir.mkdir(parents=True, exist_ok=True)
+        self.preparing_dir.mkdir(parents=True, exist_ok=True)
+        with (self.path / '.pool.lock').open('w') as lock:
+            # Only one manager at a time, even when run by hand
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.cleanup()
+            preparing = []
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                while True:
+                    for future in [f for f in preparing if f.done()]:
+                        preparing.remove(future)
+                        try:
+                            logging.info("Container {} is ready"
+                                         .format(future.result()))
+                        except Exception as e:
+                            logging.warning("Failed to prepare a container:"
+                                            " {}".format(e))
+                    if not preparing:
+                        try:
+                            if not self.size():
+                                self.cleanup()
+                            preparing = self.refill(executor)
+                        except Exception:
+                            logging.exception("Failed to refill the pool")
+                    time.sleep(poll_secs)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    ContainerPool().run()
@@ -0,0 +1,116 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps, loads
+from pathlib import Path
+import fcntl
+import os
+import re
+import xml.etree.ElementTree as ET
+
+from charmhelpers.core import templating
+from utils import get_output_scenarios
+
+
+# The templates and contexts of the jobs added by actions, so that they can
+# be rendered again when the charm (and its templates) is upgraded
+JOBS_REGISTRY_FILE = "/var/lib/jenkins/cwr-jobs.json"
+
+
+class JobSpec(namedtuple('JobSpec', ['name', 'template', 'context'])):
+    """A Jenkins job rendered from one of the charm's templates."""
+
+    def render(self):
+        context = dict(self.context, output_scenarios=get_output_scenarios())
+        return templating.render(source=self.template, target=None,
+                                 context=context)
+
+
+def record_job(job, path=JOBS_REGISTRY_FILE):
+    """
+    Remember how a job was rendered. The registry is updated under a lock
+    and replaced atomically; it may hold secrets, so only root can read it.
+    """
+    path = Path(path)
+    with open(str(path) + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        jobs = read_registry(path)
+        jobs[job.name] = {'template': job.template, 'context': job.context}
+        tmp_path = path.with_name('.{}.{}'.format(path.name, os.getpid()))
+        fd = os.open(str(tmp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(dumps(jobs, sort_keys=True, indent=2))
+        os.replace(str(tmp_path), str(path))
+
+
+def read_registry(path=JOBS_REGISTRY_FILE):
+    try:
+        return loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def recorded_jobs(path=JOBS_REGISTRY_FILE):
+    """
+    Returns: a JobSpec for every job recorded with record_job
+    """
+    return [JobSpec(name, job['template'], job['context'])
+            for name, job in sorted(read_registry(path).items())]
+
+
+def normalize_config(config_xml):
+    """
+    Reduce a job's config.xml to what Jenkins cares about, so that
+    formatting, the XML declaration and attribute order do not make two
+    configs differ.
+    """
+    # ElementTree does not like declarations of XML 1.1, which Jenkins uses
+    config_xml = re.sub(r'^\s*<\?xml[^>]*\?>', '', config_xml)
+
+    def normalize(element):
+        return (element.tag,
+                tuple(sorted(element.attrib.items())),
+                (element.text or '').strip(),
+                tuple(normalize(child) for child in element))
+
+    return normalize(ET.fromstring(config_xml))
+
+
+def reconcile_jobs(jclient, jobs, max_workers=8):
+    """
+    Make Jenkins jobs match the given configs. Missing jobs are created and
+    jobs whose config differs are reconfigured, keeping their build
+    history; the others are left alone. Jobs are compared and updated
+    concurrently.
+
+    Args:
+        jclient: the Jenkins client
+        jobs: a dict of job names to config.xml
+        max_workers: how many jobs to handle at the same time
+
+    Returns: a dict of job names to 'created', 'updated', 'unchanged' or
+    the exception raised while handling the job
+
+    """
+    existing = {job['name'] for job in jclient.get_jobs()}
+
+    def reconcile(name, config_xml):
+        if name not in existing:
+            jclient.create_job(name, config_xml)
+            return 'created'
+        current = jclient.get_job_config(name)
+        if normalize_config(current) == normalize_config(config_xml):
+            return 'unchanged'
+        jclient.reconfig_job(name, config_xml)
+        return 'updated'
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {name: pool.submit(reconcile, name, config_xml)
+                   for name, config_xml in jobs.items()}
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            results[name] = e
+    return results
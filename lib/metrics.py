@@ -0,0 +1,237 @@
+from contextlib import contextmanager
+from json import dumps, loads
+from pathlib import Path
+import atexit
+import bisect
+import fcntl
+import logging
+import os
+import threading
+import time
+
+
+# Latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+# Totals of the workers that are gone, kept so counters never go down
+RETIRED_SNAPSHOT = 'retired.json'
+
+
+class Metrics:
+    """
+    Counters and histograms rendered in the Prometheus text format.
+
+    Updates only take a lock and bump a number, so instrumenting hot paths
+    is cheap. Each gateway worker process keeps its own values and
+    periodically writes them to a snapshot file in a shared directory; a
+    scrape of any worker sums the snapshots of all live workers and the
+    totals of the retired ones.
+    """
+
+    def __init__(self, snapshot_dir=None, snapshot_secs=5,
+                 buckets=DEFAULT_BUCKETS):
+        self.snapshot_dir = snapshot_dir and Path(snapshot_dir)
+        self.snapshot_secs = snapshot_secs
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # one count per bucket, +Inf, then the sum of observations
+                histogram = [0] * (len(self.buckets) + 2)
+                self._histograms[key] = histogram
+            histogram[index] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value
+                             in self._counters.items()],
+                'histograms': [[name, labels, list(values)]
+                               for (name, labels), values
+                               in self._histograms.items()],
+            }
+
+    def start_snapshots(self):
+        """Periodically write this process' values to snapshot_dir."""
+        if not self.snapshot_dir:
+            return
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+
+        def write_snapshots():
+            while True:
+                try:
+                    self.write_snapshot()
+                except OSError:
+                    logging.exception("Failed to write metrics snapshot")
+                time.sleep(self.snapshot_secs)
+
+        threading.Thread(target=write_snapshots, name='metrics-snapshots',
+                         daemon=True).start()
+        # keep what was counted since the last snapshot when recycled
+        atexit.register(self.write_snapshot)
+
+    def write_snapshot(self):
+        path = self.snapshot_dir / '{}.json'.format(os.getpid())
+        tmp_path = self.snapshot_dir / '.{}.tmp'.format(os.getpid())
+        tmp_path.write_text(dumps(self.snapshot()))
+        tmp_path.replace(path)
+
+    def collect(self):
+        """
+        Returns: the snapshots of every live worker, this one included, and
+        the totals of the workers that are gone
+
+        """
+        snapshots = [self.snapshot()]
+        # no worker wrote a snapshot yet
+        if not self.snapshot_dir or not self.snapshot_dir.is_dir():
+            return snapshots
+        own = '{}.json'.format(os.getpid())
+        stale = time.time() - 3 * self.snapshot_secs
+        retired_path = self.snapshot_dir / RETIRED_SNAPSHOT
+        with (self.snapshot_dir / '.retired.lock').open('w') as lock:
+            # a worker's totals must be counted either in its own snapshot
+            # or in the retired one, never in both or neither
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired = read_snapshot(retired_path)
+            gone = []
+            for path in self.snapshot_dir.glob('*.json'):
+                if path.name in (own, RETIRED_SNAPSHOT):
+                    continue
+                try:
+                    snapshot = read_snapshot(path)
+                    if path.stat().st_mtime < stale:
+                        # the worker is gone (recycled or crashed)
+                        gone.append((path, snapshot))
+                        continue
+                except OSError:
+                    continue
+                if snapshot:
+                    snapshots.append(snapshot)
+            if gone:
+                retired = merge_snapshots(
+                    [retired] + [snapshot for _, snapshot in gone])
+                tmp_path = self.snapshot_dir / '.{}.{}'.format(
+                    RETIRED_SNAPSHOT, os.getpid())
+                tmp_path.write_text(dumps(retired))
+                tmp_path.replace(retired_path)
+                for path, _ in gone:
+                    path.unlink()
+        if retired:
+            snapshots.append(retired)
+        return snapshots
+
+    def render(self):
+        counters, histograms = sum_snapshots(self.collect())
+
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            if name in self._help:
+                lines.append('# HELP {} {}'.format(name, self._help[name]))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        for (name, labels), values in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels + (('le', str(bound)),)),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(
+                name, format_labels(labels), values[-1]))
+            lines.append('{}_count{} {}'.format(
+                name, format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels) + '}'
+
+
+def read_snapshot(path):
+    """
+    Returns: the snapshot stored in path, or None if there is none
+
+    """
+    try:
+        return loads(path.read_text())
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logging.warning("Ignoring malformed metrics snapshot {}".format(path))
+        return None
+
+
+def sum_snapshots(snapshots):
+    """
+    Returns: the counters and the histograms of all snapshots, summed and
+    keyed on their name and labels
+
+    """
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        if not snapshot:
+            continue
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            merged = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                merged[i] += value
+    return counters, histograms
+
+
+def merge_snapshots(snapshots):
+    """
+    Returns: a snapshot holding the sum of all snapshots
+
+    """
+    counters, histograms = sum_snapshots(snapshots)
+    return {
+        'counters': [[name, labels, value]
+                     for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, values]
+                       for (name, labels), values in histograms.items()],
+    }
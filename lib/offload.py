@@ -0,0 +1,403 @@
+"""
+Offload the artifacts of finished builds to S3 compatible storage.
+
+The offloader runs in the background (see the cwr-offload service), so
+builds finish as soon as their artifacts are on the unit's disk. Files are
+uploaded concurrently, large ones in parts, and what was uploaded is
+recorded as it goes so an interrupted upload resumes where it stopped.
+Once S3 confirms every file of a build, the local copy becomes subject to
+the retention policy; the gateway then redirects requests for its
+artifacts to the bucket.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps, loads
+from pathlib import Path
+from shutil import rmtree
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from artifacts import (
+    ARTIFACTS_DIR,
+    LATEST_LINK,
+    build_manifest,
+    is_build_finished,
+    write_offloaded,
+)
+
+
+OFFLOAD_DIR = "/var/lib/jenkins/artifacts-offload"
+OFFLOAD_CONFIG_FILE = "config.json"
+# S3 parts must be at least 5MB, except for the last one
+PART_SIZE = 8 * 1024 * 1024
+DEFAULT_WORKERS = 8
+DEFAULT_RETENTION_DAYS = 7
+
+
+class OffloadError(Exception):
+    pass
+
+
+def read_config(path=OFFLOAD_DIR):
+    """
+    Returns: the offload settings written by the configure-artifacts-offload
+    action, or None if offloading is not configured
+
+    """
+    try:
+        config = loads((Path(path) / OFFLOAD_CONFIG_FILE).read_text())
+    except (OSError, ValueError):
+        return None
+    return config if config.get('bucket') else None
+
+
+def write_config(config, path=OFFLOAD_DIR):
+    """
+    Replace the offload settings. The file holds S3 credentials, so only
+    its owner can read it.
+    """
+    path = Path(path)
+    tmp_path = path / '.{}.{}'.format(OFFLOAD_CONFIG_FILE, os.getpid())
+    fd = os.open(str(tmp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(dumps(config, sort_keys=True, indent=2))
+    os.replace(str(tmp_path), str(path / OFFLOAD_CONFIG_FILE))
+
+
+def get_bucket_url(config):
+    """
+    Returns: the URL the objects of the configured bucket are served from,
+    path-style so that it works with any S3 compatible service
+
+    """
+    if config.get('endpoint'):
+        endpoint = config['endpoint'].rstrip('/')
+    elif config.get('region'):
+        endpoint = 'https://s3.{}.amazonaws.com'.format(config['region'])
+    else:
+        endpoint = 'https://s3.amazonaws.com'
+    return '{}/{}'.format(endpoint, config['bucket'])
+
+
+def make_s3_client(config):
+    """
+    Returns: a boto3 S3 client for the configured endpoint, which may be
+    any S3 compatible service (or a local stand-in)
+
+    """
+    import boto3
+    return boto3.client(
+        's3',
+        endpoint_url=config.get('endpoint') or None,
+        region_name=config.get('region') or None,
+        aws_access_key_id=config.get('access-key'),
+        aws_secret_access_key=config.get('secret-key'))
+
+
+class Offloader:
+    """
+    Upload finished builds under root to a bucket and apply the retention
+    policy to the local copies.
+
+    The progress of every build is kept in state_dir: <job>/<build>.json
+    while the build is being uploaded and <job>/<build>.done once S3
+    confirmed all its files. Builds removed by the retention policy leave
+    a record of their location in S3 under root (see write_offloaded).
+    """
+
+    def __init__(self, client, bucket, prefix='', root=ARTIFACTS_DIR,
+                 state_dir=OFFLOAD_DIR, workers=DEFAULT_WORKERS,
+                 part_size=PART_SIZE, retention_days=DEFAULT_RETENTION_DAYS,
+                 url=''):
+        self.client = client
+        self.bucket = bucket
+        self.url = url.rstrip('/')
+        self.prefix = prefix.strip('/')
+        self.root = Path(root)
+        self.state_dir = Path(state_dir) / 'builds'
+        self.workers = workers
+        self.part_size = part_size
+        self.retention_days = retention_days
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        return cls(make_s3_client(config), config['bucket'],
+                   prefix=config.get('prefix') or '',
+                   workers=config.get('workers') or DEFAULT_WORKERS,
+                   retention_days=config.get('retention-days',
+                                             DEFAULT_RETENTION_DAYS),
+                   url=get_bucket_url(config), **kwargs)
+
+    def get_key(self, job, build, relpath):
+        return '/'.join(p for p in (self.prefix, job, str(build), relpath)
+                        if p)
+
+    def _state_path(self, job, build, suffix):
+        return self.state_dir / job / '{}.{}'.format(build, suffix)
+
+    def builds(self):
+        """
+        Returns: the (job, build) of every build under root, oldest first
+
+        """
+        builds = []
+        for job_path in sorted(self.root.iterdir()):
+            if job_path.name.startswith('.') or not job_path.is_dir():
+                continue
+            for build_path in job_path.iterdir():
+                if build_path.name.isdigit() and build_path.is_dir():
+                    builds.append((job_path.name, int(build_path.name)))
+        builds.sort(key=lambda b: (b[1], b[0]))
+        return builds
+
+    def pending_builds(self):
+        """
+        Returns: the finished builds that are not confirmed in S3 yet
+
+        """
+        return [(job, build) for job, build in self.builds()
+                if is_build_finished(job, build, root=str(self.root)) and
+                not self._state_path(job, build, 'done').exists()]
+
+    def offload_build(self, job, build):
+        """
+        Upload every file of a build that is not in S3 yet, then check that
+        S3 has all of them.
+
+        Raises: OffloadError if any file could not be uploaded; what was
+        uploaded is kept for the next attempt
+
+        """
+        build_dir = self.root / job / str(build)
+        state_path = self._state_path(job, build, 'json')
+        state_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            state = loads(state_path.read_text())
+        except (OSError, ValueError):
+            state = {}
+        uploaded = state.setdefault('files', {})
+        uploads = state.setdefault('uploads', {})
+        lock = threading.Lock()
+        saved = [time.monotonic()]
+
+        def save(force=False):
+            with lock:
+                # saving after every small file would cost more than
+                # uploading it again after a crash
+                if not force and time.monotonic() - saved[0] < 1:
+                    return
+                tmp_path = state_path.with_suffix('.tmp')
+                tmp_path.write_text(dumps(state, sort_keys=True))
+                os.replace(str(tmp_path), str(state_path))
+                saved[0] = time.monotonic()
+
+        def put_file(entry):
+            with (build_dir / entry['path']).open('rb') as fp:
+                self.client.put_object(
+                    Bucket=self.bucket, Body=fp,
+                    Key=self.get_key(job, build, entry['path']))
+            with lock:
+                uploaded[entry['path']] = entry['sha256']
+            save()
+
+        def put_part(entry, upload_id, number):
+            with (build_dir / entry['path']).open('rb') as fp:
+                fp.seek((number - 1) * self.part_size)
+                body = fp.read(self.part_size)
+            response = self.client.upload_part(
+                Bucket=self.bucket, UploadId=upload_id, PartNumber=number,
+                Key=self.get_key(job, build, entry['path']), Body=body)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+
+        manifest = build_manifest(build_dir)
+        todo = [entry for entry in manifest
+                if uploaded.get(entry['path']) != entry['sha256']]
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            puts = []
+            multiparts = []
+            for entry in todo:
+                if entry['size'] <= self.part_size:
+                    puts.append((entry, pool.submit(put_file, entry)))
+                    continue
+                try:
+                    upload_id, parts = self._start_multipart(
+                        job, build, entry, uploads.get(entry['path']))
+                except Exception as e:
+                    errors.append((entry['path'], e))
+                    continue
+                with lock:
+                    uploads[entry['path']] = {'upload_id': upload_id,
+                                              'sha256': entry['sha256']}
+                save(force=True)
+                count = -(-entry['size'] // self.part_size)
+                futures = [pool.submit(put_part, entry, upload_id, number)
+                           for number in range(1, count + 1)
+                           if number not in parts]
+                multiparts.append((entry, upload_id, parts, futures))
+
+            for entry, future in puts:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append((entry['path'], e))
+            for entry, upload_id, parts, futures in multiparts:
+                try:
+                    for future in futures:
+                        part = future.result()
+                        parts[part['PartNumber']] = part['ETag']
+                    self.client.complete_multipart_upload(
+                        Bucket=self.bucket,
+                        Key=self.get_key(job, build, entry['path']),
+                        UploadId=upload_id,
+                        MultipartUpload={'Parts': [
+                            {'PartNumber': number, 'ETag': parts[number]}
+                            for number in sorted(parts)]})
+                except Exception as e:
+                    errors.append((entry['path'], e))
+                    continue
+                with lock:
+                    uploaded[entry['path']] = entry['sha256']
+                    del uploads[entry['path']]
+            save(force=True)
+            if errors:
+                raise OffloadError("Failed to upload {} file(s) of {}/{}: {}"
+                                   .format(len(errors), job, build,
+                                           errors[0][1]))
+
+            def check(entry):
+                try:
+                    head = self.client.head_object(
+                        Bucket=self.bucket,
+                        Key=self.get_key(job, build, entry['path']))
+                except Exception:
+                    return False
+                return head['ContentLength'] == entry['size']
+
+            confirmed = list(pool.map(check, manifest))
+        if not all(confirmed):
+            for entry, ok in zip(manifest, confirmed):
+                if not ok:
+                    uploaded.pop(entry['path'], None)
+            save(force=True)
+            raise OffloadError("S3 does not have all the files of {}/{}"
+                               .format(job, build))
+
+        self._state_path(job, build, 'done').write_text(
+            dumps({'files': len(manifest), 'confirmed': time.time()}))
+        state_path.unlink()
+
+    def _start_multipart(self, job, build, entry, upload=None):
+        """
+        Returns: the id of the multipart upload of a file and the parts S3
+        already has, resuming the recorded upload if S3 still knows about it
+        """
+        key = self.get_key(job, build, entry['path'])
+        if upload and upload['sha256'] == entry['sha256']:
+            try:
+                parts = {}
+                marker = 0
+                while True:
+                    response = self.client.list_parts(
+                        Bucket=self.bucket, Key=key,
+                        UploadId=upload['upload_id'],
+                        PartNumberMarker=marker)
+                    for part in response.get('Parts', []):
+                        parts[part['PartNumber']] = part['ETag']
+                    if not response.get('IsTruncated'):
+                        break
+                    marker = response['NextPartNumberMarker']
+                return upload['upload_id'], parts
+            except Exception as e:
+                logging.warning("Restarting the upload of {}: {}"
+                                .format(key, e))
+        response = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key)
+        return response['UploadId'], {}
+
+    def apply_retention(self, now=None):
+        """
+        Remove the local copies of builds confirmed in S3 more than
+        retention_days ago. The latest build of every job is kept, since
+        badges and the jobs index point at it. Where the artifacts of the
+        others went is recorded first, so their links keep working.
+
+        Returns: the (job, build) of the removed builds
+
+        """
+        if self.retention_days is None or self.retention_days < 0:
+            return []
+        deadline = (now or time.time()) - self.retention_days * 24 * 3600
+        removed = []
+        for job, build in self.builds():
+            try:
+                latest = os.readlink(str(self.root / job / LATEST_LINK))
+            except OSError:
+                latest = None
+            if latest == str(build):
+                continue
+            try:
+                confirmed = self._state_path(job, build, 'done').stat()
+            except FileNotFoundError:
+                continue
+            if confirmed.st_mtime <= deadline:
+                key = self.get_key(job, build, '')
+                write_offloaded(job, build, {
+                    'bucket': self.bucket,
+                    'key': key,
+                    'url': '{}/{}'.format(self.url, key) if self.url else '',
+                }, root=str(self.root))
+                rmtree(str(self.root / job / str(build)))
+                removed.append((job, build))
+        return removed
+
+
+def run(state_dir=OFFLOAD_DIR, poll_secs=30, max_backoff_secs=3600):
+    """
+    Offload builds until killed, reading the settings again on every pass
+    so that the configure-artifacts-offload action takes effect without a
+    restart. Builds that fail are retried with exponential backoff.
+    """
+    failures = {}
+    with (Path(state_dir) / '.offload.lock').open('w') as lock:
+        # Only one offloader at a time, even when run by hand
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        while True:
+            config = read_config(state_dir)
+            if config:
+                try:
+                    offloader = Offloader.from_config(config,
+                                                      state_dir=state_dir)
+                    offload_pending(offloader, failures, max_backoff_secs)
+                    for job, build in offloader.apply_retention():
+                        logging.info("Removed local artifacts of {}/{}"
+                                     .format(job, build))
+                except Exception:
+                    logging.exception("Failed to offload artifacts")
+            time.sleep(poll_secs)
+
+
+def offload_pending(offloader, failures, max_backoff_secs=3600):
+    for job, build in offloader.pending_builds():
+        attempts, retry_at = failures.get((job, build), (0, 0))
+        if retry_at > time.time():
+            continue
+        try:
+            offloader.offload_build(job, build)
+            logging.info("Offloaded {}/{}".format(job, build))
+        except Exception as e:
+            backoff = min(2 ** attempts * 60, max_backoff_secs)
+            failures[(job, build)] = (attempts + 1, time.time() + backoff)
+            logging.warning("Failed to offload {}/{} ({}); retrying in {}s"
+                            .format(job, build, e, backoff))
+            continue
+        failures.pop((job, build), None)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    run()
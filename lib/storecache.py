@@ -0,0 +1,121 @@
+from contextlib import contextmanager
+from json import dumps, loads
+from pathlib import Path
+from re import search
+import fcntl
+import hashlib
+import os
+import time
+
+
+STORE_CACHE_DIR = "/var/lib/jenkins/store-cache"
+DEFAULT_TTL = 300
+
+
+class StoreCache(object):
+    """
+    Charm store metadata shared by every job and action on the unit.
+
+    Channel to revision lookups expire after a TTL, as do files of entities
+    without a revision. Files of fully revisioned entities never change and
+    are kept for good. Entries are written atomically and fetched under a
+    per-entry lock, so parallel builds asking for the same entity only hit
+    the store once.
+
+    The cache is only used when its directory exists (the charm creates
+    it); otherwise every lookup goes straight to the store.
+    """
+
+    def __init__(self, path=STORE_CACHE_DIR, ttl=None):
+        self.path = Path(path)
+        if ttl is None:
+            try:
+                ttl = int((self.path / 'ttl').read_text())
+            except (OSError, ValueError):
+                ttl = DEFAULT_TTL
+        self.ttl = ttl
+
+    def get_revision(self, entity, channel, fetch, refresh=False):
+        """
+        Get the latest revision of an entity in a channel.
+
+        Args:
+            entity: the charm or bundle, without a revision
+            channel: the store channel
+            fetch: callable returning the revision from the store
+            refresh: ignore any cached value and store a fresh one
+
+        Returns: the latest revision
+
+        """
+        return self._get('revisions', [entity, channel], fetch,
+                         ttl=self.ttl, refresh=refresh)
+
+    def get_file(self, entity, filename, fetch):
+        """
+        Get the contents of a file of an entity.
+
+        Args:
+            entity: the charm or bundle
+            filename: path of the file within the entity
+            fetch: callable returning the file contents from the store
+
+        Returns: the file contents
+
+        """
+        ttl = None if search(r'-\d+$', entity) else self.ttl
+        return self._get('files', [entity, filename], fetch, ttl=ttl)
+
+    def _get(self, kind, key, fetch, ttl=None, refresh=False):
+        if not self.path.is_dir():
+            return fetch()
+        digest = hashlib.sha1(dumps(key).encode('utf-8')).hexdigest()
+        entry_path = self.path / kind / '{}.json'.format(digest)
+
+        if not refresh:
+            value = self._read(entry_path, ttl)
+            if value is not None:
+                return value
+        try:
+            with self._locked(entry_path):
+                if not refresh:
+                    # someone may have fetched it while we waited
+                    value = self._read(entry_path, ttl)
+                    if value is not None:
+                        return value
+                value = fetch()
+                self._write(entry_path, key, value)
+                return value
+        except PermissionError:
+            return fetch()
+
+    def _read(self, entry_path, ttl):
+        try:
+            entry = loads(entry_path.read_text())
+        except (OSError, ValueError):
+            return None
+        if ttl is not None and time.time() - entry['fetched'] > ttl:
+            return None
+        return entry['value']
+
+    def _write(self, entry_path, key, value):
+        tmp_path = entry_path.with_name(
+            '.{}.{}'.format(entry_path.name, os.getpid()))
+        tmp_path.write_text(dumps({
+            'key': key,
+            'value': value,
+            'fetched': time.time(),
+        }))
+        os.replace(str(tmp_path), str(entry_path))
+
+    @contextmanager
+    def _locked(self, entry_path):
+        entry_path.parent.mkdir(exist_ok=True)
+        # read-only so that users who did not create the lock can take it
+        fd = os.open(str(entry_path.with_suffix('.lock')),
+                     os.O_RDONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
@@ -1,12 +1,17 @@
 import re
 import time
 import base64
+import fcntl
+import hmac
 import os
+import threading
+import requests
 import yaml
 import uuid
 from charmhelpers.core import hookenv
 from charms.reactive import is_state
 from os import listdir
+from urllib.parse import quote
 
 
 TRIGGER_PERIODICALLY = '''
@@ -20,6 +25,9 @@ REFSPEC = "<refspec>+refs/tags/*:refs/remotes/origin/tags/*</refspec>"
 
 HOOK_TOKENS_LIST_FILE = "/var/lib/jenkins/tokens.yaml"
 CONTROLLERS_LIST_FILE = "/var/lib/jenkins/controller.names"
+CIGW_PROPERTIES_FILE = "/var/lib/jenkins/CIGWServer.properties"
+WEBHOOK_QUEUE_DIR = "/var/lib/cwr-server/webhooks"
+METRICS_DIR = "/var/lib/cwr-server/metrics"
 REST_PORT = 5000
 REST_PREFIX = "ci"
 REST_VER = "v1.0"
@@ -46,33 +54,67 @@ def trigger_jenkins_job(jclient, job, attempts=5):
     jclient.build_job(job, params)
 
 
-def get_hook_token(job_name):
-    tokens = {}
-    try:
-        with open(HOOK_TOKENS_LIST_FILE, "r+") as fp:
-            tokens = yaml.load(fp)
-    except IOError:
-        print("Tokens file will be created")
+class HookTokens:
+    """
+    In-memory index of the webhook tokens kept in HOOK_TOKENS_LIST_FILE.
+
+    The file is only parsed again when it changes on disk. New tokens are
+    written under an exclusive lock and atomically replace the file, so
+    jobs created concurrently do not lose each other's tokens.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tokens = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._tokens, self._stamp = {}, None
+            return
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stamp != self._stamp:
+            with open(self.path, "r") as fp:
+                self._tokens = yaml.safe_load(fp) or {}
+            self._stamp = stamp
+
+    def get(self, job_name):
+        with self._lock:
+            self._reload()
+            return self._tokens.get(job_name)
+
+    def add(self, job_name):
+        """Return the token of job_name, creating one if needed."""
+        with self._lock, open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._reload()
+            if job_name not in self._tokens:
+                tokens = dict(self._tokens)
+                tokens[job_name] = str(uuid.uuid4())
+                tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+                with open(tmp_path, "w") as fp:
+                    yaml.dump(tokens, fp)
+                os.replace(tmp_path, self.path)
+                self._reload()
+            return self._tokens[job_name]
+
+
+hook_tokens = HookTokens(HOOK_TOKENS_LIST_FILE)
 
-    if job_name not in tokens:
-        tokens[job_name] = str(uuid.uuid4())
-        with open(HOOK_TOKENS_LIST_FILE, "w") as fp:
-            yaml.dump(tokens, fp)
 
-    return tokens[job_name]
+def get_hook_token(job_name):
+    return hook_tokens.add(job_name)
 
 
 def validate_hook_token(job_name, token):
-    tokens = {}
-    try:
-        with open(HOOK_TOKENS_LIST_FILE, "r") as fp:
-            tokens = yaml.load(fp)
-    except IOError:
-        print("Tokens file not created yet")
-
-    if job_name not in tokens:
+    expected = hook_tokens.get(job_name)
+    if expected is None or token is None:
         return False
-    return tokens[job_name] == token
+    return hmac.compare_digest(expected.encode('utf-8'),
+                               token.encode('utf-8'))
 
 
 def get_charmstore_token(decode=True):
@@ -169,3 +211,21 @@ def report_status():
         msg = ('Ready (controllers: {}; store: unauthenticated).'
                .format(controllers))
     hookenv.status_set('active', msg)
+
+
+def get_progressive_console(jclient, job_name, build_id, start=0):
+    """
+    Fetch the console output of a build from a byte offset on, using the
+    Jenkins progressive-text API.
+
+    Returns: a tuple of the new text, the offset to continue from and
+    whether Jenkins may still append to the console.
+    """
+    url = "{}job/{}/{}/logText/progressiveText".format(
+        jclient.server, quote(job_name), build_id)
+    response = jclient.jenkins_request(
+        requests.Request('GET', url, params={'start': start}),
+        add_crumb=False)
+    next_start = int(response.headers.get('X-Text-Size', start))
+    more = response.headers.get('X-More-Data') == 'true'
+    return response.text, next_start, more
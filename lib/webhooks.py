@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from json import dumps, loads
+from pathlib import Path
+from uuid import uuid4
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from jenkins import NotFoundException
+
+
+class WebhookQueue:
+    """
+    Persistent spool of webhook events waiting to be sent to Jenkins.
+
+    Every event is a small JSON file in the queue directory, written
+    atomically so a crash never leaves a half written event behind. File
+    names sort in arrival order.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.wakeup = threading.Event()
+
+    def put(self, job, params=None):
+        """
+        Queue a build of job with the given parameters.
+
+        Returns: the id of the queued event
+
+        """
+        event_id = '{:019d}-{}'.format(int(time.time() * 1000000),
+                                       uuid4().hex)
+        event = {'job': job, 'params': params or {}, 'received': time.time()}
+        tmp_path = self.path / '.{}.tmp'.format(event_id)
+        with tmp_path.open('w') as fp:
+            fp.write(dumps(event))
+            fp.flush()
+            os.fsync(fp.fileno())
+        tmp_path.rename(self.path / '{}.json'.format(event_id))
+        self.wakeup.set()
+        return event_id
+
+    def pending(self):
+        """
+        Returns: the paths of the queued events, oldest first
+
+        """
+        return sorted(self.path.glob('*.json'))
+
+
+class WebhookDispatcher(threading.Thread):
+    """
+    Background thread draining a WebhookQueue into Jenkins.
+
+    Identical events queued while Jenkins was busy are sent as a single
+    build, and events Jenkins fails to accept are retried with exponential
+    backoff. Only one dispatcher per queue is active at a time, even when
+    the gateway runs several worker processes.
+    """
+
+    def __init__(self, queue, get_jenkins_client,
+                 poll_secs=1, max_backoff_secs=300):
+        super().__init__(name='webhook-dispatcher', daemon=True)
+        self.queue = queue
+        self.get_jenkins_client = get_jenkins_client
+        self.poll_secs = poll_secs
+        self.max_backoff_secs = max_backoff_secs
+        self._failures = {}
+
+    def run(self):
+        self.queue.path.mkdir(parents=True, exist_ok=True)
+        with (self.queue.path / '.dispatcher.lock').open('w') as lock:
+            # Blocks until no other process is dispatching this queue
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            while True:
+                self.queue.wakeup.wait(self.poll_secs)
+                self.queue.wakeup.clear()
+                try:
+                    self.drain()
+                except Exception:
+                    logging.exception("Failed to dispatch webhook events")
+
+    def drain(self):
+        """
+        Send every queued event to Jenkins once, skipping builds that are
+        still backing off after a failure.
+        """
+        batches = OrderedDict()
+        for path in self.queue.pending():
+            try:
+                event = loads(path.read_text())
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                logging.error("Dropping malformed webhook event {}"
+                              .format(path))
+                path.unlink()
+                continue
+            key = (event['job'], dumps(event['params'], sort_keys=True))
+            batches.setdefault(key, []).append(path)
+
+        if not batches:
+            return
+        jclient = self.get_jenkins_client()
+        for key, paths in batches.items():
+            job, params = key
+            attempts, retry_at = self._failures.get(key, (0, 0))
+            if retry_at > time.time():
+                continue
+            try:
+                jclient.build_job(job, loads(params) or None)
+                logging.info("Triggered {} for {} webhook event(s)"
+                             .format(job, len(paths)))
+            except NotFoundException:
+                logging.error("Dropping webhook event(s) for missing job {}"
+                              .format(job))
+            except Exception as e:
+                backoff = min(2 ** attempts, self.max_backoff_secs)
+                self._failures[key] = (attempts + 1, time.time() + backoff)
+                logging.warning("Failed to trigger {} ({}); retrying in {}s"
+                                .format(job, e, backoff))
+                continue
+            self._failures.pop(key, None)
+            for path in paths:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
@@ -14,11 +14,12 @@ from utils import (
     get_charmstore_token,
     report_status
 )
-from charmhelpers.core import host, hookenv, unitdata
+from charmhelpers.core import host, hookenv, templating, unitdata
 from charms.reactive import (
     hook,
     when,
     when_not,
+    when_any,
     set_state,
     remove_state,
     is_state,
@@ -27,7 +28,17 @@ from charms.reactive import (
 )
 from jujubigdata import utils
 from jenkins import Jenkins
+from jenkinsjobs import reconcile_jobs, recorded_jobs
 from CIGateway import CIGateway
+from containerpool import POOL_DIR
+from offload import OFFLOAD_DIR
+from storecache import STORE_CACHE_DIR
+
+JENKINS_PLUGINS_DIR = "/var/lib/jenkins/plugins"
+# Update center statuses of plugin installations that are complete
+PLUGIN_INSTALLED_STATUSES = ('Success', 'SuccessButRequiresRestart',
+                             'Skipped')
+CWR_PARALLEL_FILE = "/var/lib/jenkins/cwr_parallel"
 
 
 @when('config.changed.subnet')
@@ -210,35 +221,104 @@ def setup_ci_env():
     report_status()
 
 
+@when('config.changed.store_cache_ttl')
+def reconfigure_store_cache():
+    remove_state('store-cache.configured')
+    remove_state('config.changed.store_cache_ttl')
+
+
+@when('juju-ci-env.installed')
+@when_not('store-cache.configured')
+def configure_store_cache():
+    # shared by the jobs (jenkins) and the actions (root)
+    host.mkdir(STORE_CACHE_DIR, owner='jenkins', group='jenkins', perms=0o755)
+    ttl = hookenv.config().get('store_cache_ttl')
+    host.write_file(os.path.join(STORE_CACHE_DIR, 'ttl'), str(ttl).encode(),
+                    owner='jenkins', group='jenkins', perms=0o644)
+    set_state('store-cache.configured')
+
+
+@when('config.changed.parallel_controllers')
+def reconfigure_parallel_controllers():
+    remove_state('cwr-parallel.configured')
+    remove_state('config.changed.parallel_controllers')
+
+
+@when('juju-ci-env.installed')
+@when_not('cwr-parallel.configured')
+def configure_parallel_controllers():
+    # read by run_cwr_in_container in cwr-helpers.sh
+    parallel = hookenv.config().get('parallel_controllers')
+    host.write_file(CWR_PARALLEL_FILE, str(bool(parallel)).lower().encode(),
+                    owner='jenkins', group='jenkins', perms=0o644)
+    set_state('cwr-parallel.configured')
+
+
+@when('juju-ci-env.installed')
+@when_not('artifacts-offload.started')
+def start_artifacts_offload():
+    # The service idles until the configure-artifacts-offload action is run
+    host.mkdir(OFFLOAD_DIR, owner='jenkins', group='jenkins', perms=0o700)
+    templating.render(
+        source="cwr-offload.service",
+        target="/etc/systemd/system/cwr-offload.service",
+        context={'charm_dir': hookenv.charm_dir()})
+    if host.init_is_systemd():
+        run(['systemctl', 'daemon-reload'], check=True)
+    host.service_resume('cwr-offload')
+    host.service_restart('cwr-offload')
+    set_state('artifacts-offload.started')
+
+
+@when('config.changed.container_pool_size')
+def reconfigure_container_pool():
+    remove_state('container-pool.configured')
+    remove_state('config.changed.container_pool_size')
+
+
+@when('juju-ci-env.installed')
+@when_not('container-pool.configured')
+def configure_container_pool():
+    # read by the cwr-container-pool service on every pass
+    host.mkdir(POOL_DIR, owner='jenkins', group='jenkins', perms=0o755)
+    size = hookenv.config().get('container_pool_size')
+    host.write_file(os.path.join(POOL_DIR, 'size'), str(size).encode(),
+                    owner='jenkins', group='jenkins', perms=0o644)
+    set_state('container-pool.configured')
+
+
+@when('cwrbox.imported', 'container-pool.configured')
+@when_not('container-pool.started')
+def start_container_pool():
+    templating.render(
+        source="cwr-container-pool.service",
+        target="/etc/systemd/system/cwr-container-pool.service",
+        context={'charm_dir': hookenv.charm_dir()})
+    if host.init_is_systemd():
+        run(['systemctl', 'daemon-reload'], check=True)
+    host.service_resume('cwr-container-pool')
+    host.service_restart('cwr-container-pool')
+    set_state('container-pool.started')
+
+
 @when('jenkins.available', 'juju-ci-env.installed')
 @when_not('jenkins.jobs.ready', 'jenkins.jobs.failed')
 def install_jenkins_jobs(connected_jenkins):
-    hookenv.status_set('maintenance', 'Uploading jenkins jobs.')
     jenkins_connection_info = connected_jenkins.get_connection_info()
     jclient = Jenkins(jenkins_connection_info["jenkins_url"],
                       jenkins_connection_info["admin_username"],
                       jenkins_connection_info["admin_password"])
 
-    for dirname, dirnames, _ in os.walk('jobs'):
-        for subdirname in dirnames:
-            if jclient.job_exists(subdirname):
-                jclient.delete_job(subdirname)
-            jobfilename = os.path.join(dirname, subdirname, "config.xml")
-            with open(jobfilename, 'r') as jobfile:
-                configxml = jobfile.read()
-                jclient.create_job(subdirname, configxml)
-
     plugins = ["github", "ghprb", "postbuildscript", "scripttrigger"]
-    for plugin in plugins:
-        hookenv.status_set('maintenance', 'Installing plugin {}.'
-                           .format(plugin))
-        reboot = jclient.install_plugin(plugin)
-        hookenv.log("Installing plugin {}. Restart required: {}"
-                    .format(plugin, reboot))
-        installed = wait_for_plugin(plugin)
-        if not installed:
+    installed = get_installed_plugins()
+    missing = [plugin for plugin in plugins if plugin not in installed]
+    if missing:
+        hookenv.status_set('maintenance', 'Installing plugins {}.'
+                           .format(", ".join(missing)))
+        install_plugins(jclient, missing)
+        if not wait_for_plugins(jclient, missing):
             hookenv.log("installation of {} did not complete on time."
-                        .format(plugin))
+                        .format(", ".join(missing)))
             # Retrying does not play well here.
             # I have seen a case where Jenkins mistakenly reports that
             # the plugin is installed causing an infinite retry loop :(
@@ -246,9 +326,16 @@ def install_jenkins_jobs(connected_jenkins):
             set_state("jenkins.jobs.failed")
             return
 
-    # Give some slack for syncing the plugins.
-    time.sleep(15)
-    host.service_restart("jenkins")
+        reboot = is_restart_required(jclient)
+        hookenv.log("Installed plugins {}. Restart required: {}"
+                    .format(", ".join(missing), reboot))
+        if reboot:
+            host.service_restart("jenkins")
+            jclient.wait_for_normal_op(300)
+
+    # The jobs use the plugins, so they are loaded once the plugins are
+    hookenv.status_set('maintenance', 'Uploading jenkins jobs.')
+    update_jenkins_jobs(jclient, get_static_jobs())
 
     CIGateway.start(jenkins_connection_info["jenkins_url"],
                     jenkins_connection_info["admin_username"],
@@ -287,6 +374,24 @@ def cleanup_jenkins():
     report_status()
 
 
+@when('jenkins.available', 'jenkins.jobs.ready', 'jenkins.jobs.outdated')
+def rerender_jenkins_jobs(jenkins):
+    '''
+    Bring the jobs in line with the templates of an upgraded charm, keeping
+    their build history.
+    '''
+    hookenv.status_set('maintenance', 'Updating jenkins jobs.')
+    jenkins_connection_info = jenkins.get_connection_info()
+    jclient = Jenkins(jenkins_connection_info["jenkins_url"],
+                      jenkins_connection_info["admin_username"],
+                      jenkins_connection_info["admin_password"])
+    jobs = get_static_jobs()
+    jobs.update((job.name, job.render()) for job in recorded_jobs())
+    update_jenkins_jobs(jclient, jobs)
+    remove_state('jenkins.jobs.outdated')
+    report_status()
+
+
 @when('ci-client.joined')
 def client_joined(client):
     inform_client(client)
@@ -313,6 +418,20 @@ def ci_connection_updated(jenkins, jenkins_changed):
     report_status()
 
 
+@when('jenkins.available', 'jenkins.jobs.ready')
+@when_any('config.changed.gateway_workers',
+          'config.changed.gateway_threads',
+          'config.changed.gateway_max_requests')
+def gateway_config_changed(jenkins):
+    hookenv.status_set('maintenance', 'Configuring CI gateway.')
+    if CIGateway.render_service():
+        CIGateway.restart()
+    else:
+        # gunicorn picks up the new settings without dropping requests
+        CIGateway.reload()
+    report_status()
+
+
 @when_file_changed(CONTROLLERS_LIST_FILE)
 def controllers_updated():
     hookenv.log("Controllers file has changed")
@@ -331,8 +450,50 @@ def jenkins_available(jenkins):
 @hook('upgrade-charm')
 def restart_ciserver():
     remove_state("cwrbox.imported")
+    # pick up the new code and unit file
+    remove_state("artifacts-offload.started")
+    remove_state("container-pool.started")
+    # the job templates may have changed with the charm
+    set_state("jenkins.jobs.outdated")
     if is_state("jenkins.jobs.ready"):
-        CIGateway.restart()
+        # the unit file may have changed with the charm; if not, a reload
+        # gracefully replaces the workers running the old code
+        if CIGateway.render_service():
+            CIGateway.restart()
+        else:
+            CIGateway.reload()
+
+
+def get_static_jobs():
+    '''
+    Returns: a dict of the names of the jobs shipped with the charm to their
+    config.xml
+    '''
+    jobs = {}
+    for dirname, dirnames, _ in os.walk('jobs'):
+        for subdirname in dirnames:
+            jobfilename = os.path.join(dirname, subdirname, "config.xml")
+            with open(jobfilename, 'r') as jobfile:
+                jobs[subdirname] = jobfile.read()
+    return jobs
+
+
+def update_jenkins_jobs(jclient, jobs):
+    '''
+    Create the missing jobs and reconfigure the ones that changed. Raises
+    the first error after all jobs were handled, so that the hook is retried.
+    '''
+    results = reconcile_jobs(jclient, jobs)
+    errors = []
+    for name, result in sorted(results.items()):
+        if isinstance(result, Exception):
+            hookenv.log("Failed to update job {}: {}".format(name, result),
+                        hookenv.ERROR)
+            errors.append(result)
+        else:
+            hookenv.log("Job {}: {}".format(name, result))
+    if errors:
+        raise errors[0]
 
 
 def inform_client(client):
@@ -348,23 +509,113 @@ def inform_client(client):
         client.set_ready()
 
 
-def wait_for_plugin(plugin, wait_for_secs=300):
+def get_installed_plugins():
+    '''
+    Returns: the short names of the plugins in the Jenkins plugins directory
+    '''
+    names = set()
+    for filename in os.listdir(JENKINS_PLUGINS_DIR):
+        name, ext = os.path.splitext(filename)
+        if ext in (".hpi", ".jpi"):
+            names.add(name)
+    return names
+
+
+def install_plugins(jclient, plugins):
+    '''
+    Ask Jenkins to install plugins and their dependencies in one go. Plugins
+    are loaded without a restart when they support it; the installation
+    goes on in the background.
+    Args:
+        jclient: the Jenkins client
+        plugins: the short names of the plugins to install
+
+    '''
+    # Jenkins has no REST endpoint for installing plugins
+    script = (
+        "def uc = Jenkins.instance.updateCenter\n"
+        "[{}].each {{ name ->\n"
+        "    def plugin = uc.getPlugin(name)\n"
+        "    plugin.getNeededDependencies().each {{ it.deploy(true) }}\n"
+        "    plugin.deploy(true)\n"
+        "}}\n").format(", ".join('"{}"'.format(p) for p in plugins))
+    jclient.run_script(script)
+
+
+def is_restart_required(jclient):
+    '''
+    Returns: True if Jenkins needs a restart to complete the installation of
+    plugins, or if it cannot tell
+    '''
+    response = jclient.run_script(
+        "println(Jenkins.instance.updateCenter"
+        ".isRestartRequiredForCompletion())")
+    answer = response.strip().lower() if response else ''
+    if answer not in ('true', 'false'):
+        hookenv.log("Unexpected answer when asking Jenkins whether it needs "
+                    "a restart: {}".format(response), hookenv.WARNING)
+        return True
+    return answer == 'true'
+
+
+def get_plugin_installations(jclient):
+    '''
+    Returns: the status of the latest installation job of every plugin the
+    update center installed or is installing, by plugin short name; e.g.
+    Pending, Installing, Success, SuccessButRequiresRestart or Failure
+    '''
+    response = jclient.run_script(
+        "import hudson.model.UpdateCenter\n"
+        "Jenkins.instance.updateCenter.jobs.findAll {\n"
+        "    it instanceof UpdateCenter.InstallationJob\n"
+        "}.sort { it.id }.each {\n"
+        "    println \"${it.plugin.name} ${it.status.class.simpleName}\"\n"
+        "}\n")
+    statuses = {}
+    for line in (response or '').splitlines():
+        fields = line.split()
+        # anything else is Groovy complaining, not a status
+        if len(fields) == 2 and fields[1].isidentifier():
+            statuses[fields[0]] = fields[1]
+    return statuses
+
+
+def wait_for_plugins(jclient, plugins, wait_for_secs=300, poll_secs=1):
     '''
-    Waits for 5 minutes to see if the plugin is available.
+    Waits for 5 minutes for the update center to finish installing plugins.
+    A plugin's file shows up in the plugins directory before Jenkins is
+    done loading it, so it is the installation jobs that are looked at;
+    only once they are all done can Jenkins tell whether it needs a
+    restart.
     Args:
-        plugin: the plugin to look for
-        wait_for_secs: how long should we wait for the plugin to appear
+        jclient: the Jenkins client
+        plugins: the plugins that were asked for
+        wait_for_secs: how long should we wait for the plugins to install
+        poll_secs: how often to ask Jenkins
 
-    Returns: True if the plugin got deployed
+    Returns: True if the plugins got installed
 
     '''
     timeout = time.time() + wait_for_secs
     while True:
+        try:
+            statuses = get_plugin_installations(jclient)
+        except Exception as e:
+            hookenv.log("Failed to get the plugin installations: {}"
+                        .format(e), hookenv.WARNING)
+            statuses = None
+        # the update center queues the jobs of the plugins asked for
+        # asynchronously, so wait for all of them to show up
+        if statuses and set(statuses).issuperset(plugins):
+            failed = [name for name, status in statuses.items()
+                      if status == 'Failure']
+            if failed:
+                hookenv.log("Failed to install plugins {}"
+                            .format(", ".join(sorted(failed))), hookenv.ERROR)
+                return False
+            if all(status in PLUGIN_INSTALLED_STATUSES
+                   for status in statuses.values()):
+                return True
         if time.time() > timeout:
             return False
-        all_plugins = os.listdir("/var/lib/jenkins/plugins")
-        if "{}.hpi".format(plugin) in all_plugins:
-            return True
-        if "{}.jpi".format(plugin) in all_plugins:
-            return True
-        time.sleep(15)
+        time.sleep(poll_secs)
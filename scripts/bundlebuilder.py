@@ -2,44 +2,193 @@
 
 import argparse
 import sys
+from codecs import getincrementaldecoder
+from collections import deque
 import os
 import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from fcntl import flock, LOCK_EX
 from tempfile import mkdtemp
-from time import sleep
+from threading import Lock
+from time import monotonic, sleep, time
+from selectors import DefaultSelector, EVENT_READ
+from signal import SIGKILL
 from subprocess import Popen, PIPE, STDOUT
 from shutil import rmtree, copytree
 from yaml import safe_load, dump
 from re import search
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from artifacts import update_latest_build  # noqa: E402
+from storecache import StoreCache  # noqa: E402
 
+store_cache = StoreCache()
 
-def execute(cmd, raise_exception=True):
+# Bare mirrors of the bundle repositories, shared by all the jobs
+GIT_MIRROR_DIR = "/var/lib/jenkins/git-mirrors"
+
+# Where the digest of the last bundle built was kept before the signature
+# history, see SignatureHistory.seed_legacy
+LEGACY_SIGNATURE_FILE = "last_bundle.signature"
+
+# Characters of command output kept in memory
+MAX_OUTPUT = 1024 * 1024
+# Limits for commands talking to the charm store or git remotes
+NETWORK_TIMEOUTS = dict(timeout=30 * 60, idle_timeout=10 * 60)
+
+
+def execute(cmd, raise_exception=True, echo=True, timeout=None,
+            idle_timeout=None, log_file=None, max_output=MAX_OUTPUT):
     """
     Execute bash script printing the stdout and stderr without delay.
 
+    Output is read in chunks as it comes. Only the last max_output
+    characters are returned; the whole of it can be kept in log_file.
+
     Args:
         cmd: a list with the command
         raise_exception: If True, will raise an exception upon a failing script
+        echo: If False, only capture the output; used for commands run
+              concurrently so that their output does not interleave
+        timeout: seconds after which the command is killed
+        idle_timeout: seconds without output after which the command is
+                      killed
+        log_file: file to append the full output to; defaults to the file
+                  named by the BUNDLEBUILDER_LOG environment variable
+        max_output: how many characters of output to return at most
 
     Returns: a tuple of return_code, output
 
     """
-    print("Running {}".format(" ".join(cmd)))
-    output = ""
-    with Popen(cmd, stdout=PIPE, stderr=STDOUT, bufsize=1, universal_newlines=True) as p:
-        for line in p.stdout:
-            output += line
-            print(line, end='')
-
-        # Wait until process terminates
-        while p.poll() is None:
-            sleep(1)
-
-        if raise_exception and p.returncode != 0:
-            raise Exception("Command {} failed with {}".format(" ".join(cmd), p.returncode))
-        else:
-            return p.returncode, output
+    if echo:
+        print("Running {}".format(" ".join(cmd)), flush=True)
+    log_file = log_file or os.environ.get('BUNDLEBUILDER_LOG')
+    output = OutputBuffer(max_output)
+    decoder = getincrementaldecoder('utf-8')(errors='replace')
+    timed_out = None
+    start = monotonic()
+    # In a session of its own, so that a timeout kills all its children
+    with Popen(cmd, stdout=PIPE, stderr=STDOUT, start_new_session=True) as p, \
+            DefaultSelector() as selector, \
+            open(log_file or os.devnull, 'a') as log:
+        selector.register(p.stdout, EVENT_READ)
+        last_output = start
+        while True:
+            now = monotonic()
+            if timeout and now - start >= timeout:
+                timed_out = "{} seconds".format(timeout)
+            elif idle_timeout and now - last_output >= idle_timeout:
+                timed_out = "{} seconds without output".format(idle_timeout)
+            if timed_out:
+                os.killpg(p.pid, SIGKILL)
+                break
+            deadlines = []
+            if timeout:
+                deadlines.append(start + timeout)
+            if idle_timeout:
+                deadlines.append(last_output + idle_timeout)
+            wait = min(deadlines) - now if deadlines else None
+            if not selector.select(wait):
+                continue
+            chunk = os.read(p.stdout.fileno(), 64 * 1024)
+            last_output = monotonic()
+            text = decoder.decode(chunk, final=not chunk)
+            output.append(text)
+            log.write(text)
+            if echo:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            if not chunk:
+                break
+        p.wait()
+
+    if timed_out:
+        message = "Command {} timed out after {}".format(" ".join(cmd),
+                                                         timed_out)
+        if raise_exception:
+            raise CommandTimeout(message)
+        output.append("\n{}\n".format(message))
+    elif raise_exception and p.returncode != 0:
+        raise CommandFailed(cmd, p.returncode, output.getvalue())
+    return p.returncode, output.getvalue()
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class CommandFailed(Exception):
+    """
+    A command exited with an error. Keeps what the command printed, so the
+    error can be reported even when the output was not echoed.
+    """
+
+    def __init__(self, cmd, returncode, output):
+        super().__init__("Command {} failed with {}".format(" ".join(cmd),
+                                                            returncode))
+        self.returncode = returncode
+        self.output = output
+
+    def tail(self, lines=10):
+        """
+        Returns: the last lines of output of the command
+
+        """
+        return "\n".join(self.output.rstrip().splitlines()[-lines:])
+
+
+class OutputBuffer(object):
+    """
+    Keep the last max_size characters written to it.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.chunks = deque()
+        self.size = 0
+
+    def append(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        while self.size > self.max_size:
+            excess = self.size - self.max_size
+            first = self.chunks[0]
+            if len(first) <= excess:
+                self.chunks.popleft()
+                self.size -= len(first)
+            else:
+                self.chunks[0] = first[excess:]
+                self.size -= excess
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+def retry(func, attempts=5, backoff=2, max_delay=60):
+    """
+    Call func until it succeeds, sleeping exponentially longer in between.
+
+    Args:
+        func: the callable to call
+        attempts: how many times to try
+        backoff: seconds to sleep after the first failure; doubled after
+                 each failure, up to max_delay
+
+    Returns: what func returns
+
+    """
+    delay = backoff
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            print("Attempt {} failed: {}. Retrying in {}s".format(
+                attempt, e, delay))
+            sleep(delay)
+            delay = min(delay * 2, max_delay)
 
 
 class Fetcher(object):
@@ -77,24 +226,198 @@ class Fetcher(object):
         """
         tempdir = mkdtemp()
         destination = "{}/bundle".format(tempdir)
-        copytree(path, destination)
+        try:
+            copytree(path, destination)
+        except BaseException:
+            rmtree(tempdir)
+            raise
         return destination
 
     @staticmethod
     def fetch_git(repo, branch):
         """
-        Clone the repository of the bundle
+        Check out the branch of the repository with the bundle.
+
+        The repository is kept in a local bare mirror that only needs an
+        incremental fetch on later calls. The checkout shares the objects of
+        the mirror, so it is quick and uses little disk. Without a usable
+        mirror directory we fall back to a full clone.
+
         Args:
             repo: the git repo repo with the bundle
-            branch: the branch with the bundle
+            branch: the branch with the bundle; the default branch of the
+                    repo if None
 
         Returns: the temp directory containing the bundle
 
         """
         tempdir = mkdtemp()
         destination = "{}/bundle".format(tempdir)
-        execute(["git", "clone", repo, "--branch", branch, "--single-branch", destination])
-        return destination
+        # Without a branch, clones check out the HEAD of their source
+        branch_args = ["--branch", branch] if branch else []
+        try:
+            mirror = Fetcher.update_mirror(repo, branch)
+            if mirror is None:
+                execute(["git", "clone", repo, "--single-branch"] +
+                        branch_args + [destination],
+                        **NETWORK_TIMEOUTS)
+                return destination
+            with open("{}.lock".format(mirror), 'w') as lock:
+                flock(lock, LOCK_EX)
+                execute(["git", "clone", "--shared", "--single-branch"] +
+                        branch_args + [mirror, destination])
+            return destination
+        except BaseException:
+            rmtree(tempdir)
+            raise
+
+    @staticmethod
+    def update_mirror(repo, branch):
+        """
+        Create or update the bare mirror of a repository.
+
+        Args:
+            repo: the git repo
+            branch: the branch to fetch; all of them if None
+
+        Returns: the path to the mirror, or None if mirrors are not
+                 available here
+
+        """
+        if not os.path.isdir(os.path.dirname(GIT_MIRROR_DIR)):
+            # not on a CI unit
+            return None
+        try:
+            os.makedirs(GIT_MIRROR_DIR, exist_ok=True)
+        except OSError:
+            return None
+
+        mirror = os.path.join(
+            GIT_MIRROR_DIR,
+            "{}.git".format(hashlib.sha1(repo.encode('utf-8')).hexdigest()))
+        with open("{}.lock".format(mirror), 'w') as lock:
+            # Keep other jobs from updating the mirror under our feet
+            flock(lock, LOCK_EX)
+            if not os.path.isdir(mirror):
+                execute(["git", "clone", "--mirror", repo, mirror],
+                        **NETWORK_TIMEOUTS)
+            elif branch:
+                execute(["git", "--git-dir", mirror, "fetch", "--prune",
+                         "origin",
+                         "+refs/heads/{0}:refs/heads/{0}".format(branch)],
+                        **NETWORK_TIMEOUTS)
+            else:
+                # the refspecs of the mirror update every branch, including
+                # the one its HEAD points at
+                execute(["git", "--git-dir", mirror, "fetch", "--prune",
+                         "origin"],
+                        **NETWORK_TIMEOUTS)
+        return mirror
+
+    @staticmethod
+    def cleanup(destination):
+        """
+        Remove a bundle fetched with fetch() and its temp directory.
+
+        Args:
+            destination: the directory returned by fetch()
+
+        """
+        rmtree(os.path.dirname(destination.rstrip('/')))
+
+
+def normalize_charm_url(url):
+    """
+    Args:
+        url: a charm URL as found in a bundle
+
+    Returns: the URL with its schema, so that 'ubuntu-1' and 'cs:ubuntu-1'
+             compare equal
+
+    """
+    url = url.strip()
+    if ':' not in url and not url.startswith(('/', '.')):
+        url = "cs:{}".format(url)
+    return url
+
+
+class SignatureHistory(object):
+    """
+    The signatures of the bundles we triggered builds for, and the outcome
+    of testing them, kept in a JSON file. Updates are made under a lock and
+    replace the file atomically, so the checker and the build can both
+    record entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, signature):
+        """
+        Returns: the entry recorded for the signature, or None
+
+        """
+        return self._read().get(signature)
+
+    def add(self, signature, outcome, **info):
+        """
+        Record a signature. A signature already recorded as triggered only
+        gets its outcome updated.
+
+        Args:
+            signature: the bundle signature
+            outcome: 'triggered', 'pass' or 'fail'
+            info: more details to keep with the entry
+
+        Returns: True if the signature was not recorded before
+
+        """
+        with open("{}.lock".format(self.path), 'w') as lock:
+            flock(lock, LOCK_EX)
+            history = self._read()
+            new = signature not in history
+            if not new and outcome == 'triggered':
+                return False
+            entry = history.setdefault(signature, {})
+            entry.update(info, outcome=outcome, updated=int(time()))
+            tmp_path = "{}.{}".format(self.path, os.getpid())
+            with open(tmp_path, 'w') as fp:
+                json.dump(history, fp, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+            return new
+
+    def seed_legacy(self, legacy_path, signature, legacy_digest):
+        """
+        Carry over the digest kept by earlier versions, which only
+        remembered the last bundle a build was triggered for, as a sha1 of
+        its YAML dump. The file is removed once read.
+
+        Args:
+            legacy_path: the file with the old digest
+            signature: the signature of the current bundle
+            legacy_digest: callable returning the old-style digest of the
+                           current bundle
+
+        Returns: True if the current bundle was the last one built
+
+        """
+        try:
+            with open(legacy_path) as fp:
+                last_digest = fp.read().strip()
+        except OSError:
+            return False
+        built = last_digest == legacy_digest()
+        if built:
+            self.add(signature, 'triggered', migrated=True)
+        os.remove(legacy_path)
+        return built
+
+    def _read(self):
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
 
 
 class Bundle(object):
@@ -106,7 +429,10 @@ class Bundle(object):
                  ci_info_file=None,
                  CWR_dry_run=False,
                  store_push_dry_run=False,
-                 fake_output=""):
+                 fake_output="",
+                 checkout=None,
+                 history_file="tested_bundles.json",
+                 legacy_signature_file=LEGACY_SIGNATURE_FILE):
         """
         Grab the bundle source and initialise the object.
 
@@ -118,8 +444,15 @@ class Bundle(object):
             CWR_dry_run: perform a dry run on running the tests
             store_push_dry_run: perform a dry run on pushing to the store
             fake_output: path to a tarball with fake output
+            checkout: an existing checkout of the repo to use instead of
+                      fetching one; it is left in place on exit
+            history_file: where to keep the signatures of the bundles
+                          builds were triggered for, and their outcomes
+            legacy_signature_file: where earlier versions kept the digest
+                                   of the last bundle built, if anywhere
         """
-        self.tempdir = Fetcher.fetch(repo, branch)
+        self.owns_checkout = checkout is None
+        self.tempdir = checkout or Fetcher.fetch(repo, branch)
         self.subdir = subdir
         self.bundle_path = "{}/{}/bundle.yaml".format(self.tempdir, subdir)
         self.ci_info_path = "{}/{}/ci-info.yaml".format(self.tempdir, subdir)
@@ -143,9 +476,10 @@ class Bundle(object):
         self.upgraded = False
         self.fake_output = fake_output
 
-        # We keep the sha1 digest/signature of the last bundle for
-        # which we triggered a build in the follwing file
-        self.signature_file = "last_bundle.signature"
+        # We keep the signatures of all the bundles we triggered a build
+        # for, so that no combination of revisions is tested twice
+        self.history = SignatureHistory(history_file)
+        self.legacy_signature_file = legacy_signature_file
         self.CWR_command = ["/var/lib/jenkins/scripts/cwr-helpers.sh",
                             "run_cwr_in_container"]
         if CWR_dry_run:
@@ -160,7 +494,8 @@ class Bundle(object):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        rmtree(self.tempdir)
+        if self.owns_checkout:
+            Fetcher.cleanup(self.tempdir)
 
     def get_charms(self):
         """
@@ -230,57 +565,48 @@ class Bundle(object):
             return False
 
         # Bundle is upgradable from here on
-        if not os.path.isfile(self.signature_file):
-            self.store_signature()
-            return True
-        else:
-            last_digest = self.get_last_signature()
-            current_digest = self.get_current_signature()
-            if last_digest != current_digest:
-                self.store_signature()
-                return True
-            else:
-                return False
+        signature = self.get_current_signature()
+        if self.legacy_signature_file and self.history.seed_legacy(
+                self.legacy_signature_file, signature,
+                self.get_legacy_signature):
+            return False
+        return self.history.add(signature, 'triggered')
 
     def get_current_signature(self):
         """
-        Get the sha1 digest of the bundle we have so far.
+        Get the digest of the bundle we have so far. Keys are sorted and
+        charm URLs normalized, so equivalent bundles get the same digest.
 
-        Returns: sha1 digest of bundle
+        Returns: sha256 digest of bundle
 
         """
-
-        with open("temp_bundle.yaml", 'w') as fp:
-            dump(self.bundle, fp)
-
-        sha1 = hashlib.sha1()
-        with open("temp_bundle.yaml", 'rb') as f:
-            data = f.read()
-            sha1.update(data)
-        return sha1.hexdigest()
-
-    def get_last_signature(self):
+        bundle = dict(self.bundle)
+        bundle['services'] = {
+            name: dict(service, charm=normalize_charm_url(service['charm']))
+            for name, service in self.bundle['services'].items()}
+        canonical = json.dumps(bundle, sort_keys=True, separators=(',', ':'),
+                               default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get_legacy_signature(self):
         """
-        Get the digest of the bundle we last fired a build for.
-
-        Returns: string digest
+        Returns: the digest earlier versions kept of the bundle, the sha1
+        of its YAML dump
 
         """
-        with open(self.signature_file, 'r') as fp:
-            digest = fp.read()
-        return digest
+        return hashlib.sha1(dump(self.bundle).encode('utf-8')).hexdigest()
 
-    def store_signature(self):
+    def record_outcome(self, outcome, build_num):
         """
-        Store the digest of the current bundle.
+        Remember the outcome of testing the bundle we have so far.
 
-        Returns: string digest
+        Args:
+            outcome: 'pass' or 'fail'
+            build_num: Build ID number
 
         """
-        digest = self.get_current_signature()
-        with open(self.signature_file, 'w') as f:
-            f.write(digest)
-        return digest
+        self.history.add(self.get_current_signature(), outcome,
+                         build=str(build_num))
 
     def test(self, build_num, controllers):
         """
@@ -304,6 +630,7 @@ class Bundle(object):
             cmd_str = "tar -zxvf {} -C {}".format(self.fake_output, output_dir)
             cmd = cmd_str.split()
             execute(cmd)
+            update_latest_build(os.environ['JOB_NAME'], build_num)
             if "output-results/pass" not in self.fake_output:
                 raise Exception("Faking a failing CWR")
 
@@ -318,22 +645,25 @@ class Bundle(object):
             return False
 
         cmd = list(self.charm_command)
-        cmd += ["push",  "{}/{}".format(self.tempdir, self.subdir), self.location]
-        execute(cmd)
+        cmd += ["push", "{}/{}".format(self.tempdir, self.subdir),
+                self.location]
+        execute(cmd, **NETWORK_TIMEOUTS)
 
-        _, output = execute(["charm", "show", self.location, "-c", "unpublished", "id"])
+        _, output = execute(["charm", "show", self.location, "-c",
+                             "unpublished", "id"],
+                            **NETWORK_TIMEOUTS)
         latest = safe_load(output)
         just_released = latest['id']['Id']
 
         cmd = list(self.charm_command)
         cmd += ["release", just_released]
         cmd += ["--channel", self.ci_info['bundle']['to-channel']]
-        execute(cmd)
+        execute(cmd, **NETWORK_TIMEOUTS)
 
         cmd = list(self.charm_command)
         cmd += ["grant", just_released]
         cmd += ["everyone"]
-        _, output = execute(cmd)
+        _, output = execute(cmd, **NETWORK_TIMEOUTS)
 
         return True
 
@@ -351,31 +681,48 @@ class Charm(object):
         self.provided_name = charm_name
         self.name_no_namespace = charm_name[charm_name.rfind('/')+1:]
         m = search(r'\-\d+$', self.name_no_namespace)
-        # if the string ends in digits m will be a Match object, or None otherwise.
+        # if the string ends in digits m will be a Match object, or None
+        # otherwise.
         self.name = self.name_no_namespace
         self.name_no_revision = charm_name
         if m is not None:
             self.name = self.name[:len(self.name) - len(m.group())]
-            self.name_no_revision = charm_name[:len(charm_name) - len(m.group())]
+            self.name_no_revision = charm_name[:len(charm_name) -
+                                               len(m.group())]
 
         if store_push_dry_run:
             self.charm_command = ["echo", "charm"]
         else:
             self.charm_command = ["charm"]
 
-    def get_latest(self, channel):
+    def get_latest(self, channel, echo=True, refresh=False):
         """
-        Get the latest revision of the charm present in the channel provided
+        Get the latest revision of the charm present in the channel provided.
+        Lookups are shared with other jobs through the store cache.
 
         Args:
             channel: the channel to look for the charm
+            echo: print the charm command and its output
+            refresh: bypass the store cache
 
         Returns: the latest revision of the charm
 
         """
-        _, output = execute(["charm", "show", self.name_no_revision, "-c", channel, "id"])
-        latest = safe_load(output)
-        return latest['id']['Id']
+        def fetch():
+            try:
+                _, output = execute(["charm", "show", self.name_no_revision,
+                                     "-c", channel, "id"], echo=echo,
+                                    **NETWORK_TIMEOUTS)
+            except CommandFailed as e:
+                # lookups made by the resolver are not echoed, so this is
+                # the only place the store's error shows up
+                raise Exception("Failed to look up {} in {}: {}".format(
+                    self.name_no_revision, channel,
+                    e.tail(lines=3) or e)) from e
+            return safe_load(output)['id']['Id']
+
+        return store_cache.get_revision(self.name_no_revision, channel, fetch,
+                                        refresh=refresh)
 
     def get_name(self):
         """
@@ -409,16 +756,78 @@ class Charm(object):
             to_channel: where to release the charm
 
         """
-        latest = self.get_latest(from_channel)
+        latest = self.get_latest(from_channel, refresh=True)
+        self.release(latest, to_channel)
+
+    def release(self, revision, to_channel, echo=True):
+        """
+        Release a revision of the charm to a channel and grant everyone
+        access to it.
+
+        Args:
+            revision: the charm revision, eg cs:~me/ubuntu-3
+            to_channel: where to release the charm
+            echo: print the charm commands and their output
+
+        """
         cmd = list(self.charm_command)
-        cmd += ["release", latest]
+        cmd += ["release", revision]
         cmd += ["--channel", to_channel]
-        execute(cmd)
-        latest_just_released = self.get_latest(to_channel)
+        execute(cmd, echo=echo, **NETWORK_TIMEOUTS)
         cmd = list(self.charm_command)
-        cmd += ["grant", latest_just_released]
+        cmd += ["grant", revision]
         cmd += ["everyone"]
-        execute(cmd)
+        execute(cmd, echo=echo, **NETWORK_TIMEOUTS)
+
+
+class RevisionResolver(object):
+    """
+    Resolve the latest revisions of charms in store channels.
+
+    Lookups are made once per (charm, channel) and run concurrently on a
+    bounded pool of workers.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.revisions = {}
+        self.lock = Lock()
+
+    def resolve(self, lookups):
+        """
+        Get the latest revisions of many charms at once.
+
+        Args:
+            lookups: a list of (Charm, channel) tuples
+
+        Returns: the latest revisions, in the order of lookups
+
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [self._submit(pool, charm, channel)
+                       for charm, channel in lookups]
+            return [future.result() for future in futures]
+
+    def get_latest(self, charm, channel):
+        """
+        Get the latest revision of a single charm in a channel.
+
+        Args:
+            charm: a Charm
+            channel: the channel to look for the charm
+
+        Returns: the latest revision of the charm
+
+        """
+        return self.resolve([(charm, channel)])[0]
+
+    def _submit(self, pool, charm, channel):
+        key = (charm.get_namespace_name(), channel)
+        with self.lock:
+            if key not in self.revisions:
+                self.revisions[key] = pool.submit(
+                    charm.get_latest, channel, echo=False)
+            return self.revisions[key]
 
 
 class Coordinator(object):
@@ -426,6 +835,36 @@ class Coordinator(object):
     def __init__(self, CWR_dry_run=False, store_push_dry_run=False):
         self.CWR_dry_run = CWR_dry_run
         self.store_push_dry_run = store_push_dry_run
+        self.resolver = RevisionResolver()
+        self.release_workers = 8
+        self.release_attempts = 5
+        self.release_backoff = 2
+
+    def get_upgrades(self, bundle, charms):
+        """
+        Look up the latest revision of every charm of the bundle that is
+        marked for upgrade.
+
+        Args:
+            bundle: the Bundle
+            charms: the charms of the bundle
+
+        Returns: a list of (charm, Charm, upgrade_info, latest revision)
+                 tuples in the order of charms; upgrade_info and latest
+                 revision are None for charms not marked for upgrade
+
+        """
+        upgrades = []
+        for charm in charms:
+            c = Charm(charm)
+            upgrades.append((charm, c,
+                             bundle.get_charms_upgrade_policy(c.get_name())))
+        revisions = iter(self.resolver.resolve(
+            [(c, upgrade_info["from-channel"])
+             for _, c, upgrade_info in upgrades if upgrade_info]))
+        return [(charm, c, upgrade_info,
+                 next(revisions) if upgrade_info else None)
+                for charm, c, upgrade_info in upgrades]
 
     def check_bundle(self, repo, branch, subdir):
         """
@@ -442,31 +881,118 @@ class Coordinator(object):
                     CWR_dry_run=self.CWR_dry_run,
                     store_push_dry_run=self.store_push_dry_run) as bundle:
             print("Checking {}".format(repo))
-            charms = bundle.get_charms()
-            print("Charms in bundle {}".format(charms))
-            for charm in charms:
-                c = Charm(charm)
-                upgrade_info = bundle.get_charms_upgrade_policy(c.get_name())
-                if upgrade_info:
-                    print("Upgrading charm {}".format(charm))
-                    print("Upgrading info {}".format(upgrade_info))
-                    print("Latest revision {} in channel {}"
-                          .format(c.get_latest(upgrade_info["from-channel"]),
-                                  upgrade_info["from-channel"]))
-                    bundle.upgrade(charm, c.get_latest(upgrade_info["from-channel"]))
-                else:
-                    print("Charm {} not marked for upgrade.".format(c.get_name()))
-
-            if not bundle.upgradable():
-                print("Not upgradable")
-                return False
+            return self.should_build(bundle)
+
+    def should_build(self, bundle):
+        """
+        Upgrade the charms of the bundle to their latest revisions and see
+        if the result is a bundle we have not triggered a build for yet.
+
+        Args:
+            bundle: the Bundle
+
+        Returns: True if a build should be triggered
+
+        """
+        charms = bundle.get_charms()
+        print("Charms in bundle {}".format(charms))
+        for charm, c, upgrade_info, latest in self.get_upgrades(bundle,
+                                                                charms):
+            if upgrade_info:
+                print("Upgrading charm {}".format(charm))
+                print("Upgrading info {}".format(upgrade_info))
+                print("Latest revision {} in channel {}"
+                      .format(latest, upgrade_info["from-channel"]))
+                bundle.upgrade(charm, latest)
+            else:
+                print("Charm {} not marked for upgrade.".format(c.get_name()))
+
+        if not bundle.upgradable():
+            print("Not upgradable")
+            return False
+        else:
+            print("Upgraded")
+            if bundle.should_trigger_build():
+                print("Should trigger build")
+                return True
             else:
-                print("Upgraded")
-                if bundle.should_trigger_build():
-                    print("Should trigger build")
-                    return True
-                else:
-                    return False
+                return False
+
+    def check_all(self, entries, state_dir="."):
+        """
+        Check many bundles in one go. Every repo and branch is fetched once,
+        and the latest revisions of all the charms to upgrade are looked up
+        together, once per charm and channel.
+
+        Args:
+            entries: a list of dicts with the repo, branch and subdir of a
+                     bundle, and optionally a name identifying it
+            state_dir: where to keep the signatures of the bundles builds
+                       were triggered for, one file per bundle
+
+        Returns: a tuple with the entries of the bundles that need a build
+                 and the entries of the bundles that could not be checked,
+                 the latter with the error added
+
+        """
+        checkouts = {}
+        bundles = []
+        errors = []
+        try:
+            for entry in entries:
+                repo, branch = entry['repo'], entry.get('branch')
+                subdir = entry.get('subdir', '.')
+                try:
+                    if (repo, branch) not in checkouts:
+                        checkouts[repo, branch] = Fetcher.fetch(repo, branch)
+                    history_file = os.path.join(
+                        state_dir, "{}.json".format(bundle_name(entry)))
+                    bundles.append((entry, Bundle(
+                        repo, branch, subdir,
+                        CWR_dry_run=self.CWR_dry_run,
+                        store_push_dry_run=self.store_push_dry_run,
+                        checkout=checkouts[repo, branch],
+                        history_file=history_file,
+                        legacy_signature_file=None)))
+                except Exception as e:
+                    errors.append(dict(entry, error=str(e)))
+
+            # Warm up the resolver with the lookups of all the bundles
+            lookups = []
+            checked = []
+            for entry, bundle in bundles:
+                try:
+                    bundle_lookups = []
+                    for charm in bundle.get_charms():
+                        c = Charm(charm)
+                        upgrade_info = bundle.get_charms_upgrade_policy(
+                            c.get_name())
+                        if upgrade_info:
+                            bundle_lookups.append(
+                                (c, upgrade_info["from-channel"]))
+                except Exception as e:
+                    errors.append(dict(entry, error=str(e)))
+                    continue
+                lookups.extend(bundle_lookups)
+                checked.append((entry, bundle))
+            try:
+                self.resolver.resolve(lookups)
+            except Exception:
+                # reported by the bundles that need the failing lookup
+                pass
+
+            to_build = []
+            for entry, bundle in checked:
+                print("Checking {}".format(bundle_name(entry)))
+                try:
+                    if self.should_build(bundle):
+                        to_build.append(entry)
+                except Exception as e:
+                    errors.append(dict(entry, error=str(e)))
+            return to_build, errors
+        finally:
+            for checkout in checkouts.values():
+                Fetcher.cleanup(checkout)
 
     def test_and_release_bundle(self, repo, branch, subdir, build_num, models):
         """
@@ -490,34 +1016,96 @@ class Coordinator(object):
             print("Checking {}".format(repo))
             charms = bundle.get_charms()
             print("Charms in bundle {}".format(charms))
-            for charm in charms:
-                c = Charm(charm)
-                upgrade_info = bundle.get_charms_upgrade_policy(c.get_name())
+            upgrades = self.get_upgrades(bundle, charms)
+            for charm, c, upgrade_info, latest in upgrades:
                 if upgrade_info:
                     print("Upgrading {}".format(charm))
                     print("Upgrading info {}".format(upgrade_info))
                     print("Upgrading to revision {} of channel {}"
-                          .format(c.get_latest(upgrade_info["from-channel"]),
-                                  upgrade_info["from-channel"]))
-                    bundle.upgrade(charm,
-                                   c.get_latest(upgrade_info["from-channel"]))
+                          .format(latest, upgrade_info["from-channel"]))
+                    bundle.upgrade(charm, latest)
             print("Testing new bundle")
-            bundle.test(build_num, models)
+            try:
+                bundle.test(build_num, models)
+            except Exception:
+                bundle.record_outcome('fail', build_num)
+                raise
+            bundle.record_outcome('pass', build_num)
             if bundle.ci_info and bundle.ci_info['bundle']['release']:
                 print("Releasing bundle")
                 bundle.release()
-                for charm in charms:
-                    c = Charm(charm)
-                    upgrade_info = bundle.get_charms_upgrade_policy(
-                        c.get_name())
+                releases = {}
+                for _, c, upgrade_info, latest in upgrades:
                     if upgrade_info and upgrade_info['release']:
-                        print("Releasing charm {} "
-                              "from channel {} to channel {}".format(
-                                  c.get_latest(upgrade_info["from-channel"]),
-                                  upgrade_info["from-channel"],
-                                  upgrade_info['to-channel']))
-                        c.release_latest(upgrade_info['from-channel'],
-                                         upgrade_info['to-channel'])
+                        releases[latest, upgrade_info['to-channel']] = c
+                self.release_charms([
+                    (c, revision, channel)
+                    for (revision, channel), c in releases.items()])
+
+    def release_charms(self, releases):
+        """
+        Release charms concurrently, retrying each with exponential backoff.
+        A summary is printed once all are done.
+
+        Args:
+            releases: a list of (Charm, revision, channel) tuples, the
+                      revision being the one the bundle was tested with
+
+        """
+        def release(c, revision, channel):
+            attempts = 0
+
+            def attempt():
+                nonlocal attempts
+                attempts += 1
+                c.release(revision, channel, echo=False)
+
+            try:
+                retry(attempt, attempts=self.release_attempts,
+                      backoff=self.release_backoff)
+                return attempts, None
+            except Exception as e:
+                return attempts, e
+
+        with ThreadPoolExecutor(max_workers=self.release_workers) as pool:
+            futures = [pool.submit(release, c, revision, channel)
+                       for c, revision, channel in releases]
+            results = [future.result() for future in futures]
+
+        print("Charm releases:")
+        failed = []
+        for (_, revision, channel), (attempts, error) in zip(releases,
+                                                             results):
+            status = "FAILED ({})".format(error) if error else "released"
+            print("  {} to {}: {} after {} attempt(s)".format(
+                revision, channel, status, attempts))
+            if isinstance(error, CommandFailed):
+                # the commands ran concurrently, so their output was not
+                # echoed as it came
+                for line in error.tail().splitlines():
+                    print("    {}".format(line))
+            if error:
+                failed.append(revision)
+        if failed:
+            raise Exception("Failed to release {}".format(", ".join(failed)))
+
+
+def bundle_name(entry):
+    """
+    Name a bundle of a check-all manifest.
+
+    Args:
+        entry: the manifest entry
+
+    Returns: the name given in the entry, or one derived from where the
+             bundle is
+
+    """
+    if 'name' in entry:
+        return entry['name']
+    source = "{} {} {}".format(entry['repo'], entry.get('branch'),
+                               entry.get('subdir', '.'))
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
 
 
 def parse_args(argv=None):
@@ -532,6 +1120,19 @@ def parse_args(argv=None):
         'subdir',
         help='Subdirectory within the repo where the bundle is')
 
+    ca_parser = subparsers.add_parser(
+        'check-all', help='Check all the bundles of a manifest.')
+    ca_parser.add_argument(
+        'manifest',
+        help='YAML list of bundles, each with a repo, a branch, a subdir '
+             'and optionally a name.')
+    ca_parser.add_argument(
+        '--state-dir', default='.',
+        help='Where to keep the signatures of the bundles built.')
+    ca_parser.add_argument(
+        '--output', default='-',
+        help='Where to write the JSON list of bundles that need a build.')
+
     bl_parser = subparsers.add_parser('build', help='Check the bundle.')
     bl_parser.add_argument('repo', help='Repo of the bundle.')
     bl_parser.add_argument('branch', help='Branch to grab the bundle from.')
@@ -554,6 +1155,19 @@ if __name__ == "__main__":
             sys.exit(0)
         else:
             sys.exit(1)
+    elif args.operation == "check-all":
+        with open(args.manifest) as stream:
+            entries = safe_load(stream) or []
+        to_build, errors = tester.check_all(entries, args.state_dir)
+        for error in errors:
+            print("Failed to check {}: {}".format(bundle_name(error),
+                                                  error['error']))
+        if args.output == '-':
+            print(json.dumps(to_build, indent=2))
+        else:
+            with open(args.output, 'w') as fp:
+                json.dump(to_build, fp, indent=2)
+        sys.exit(1 if errors else 0)
     elif args.operation == "build":
         build_num = sys.argv[5]
         models = sys.argv[6:]
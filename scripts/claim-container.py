@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+
+"""
+Take a started, network ready cwrbox container out of the pool kept by the
+cwr-container-pool service, and print its name. Nothing is printed when no
+container is ready; the caller then creates one itself.
+
+    .. note:: This is currently called from run_in_container() in
+              cwr-helpers.sh.
+"""
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from containerpool import ContainerPool  # noqa: E402
+
+
+if __name__ == "__main__":
+    name = ContainerPool().claim()
+    if name:
+        print(name)
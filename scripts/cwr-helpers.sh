@@ -96,16 +96,49 @@ function update_image() {
 }
 
 
-function run_in_container() {
+function create_container() {
+    # Create and start a container, with the same setup as the ones of the
+    # container pool (see lib/containerpool.py)
     container=$(petname)
     echo "Creating container"
     lxc init cwrbox $container
     add_exit_handler "lxc delete --force $container"
 
-    echo "Configuring container"
     # map container's root to jenkins
     lxc config set $container raw.idmap "$(printf "uid $(id -u) 0\ngid $(id -g) 0")"
+    lxc config device add $container artifacts disk source=/srv/artifacts path=/srv/artifacts
+
+    echo "Starting container"
+    lxc start $container
+
+    echo "Waiting for container's networking to come up"
+    wait_time=1
+    until check_container_network $container || [[ $wait_time == 30 ]]; do
+        sleep 1
+        wait_time=$(( wait_time + 1 ))
+    done
+    if ! check_container_network $container; then
+        >&2 echo 'Container does not have network connectivity'
+        exit 1
+    fi
+
+    echo "Updating container's packages"
+    lxc exec $container -- apt update -yq
+}
 
+
+function run_in_container() {
+    # Use a container of the pool kept by the cwr-container-pool service
+    # when one is ready, else set one up from scratch.
+    container=$(/var/lib/jenkins/scripts/claim-container.py || true)
+    if [[ -n "$container" ]]; then
+        echo "Using pre-started container $container"
+        add_exit_handler "lxc delete --force $container"
+    else
+        create_container
+    fi
+
+    echo "Configuring container"
     # Copy in Juju config (instead of mounting to isolate active model) and helper scripts
     lxc file push -r ~/.local/share/juju $container/root/.local/share/
     lxc file push -r /var/lib/jenkins/scripts/ $container/usr/local/bin/
@@ -113,10 +146,8 @@ function run_in_container() {
         lxc file push -r /var/lib/jenkins/configuration/ $container/root/configuration/
     fi
 
-
-    # Mount the workspace and artifacts dir
+    # Mount the workspace
     lxc config device add $container workspace disk source=$(pwd) path=/root/workspace
-    lxc config device add $container artifacts disk source=/srv/artifacts path=/srv/artifacts
 
     # buildbundle.py does fetching and processing outside of the container
     # we should refactor that so that the tools (bundletester and/or matrix)
@@ -128,23 +159,6 @@ function run_in_container() {
         lxc config device add $container bundle disk source="$bundle" path="$bundle"
     fi
 
-    echo "Starting container"
-    lxc start $container
-
-    echo "Waiting for container's networking to come up"
-    wait_time=1
-    until check_container_network $container || [[ $wait_time == 30 ]]; do
-        sleep 1
-        wait_time=$(( wait_time + 1 ))
-    done
-    if ! check_container_network $container; then
-        >&2 echo 'Container does not have network connectivity'
-        exit 1
-    fi
-
-    echo "Updating container's packages"
-    lxc exec $container -- apt update -yq
-
     # Run the command.
     echo "Execing container"
     lxc exec $container --env=JOB_NAME="$JOB_NAME" \
@@ -154,6 +168,7 @@ function run_in_container() {
                         --env=REPO="$REPO" \
                         --env=PR_ID="$PR_ID" \
                         --env=S3_OPTIONS_ENV="$S3_OPTIONS_ENV" \
+                        --env=CWR_RESULTS_DIR="$CWR_RESULTS_DIR" \
                         -- "$@"
 }
 
@@ -212,6 +227,13 @@ function copy_xml() {
 }
 
 
+function update_artifacts_index() {
+    # Move the job's "latest" link to this build and record its results in
+    # /srv/artifacts/jobs.json, so the gateway never has to scan builds.
+    /var/lib/jenkins/scripts/update-artifacts-index.py "$(get_fname $1)" "$BUILD_NUMBER"
+}
+
+
 function release_charm() {
   # Push a directory to the charm store, release it and grant everyone access.
   local charm_build_dir=$1
@@ -302,7 +324,12 @@ function add_models() {
             juju destroy-model $model -y
         done
     }
-    add_exit_handler cleanup_models
+    # Jobs add models once per controller, but a single cleanup destroys
+    # all of them
+    if [[ -z "$MODELS_CLEANUP_REGISTERED" ]]; then
+        add_exit_handler cleanup_models
+        MODELS_CLEANUP_REGISTERED=1
+    fi
 
     sleep 5 # temporary hackaround for https://bugs.launchpad.net/juju/+bug/1635052
 
@@ -336,36 +363,68 @@ function run_cwr() {
         bundle_file="bundle.yaml"
     fi
 
-    output_option='--results-dir /srv/artifacts'
+    # Parallel runs each write their results to their own directory, see
+    # run_controllers_in_parallel
+    results_dir="${CWR_RESULTS_DIR:-/srv/artifacts}"
+    output_option="--results-dir $results_dir"
     if [[ -n "${s3_options}" ]]; then
         output_option=$s3_options
     elif [[ -n "${S3_OPTIONS_ENV}" ]]; then
         output_option=$S3_OPTIONS_ENV
     fi
 
-    rm -f totest.yaml
-    echo "bundle: $bundle" >> totest.yaml
-    echo "bundle_name: $job_title" >> totest.yaml
-    echo "bundle_file: $bundle_file" >> totest.yaml
+    # parallel runs share the workspace
+    totest="totest.yaml"
+    if [[ -n "$CWR_RESULTS_DIR" ]]; then
+        totest="totest-$(basename $CWR_RESULTS_DIR).yaml"
+    fi
+    rm -f $totest
+    echo "bundle: $bundle" >> $totest
+    echo "bundle_name: $job_title" >> $totest
+    echo "bundle_file: $bundle_file" >> $totest
 
-    artifacts_dir=$(job_output_dir "$job_title")
+    artifacts_dir="$results_dir/$(get_fname $job_title)/$BUILD_NUMBER"
     if ! env MATRIX_MODEL_PREFIX="job-$BUILD_NUMBER-matrix" \
-      MATRIX_OUTPUT_DIR=$artifacts_dir cwr -F -l DEBUG -v $models totest.yaml \
+      MATRIX_OUTPUT_DIR=$artifacts_dir cwr -F -l DEBUG -v $models $totest \
       $output_option --test-id $BUILD_NUMBER
     then
         echo 'CWR reported failure'
-        if [[ -n $PR_ID && -n $TOKEN ]]; then
-            send-comment.py $TOKEN $REPO $PR_ID "PR failed Cloud Weather Report tests"
+        # Parallel runs are reported once they are all done, see
+        # run_controllers_in_parallel
+        if [[ -z "$CWR_RESULTS_DIR" ]]; then
+            report_cwr failed "${@:2}"
         fi
         exit 1
     fi
 
     echo 'CWR reported success'
+    if [[ -z "$CWR_RESULTS_DIR" ]]; then
+        report_cwr passed "${@:2}"
+    fi
+}
+
+
+function report_cwr() {
+    # Comment on the pull request with the outcome of CWR and, if it passed,
+    # release the charm. Takes the arguments of run_cwr, with "passed" or
+    # "failed" in place of the models.
+    outcome="$1"
+    charm_name="$4"
+    series="$5"
+    charm_subdir="$7"
+    push_to_channel="$8"
+    lp_id="$9"
+    charm_build_dir="/tmp/${series:-builds}/$charm_name"
+
     if [[ -n $PR_ID && -n $TOKEN ]]; then
-        send-comment.py $TOKEN $REPO $PR_ID "PR passed Cloud Weather Report tests"
+        send-comment.py $TOKEN $REPO $PR_ID "PR $outcome Cloud Weather Report tests"
     fi
 
-    if [[ $? == 0 && -n "$push_to_channel" && -n "$lp_id" ]]; then
+    if [[ $outcome == passed && -n "$push_to_channel" && -n "$lp_id" ]]; then
+        # Parallel runs built the charm in their own containers
+        if [[ ! -d "$charm_build_dir" ]]; then
+            build_charm "$charm_name" "$series" "$charm_subdir"
+        fi
         release_charm $charm_build_dir $lp_id $series $charm_name $push_to_channel
     fi
 }
@@ -384,25 +443,27 @@ function run_cwr_in_container() {
     charm_subdir="$6"
     push_to_channel="$7"
     lp_id="$8"
+    s3_options="$9"
 
     artifacts_dir=$(job_output_dir "$job_title")
     mkdir -p $artifacts_dir
 
     add_exit_handler "link_artifacts $job_title"
     add_exit_handler "copy_xml $job_title"
+    add_exit_handler "update_artifacts_index $job_title"
 
     update_image
 
-    # NB: This really stinks. We're running clouds sequentially intead of
-    # parallellelly because of this issue:
-    #   https://github.com/juju-solutions/layer-cwr/issues/114
-    #
-    # Hopefully we can axe this loop once cwr/bt handle multiple models better.
-    # Until then, remove the set -e around the loop because we want to process
-    # all clouds even if one fails. Note we *could* background the run_cwr
-    # bits to spawn parallel cwr tasks, but that interleaves the logs and
-    # makes it almost impossible to debug jenkins console output.
-    # Be patient instead :(
+    # cwr's own S3 upload cannot be pointed at a directory per run
+    if [[ -z "$OUTPUT_SCENARIO" && -z "$s3_options$S3_OPTIONS_ENV" ]] && is_parallel; then
+        run_controllers_in_parallel "$artifacts_dir" "$controllers" "$@"
+        return
+    fi
+
+    # Controllers run one after the other unless parallel runs are enabled
+    # (see is_parallel), in which case the logs of every controller go to
+    # their own file. Remove the set -e around the loop because we want to
+    # process all clouds even if one fails.
     set +e
     for controller in $controllers; do
       add_models $controller
@@ -426,12 +487,94 @@ function run_cwr_in_container() {
 }
 
 
+function is_parallel() {
+    # CWR_PARALLEL in the job's environment wins over the charm's
+    # parallel_controllers config
+    parallel="${CWR_PARALLEL:-$(cat /var/lib/jenkins/cwr_parallel 2>/dev/null)}"
+    [[ "$parallel" == "true" ]]
+}
+
+
+function run_controllers_in_parallel() {
+    # Run CWR against every controller at the same time, each in its own
+    # container. Every run logs to controllers/<controller>/cwr.log in the
+    # artifacts dir; the console shows all of them merged, one line at a
+    # time, prefixed with the controller. The build fails if any run does,
+    # and the reports of all runs are combined into the build's report.
+    local artifacts_dir="$1"
+    local to_test="$2"
+    shift 2
+
+    local names=() models=() pids=() runs=()
+    local i name run_dir
+    # Models are all added before any run starts: add_models switches the
+    # current controller while runs copy the Juju config into their
+    # container, and it registers the cleanup of the job's models, which
+    # must only run once every run is done.
+    for name in $to_test; do
+        add_models $name
+        names+=("$name")
+        models+=("$MODELS_TO_TEST")
+    done
+
+    for i in "${!names[@]}"; do
+        name="${names[$i]}"
+        run_dir="$artifacts_dir/controllers/$(get_fname $name)"
+        mkdir -p "$run_dir"
+        runs+=("$name" "$run_dir/$(get_fname $1)/$BUILD_NUMBER")
+        run_controller "$name" "$run_dir" "${models[$i]}" "$@" &
+        pids+=($!)
+    done
+
+    local status=0 failed="" outcome=passed
+    for i in "${!pids[@]}"; do
+        wait ${pids[$i]} || { status=1; failed+="${names[$i]} "; }
+    done
+
+    /var/lib/jenkins/scripts/merge-cwr-reports.py "$artifacts_dir" "${runs[@]}"
+    if [[ $status != 0 ]]; then
+        echo "CWR failed on: $failed"
+        outcome=failed
+    fi
+
+    # The runs leave commenting on the pull request and releasing the charm
+    # to here, so that it happens once and only if every run passed
+    if [[ -n $PR_ID && -n $TOKEN ]] || \
+       [[ $outcome == passed && -n "$7" && -n "$8" ]]; then
+        run_in_container cwr-helpers.sh report_cwr $outcome "$@"
+    fi
+    return $status
+}
+
+
+function run_controller() {
+    local name="$1"
+    local run_dir="$2"
+    local models="$3"
+    shift 3
+
+    # The run fails if CWR does, not only if sed does; pipefail is kept
+    # to this pipeline
+    (
+        set -o pipefail
+        (
+            # Subshells report the traps of their parent; drop them so
+            # that this run only cleans up after itself.
+            trap - EXIT SIGHUP SIGINT SIGTERM
+            export CWR_RESULTS_DIR="$run_dir"
+            run_in_container cwr-helpers.sh run_cwr "$models" "$@"
+        ) 2>&1 | tee "$run_dir/cwr.log" | sed -u "s/^/[$name] /"
+    )
+}
+
 cmd=$1
 if [[ -n "$1" ]]; then
     shift
     case $cmd in
         run_cwr)
             run_cwr "$@" ;;
+        report_cwr)
+            report_cwr "$@" ;;
         run_cwr_in_container)
             run_cwr_in_container "$@" ;;
     esac
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+"""
+Combine the reports of CWR runs made against several controllers at once
+into the build's report.json and report.xml, and print a summary.
+
+    :param build_dir: The build's artifacts dir
+    :param controller report_dir: For every controller, the directory its
+                                  run wrote its reports to
+
+    .. note:: This is currently called from run_cwr_in_container() in
+              cwr-helpers.sh, when controllers are tested in parallel.
+"""
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from artifacts import merge_reports  # noqa: E402
+
+
+if __name__ == "__main__":
+    build_dir = sys.argv[1]
+    args = sys.argv[2:]
+    runs = list(zip(args[::2], args[1::2]))
+
+    for result in merge_reports(build_dir, runs):
+        print("{}: {}".format(result.get('provider'),
+                              result.get('test_outcome')))
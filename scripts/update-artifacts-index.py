@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+"""
+Point a job's 'latest' artifacts link at a build and record the build's
+results in /srv/artifacts/jobs.json.
+
+    :param job_title: Job title, as used for the job's artifacts dir
+    :param build_number: Build number whose artifacts were just written
+
+    .. note:: This is currently called from run_cwr_in_container() in
+              cwr-helpers.sh.
+"""
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from artifacts import update_latest_build  # noqa: E402
+
+
+if __name__ == "__main__":
+    job_title = sys.argv[1]
+    build_number = sys.argv[2]
+
+    update_latest_build(job_title, build_number)
@@ -0,0 +1,15 @@
+# Gunicorn settings of the CI gateway, rendered by CIGateway.render_service()
+# and read again on every `systemctl reload cwr-server`
+
+workers = {{workers}}
+threads = {{threads}}
+worker_class = 'gthread'
+max_requests = {{max_requests}}
+max_requests_jitter = {{max_requests_jitter}}
+
+
+def post_worker_init(worker):
+    # Start the worker's background threads once the app is loaded, so that
+    # importing CIGWServer (in tests, or by gunicorn's master) starts nothing
+    import CIGWServer
+    CIGWServer.start_background_tasks()
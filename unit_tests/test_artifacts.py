@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import unittest
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from lib import artifacts
+
+
+class TestArtifacts(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def make_build(self, job, build, results=None):
+        build_dir = Path(self.root) / job / str(build)
+        build_dir.mkdir(parents=True)
+        if results is not None:
+            (build_dir / 'report.json').write_text(
+                json.dumps({'results': results}))
+        return build_dir
+
+    def test_no_builds(self):
+        self.assertIsNone(artifacts.get_latest_build('job', root=self.root))
+
+    def test_fallback_sorts_numerically(self):
+        self.make_build('job', 9)
+        self.make_build('job', 10)
+        latest = artifacts.get_latest_build('job', root=self.root)
+        self.assertEqual(latest.name, '10')
+
+    def test_update_latest_build(self):
+        results = [{'provider': 'aws', 'test_outcome': 'PASS'}]
+        self.make_build('job', 10, results)
+        self.make_build('job', 9)
+        artifacts.update_latest_build('job', 9, root=self.root)
+        self.assertEqual(
+            artifacts.get_latest_build('job', root=self.root).name, '9')
+        artifacts.update_latest_build('job', 10, root=self.root)
+        self.assertEqual(
+            artifacts.get_latest_build('job', root=self.root).name, '10')
+        self.assertEqual(
+            os.readlink(os.path.join(self.root, 'job', 'latest')), '10')
+
+        index = artifacts.read_jobs_index(root=self.root)
+        self.assertEqual(index['job']['build'], '10')
+        self.assertEqual(index['job']['results'], results)
+
+    def test_update_latest_build_out_of_order(self):
+        self.make_build('job', 11)
+        self.make_build('job', 12, [])
+        artifacts.update_latest_build('job', 12, root=self.root)
+        artifacts.update_latest_build('job', 11, root=self.root)
+        self.assertEqual(
+            os.readlink(os.path.join(self.root, 'job', 'latest')), '12')
+        index = artifacts.read_jobs_index(root=self.root)
+        self.assertEqual(index['job']['build'], '12')
+        # the earlier build still gets its manifest
+        self.assertTrue(artifacts.is_build_finished('job', 11, self.root))
+
+    def test_update_missing_build(self):
+        artifacts.update_latest_build('job', 1, root=self.root)
+        self.assertEqual(artifacts.read_jobs_index(root=self.root), {})
+
+    def test_is_build_finished(self):
+        self.make_build('job', 1)
+        self.make_build('job', 2)
+        self.assertFalse(artifacts.is_build_finished('job', 1, self.root))
+        artifacts.update_latest_build('job', 2, root=self.root)
+        self.assertTrue(artifacts.is_build_finished('job', 2, self.root))
+        # a later build finishing first says nothing about this one
+        self.assertFalse(artifacts.is_build_finished('job', 1, self.root))
+
+    def test_build_manifest(self):
+        build_dir = self.make_build('job', 1)
+        (build_dir / 'sub').mkdir()
+        (build_dir / 'sub' / 'b.log').write_text('hello')
+        (build_dir / 'a.txt').write_text('')
+        manifest = artifacts.build_manifest(build_dir)
+        self.assertEqual([f['path'] for f in manifest], ['a.txt', 'sub/b.log'])
+        self.assertEqual(manifest[1]['size'], 5)
+        self.assertEqual(
+            manifest[1]['sha256'],
+            '2cf24dba5fb0a30e26e83b2ac5b9e29e'
+            '1b161e5c1fa7425e73043362938b9824')
+
+    def test_build_manifest_without_digests(self):
+        build_dir = self.make_build('job', 1)
+        (build_dir / 'a.txt').write_text('hello')
+        manifest = artifacts.build_manifest(build_dir, digests=False)
+        self.assertEqual(manifest[0]['size'], 5)
+        self.assertNotIn('sha256', manifest[0])
+
+    def test_manifest_stored_when_finished(self):
+        build_dir = self.make_build('job', 1, [])
+        (build_dir / 'a.txt').write_text('hello')
+        self.assertIsNone(artifacts.read_manifest('job', 1, self.root))
+        artifacts.update_latest_build('job', 1, root=self.root)
+        manifest = artifacts.read_manifest('job', 1, self.root)
+        self.assertEqual(manifest, artifacts.build_manifest(build_dir))
+        # the stored manifest is not an artifact of the build
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'job'))),
+                         ['.1.manifest.json', '1', 'latest'])
+
+    def test_merge_reports(self):
+        build_dir = self.make_build('job', 1)
+        lxd = build_dir / 'controllers' / 'lxd'
+        lxd.mkdir(parents=True)
+        (lxd / 'report.json').write_text(json.dumps({
+            'version': 1,
+            'results': [{'provider': 'LXD', 'test_outcome': 'PASS'}]}))
+        (lxd / 'report.xml').write_text(
+            '<?xml version="1.0" ?><testsuites>'
+            '<testsuite name="LXD" tests="1"><testcase name="t"/>'
+            '</testsuite></testsuites>')
+
+        results = artifacts.merge_reports(build_dir, [
+            ('lxd', lxd), ('aws', build_dir / 'controllers' / 'aws')])
+
+        self.assertEqual([(r['provider'], r['test_outcome']) for r in results],
+                         [('LXD', 'PASS'), ('aws', 'INFRA')])
+        report = json.loads((build_dir / 'report.json').read_text())
+        self.assertEqual(report['version'], 1)
+        self.assertEqual(report['results'], results)
+        suites = ET.parse(str(build_dir / 'report.xml')).getroot()
+        self.assertEqual([s.get('name') for s in suites], ['LXD', 'aws'])
+        self.assertIsNotNone(suites.find('testsuite/testcase/failure'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,7 +3,10 @@
 import argparse
 import os
 import unittest
+from pathlib import Path
 from scripts import bundlebuilder
+from shutil import rmtree
+from tempfile import mkdtemp
 from unittest.mock import patch, mock_open
 
 
@@ -16,9 +19,39 @@ class TestBundlebuilder(unittest.TestCase):
         assert retcode is 0
 
     def test_raise(self):
-        with self.assertRaises(Exception):
+        with self.assertRaises(bundlebuilder.CommandFailed) as cm:
             bundlebuilder.execute(
                 ["python3", "scripts/bundlebuilder.py", "foo"])
+        self.assertEqual(cm.exception.returncode, 2)
+        assert "invalid choice:" in cm.exception.tail()
+
+    def test_timeout(self):
+        with self.assertRaises(bundlebuilder.CommandTimeout):
+            bundlebuilder.execute(["sh", "-c", "echo start; sleep 10"],
+                                  timeout=0.5)
+        retcode, output = bundlebuilder.execute(
+            ["sh", "-c", "while true; do echo tick; sleep 0.1; done"],
+            timeout=0.5, idle_timeout=5, raise_exception=False)
+        assert retcode != 0
+        assert "tick" in output
+        assert "timed out after 0.5 seconds" in output
+
+    def test_idle_timeout(self):
+        with self.assertRaises(bundlebuilder.CommandTimeout):
+            bundlebuilder.execute(["sh", "-c", "echo start; sleep 10"],
+                                  idle_timeout=0.5)
+
+    def test_bounded_output(self):
+        log_dir = mkdtemp()
+        self.addCleanup(rmtree, log_dir)
+        log_file = os.path.join(log_dir, 'build.log')
+        retcode, output = bundlebuilder.execute(
+            ["seq", "100000"], echo=False, log_file=log_file, max_output=100)
+        self.assertEqual(len(output), 100)
+        assert output.endswith("99999\n100000\n")
+        with open(log_file) as fp:
+            self.assertEqual(fp.read(), "\n".join(
+                str(i) for i in range(1, 100001)) + "\n")
 
     def test_help(self):
         retcode, output = bundlebuilder.execute(
@@ -49,7 +82,226 @@ class TestBundlebuilder(unittest.TestCase):
         assert "cs:~me/ubuntu" == charm.get_namespace_name_revision()
         charm.release_latest("edge", "beta")
         print(execute_mock.call_count)
-        assert execute_mock.call_count is 4
+        # show, release and grant of the revision shown
+        assert execute_mock.call_count == 3
+
+    @patch('scripts.bundlebuilder.sleep')
+    @patch('scripts.bundlebuilder.execute')
+    def test_release_charms(self, execute_mock, sleep_mock):
+        def charm(cmd, **kwargs):
+            if cmd[2] == 'cs:~me/flaky-1' and flaky:
+                flaky.pop()
+                raise Exception("store error")
+            if cmd[2] == 'cs:~me/broken-1':
+                raise bundlebuilder.CommandFailed(
+                    cmd, 1, "Connecting\nERROR cannot release: denied\n")
+            return 0, ""
+        execute_mock.side_effect = charm
+        flaky = [True, True]
+        coordinator = bundlebuilder.Coordinator()
+        releases = [
+            (bundlebuilder.Charm("cs:~me/" + name), "cs:~me/{}-1".format(name),
+             "stable")
+            for name in ("ubuntu", "flaky", "broken")]
+        with patch('builtins.print') as print_mock:
+            with self.assertRaises(Exception) as cm:
+                coordinator.release_charms(releases)
+        self.assertEqual(str(cm.exception),
+                         "Failed to release cs:~me/broken-1")
+        # the store's error makes it to the summary
+        printed = [call[0][0] for call in print_mock.call_args_list]
+        self.assertIn("    ERROR cannot release: denied", printed)
+        released = [cmd[0][0][2] for cmd in execute_mock.call_args_list
+                    if cmd[0][0][1] == "release"]
+        self.assertEqual(released.count("cs:~me/ubuntu-1"), 1)
+        self.assertEqual(released.count("cs:~me/flaky-1"), 3)
+        self.assertEqual(sleep_mock.call_count, 2 + 4)
+
+    @patch('scripts.bundlebuilder.execute')
+    def test_revision_resolver(self, execute_mock):
+        execute_mock.side_effect = lambda cmd, echo, **kwargs: (
+            0, "id:\n Id: {}-{}".format(cmd[2], cmd[4]))
+        resolver = bundlebuilder.RevisionResolver()
+        ubuntu = bundlebuilder.Charm("cs:~me/ubuntu-1")
+        mysql = bundlebuilder.Charm("cs:~me/mysql")
+        revisions = resolver.resolve([(ubuntu, "edge"), (mysql, "edge"),
+                                      (ubuntu, "edge"), (ubuntu, "beta")])
+        self.assertEqual(revisions, ["cs:~me/ubuntu-edge",
+                                     "cs:~me/mysql-edge",
+                                     "cs:~me/ubuntu-edge",
+                                     "cs:~me/ubuntu-beta"])
+        self.assertEqual(resolver.get_latest(ubuntu, "edge"),
+                         "cs:~me/ubuntu-edge")
+        assert execute_mock.call_count == 3
+
+    @patch('scripts.bundlebuilder.execute')
+    def test_revision_resolver_error(self, execute_mock):
+        execute_mock.side_effect = bundlebuilder.CommandFailed(
+            ["charm", "show"], 1, "ERROR cannot get info: not found\n")
+        resolver = bundlebuilder.RevisionResolver()
+        with self.assertRaises(Exception) as cm:
+            resolver.get_latest(bundlebuilder.Charm("cs:~me/gone"), "edge")
+        self.assertEqual(str(cm.exception),
+                         "Failed to look up cs:~me/gone in edge: "
+                         "ERROR cannot get info: not found")
+
+    def test_fetch_git_mirror(self):
+        root = mkdtemp()
+        self.addCleanup(rmtree, root)
+        origin = os.path.join(root, 'origin')
+        git = ['git', '-c', 'user.name=me', '-c', 'user.email=me@example.com',
+               '-C', origin]
+        bundlebuilder.execute(['git', 'init', '-q', '-b', 'main', origin])
+        Path(origin, 'bundle.yaml').write_text('services: {}\n')
+        bundlebuilder.execute(git + ['add', '.'])
+        bundlebuilder.execute(git + ['commit', '-q', '-m', 'one'])
+
+        mirror_dir = os.path.join(root, 'mirrors')
+        with patch('scripts.bundlebuilder.GIT_MIRROR_DIR', mirror_dir):
+            checkout = bundlebuilder.Fetcher.fetch(origin, 'main')
+            self.assertTrue(os.path.isfile(os.path.join(checkout,
+                                                        'bundle.yaml')))
+            bundlebuilder.Fetcher.cleanup(checkout)
+            self.assertFalse(os.path.exists(os.path.dirname(checkout)))
+
+            Path(origin, 'ci-info.yaml').write_text('{}\n')
+            bundlebuilder.execute(git + ['add', '.'])
+            bundlebuilder.execute(git + ['commit', '-q', '-m', 'two'])
+            checkout = bundlebuilder.Fetcher.fetch(origin, 'main')
+            self.addCleanup(bundlebuilder.Fetcher.cleanup, checkout)
+            self.assertTrue(os.path.isfile(os.path.join(checkout,
+                                                        'ci-info.yaml')))
+
+            # entries without a branch get the default one
+            Path(origin, 'README').write_text('three\n')
+            bundlebuilder.execute(git + ['add', '.'])
+            bundlebuilder.execute(git + ['commit', '-q', '-m', 'three'])
+            checkout = bundlebuilder.Fetcher.fetch(origin)
+            self.addCleanup(bundlebuilder.Fetcher.cleanup, checkout)
+            self.assertTrue(os.path.isfile(os.path.join(checkout, 'README')))
+        self.assertEqual(len(os.listdir(mirror_dir)), 2)  # mirror and lock
+
+    def make_bundles(self, subdirs, section='services'):
+        repo = mkdtemp()
+        self.addCleanup(rmtree, repo)
+        ci_info = ("bundle: {namespace: me, name: b, release: false}\n"
+                   "charm-upgrade:\n"
+                   "  ubuntu: {from-channel: edge, release: false}\n")
+        for subdir in subdirs:
+            Path(repo, subdir).mkdir()
+            Path(repo, subdir, 'bundle.yaml').write_text(
+                "%s:\n"
+                "  ubuntu: {charm: cs:~me/ubuntu-1}\n"
+                "  %s: {charm: cs:~me/%s-1}\n" % (section, subdir, subdir))
+            Path(repo, subdir, 'ci-info.yaml').write_text(ci_info)
+        return repo
+
+    @patch('scripts.bundlebuilder.execute')
+    def test_check_all(self, execute_mock):
+        execute_mock.side_effect = lambda cmd, echo, **kwargs: (
+            0, "id:\n Id: {}-2".format(cmd[2]))
+        repo = self.make_bundles(('one', 'two'))
+        state_dir = mkdtemp()
+        self.addCleanup(rmtree, state_dir)
+        entries = [
+            {'repo': 'local:' + repo, 'subdir': 'one', 'name': 'one'},
+            {'repo': 'local:' + repo, 'subdir': 'two', 'name': 'two'},
+            {'repo': 'local:' + repo, 'subdir': 'missing', 'name': 'bad'},
+        ]
+        fetch = bundlebuilder.Fetcher.fetch
+        with patch('scripts.bundlebuilder.Fetcher.fetch',
+                   side_effect=fetch) as fetch_mock:
+            coordinator = bundlebuilder.Coordinator()
+            to_build, errors = coordinator.check_all(entries, state_dir)
+        self.assertEqual(to_build, entries[:2])
+        self.assertEqual([e['name'] for e in errors], ['bad'])
+        assert fetch_mock.call_count == 1
+        assert execute_mock.call_count == 1
+        self.assertTrue(os.path.isfile(os.path.join(state_dir, 'one.json')))
+
+        # Nothing changed since, so nothing to build
+        coordinator = bundlebuilder.Coordinator()
+        to_build, errors = coordinator.check_all(entries[:2], state_dir)
+        self.assertEqual(to_build, [])
+
+    @patch('scripts.bundlebuilder.execute')
+    def test_check_all_malformed_bundle(self, execute_mock):
+        execute_mock.side_effect = lambda cmd, echo, **kwargs: (
+            0, "id:\n Id: {}-2".format(cmd[2]))
+        repo = self.make_bundles(('one', 'two'))
+        # a bundle using applications: where services: is expected
+        bad_repo = self.make_bundles(('three',), section='applications')
+        state_dir = mkdtemp()
+        self.addCleanup(rmtree, state_dir)
+        entries = [
+            {'repo': 'local:' + repo, 'subdir': 'one', 'name': 'one'},
+            {'repo': 'local:' + bad_repo, 'subdir': 'three', 'name': 'three'},
+            {'repo': 'local:' + repo, 'subdir': 'two', 'name': 'two'},
+        ]
+        coordinator = bundlebuilder.Coordinator()
+        to_build, errors = coordinator.check_all(entries, state_dir)
+        self.assertEqual(to_build, [entries[0], entries[2]])
+        self.assertEqual([e['name'] for e in errors], ['three'])
+        self.assertIn('services', errors[0]['error'])
+
+    def test_signature_is_canonical(self):
+        with patch("builtins.open", mock_open(read_data="services: {}")):
+            bundle = bundlebuilder.Bundle("local:/nowhere", None, ".",
+                                          "myci-info.yaml", checkout="/tmp")
+        bundle.bundle = {'services': {
+            'a': {'charm': 'cs:~me/a-1', 'num_units': 1},
+            'b': {'charm': '~me/b-2'}}}
+        signature = bundle.get_current_signature()
+        bundle.bundle = {'services': {
+            'b': {'charm': 'cs:~me/b-2'},
+            'a': {'num_units': 1, 'charm': 'cs:~me/a-1'}}}
+        self.assertEqual(bundle.get_current_signature(), signature)
+        bundle.bundle['services']['a']['charm'] = 'cs:~me/a-2'
+        self.assertNotEqual(bundle.get_current_signature(), signature)
+
+    def test_signature_history(self):
+        state_dir = mkdtemp()
+        self.addCleanup(rmtree, state_dir)
+        history = bundlebuilder.SignatureHistory(
+            os.path.join(state_dir, 'tested.json'))
+        self.assertTrue(history.add('A', 'triggered'))
+        self.assertTrue(history.add('B', 'triggered'))
+        # flipping back to an already tested combination
+        self.assertFalse(history.add('A', 'triggered'))
+        self.assertFalse(history.add('A', 'pass', build='3'))
+        self.assertFalse(history.add('A', 'triggered'))
+        self.assertEqual(history.get('A')['outcome'], 'pass')
+        self.assertEqual(history.get('A')['build'], '3')
+        self.assertIsNone(history.get('C'))
+
+    def test_signature_history_seeded_from_legacy_file(self):
+        repo = self.make_bundles(['a', 'b'])
+        state_dir = mkdtemp()
+        self.addCleanup(rmtree, state_dir)
+        legacy_file = os.path.join(state_dir, 'last_bundle.signature')
+
+        def load(subdir):
+            return bundlebuilder.Bundle(
+                repo, None, subdir, checkout=repo,
+                history_file=os.path.join(state_dir, subdir + '.json'),
+                legacy_signature_file=legacy_file)
+
+        with load('a') as bundle:
+            bundle.upgrade('cs:~me/ubuntu-1', 'cs:~me/ubuntu-2')
+            # built by an earlier version
+            Path(legacy_file).write_text(bundle.get_legacy_signature())
+            self.assertFalse(bundle.should_trigger_build())
+            self.assertFalse(os.path.exists(legacy_file))
+            self.assertTrue(bundle.history.get(
+                bundle.get_current_signature())['migrated'])
+            bundle.upgrade('cs:~me/ubuntu-2', 'cs:~me/ubuntu-3')
+            self.assertTrue(bundle.should_trigger_build())
+
+        with load('b') as bundle:
+            bundle.upgrade('cs:~me/ubuntu-1', 'cs:~me/ubuntu-2')
+            Path(legacy_file).write_text('0' * 40)
+            self.assertTrue(bundle.should_trigger_build())
+            self.assertFalse(os.path.exists(legacy_file))
 
     def test_parse_args_check(self):
         args = bundlebuilder.parse_args(
@@ -62,6 +314,17 @@ class TestBundlebuilder(unittest.TestCase):
         )
         self.assertEqual(args, expected_args)
 
+    def test_parse_args_check_all(self):
+        args = bundlebuilder.parse_args(
+            ['check-all', 'bundles.yaml', '--output', 'build.json'])
+        expected_args = argparse.Namespace(
+            operation='check-all',
+            manifest='bundles.yaml',
+            state_dir='.',
+            output='build.json',
+        )
+        self.assertEqual(args, expected_args)
+
     def test_parse_args_build(self):
         args = bundlebuilder.parse_args(
             ['build', 'github.com/foo', 'master', '.', '1', 'model1',
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import os
+import sys
+import unittest
+from functools import partial
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import mock
+
+# the gateway imports its siblings the way gunicorn runs it
+sys.path.append('lib')
+with mock.patch('logging.basicConfig'):
+    from lib import CIGWServer  # noqa: E402
+import artifacts  # noqa: E402
+
+
+class TestGateway(unittest.TestCase):
+    """The gateway routes, with Jenkins and /srv/artifacts stubbed out."""
+
+    def setUp(self):
+        self.root = os.path.realpath(mkdtemp())
+        self.addCleanup(rmtree, self.root)
+        self.jenkins = mock.Mock()
+        self.progressive = mock.Mock()
+        patches = [
+            mock.patch.object(CIGWServer, 'ARTIFACTS_DIR', self.root),
+            mock.patch.object(CIGWServer, 'get_latest_build',
+                              partial(artifacts.get_latest_build,
+                                      root=self.root)),
+            mock.patch.object(CIGWServer, 'read_manifest',
+                              partial(artifacts.read_manifest,
+                                      root=self.root)),
+            mock.patch.object(CIGWServer, 'read_offloaded',
+                              partial(artifacts.read_offloaded,
+                                      root=self.root)),
+            mock.patch.object(CIGWServer, 'badge_cache',
+                              CIGWServer.BadgeCache()),
+            mock.patch.object(CIGWServer, 'manifest_cache',
+                              CIGWServer.ManifestCache()),
+            mock.patch.object(CIGWServer, 'get_jenkins_client',
+                              lambda: self.jenkins),
+            mock.patch.object(CIGWServer, 'get_progressive_console',
+                              self.progressive),
+            mock.patch.object(CIGWServer, 'CONSOLE_POLL_SECS', 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = CIGWServer.app.test_client()
+
+    def make_build(self, job, build, files, finished=True):
+        build_dir = Path(self.root) / job / str(build)
+        for path, content in files.items():
+            (build_dir / path).parent.mkdir(parents=True, exist_ok=True)
+            (build_dir / path).write_bytes(content)
+        if finished:
+            artifacts.update_latest_build(job, build, root=self.root)
+        return build_dir
+
+    def test_badge_revalidation(self):
+        build_dir = self.make_build('job', 1, {
+            'report.json': json.dumps({'results': [
+                {'provider': 'aws', 'test_outcome': 'PASS'}]}).encode()})
+        response = self.client.get('/job/build-badge.svg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, 'image/svg+xml')
+        etag = response.headers['ETag']
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+
+        response = self.client.get('/job/build-badge.svg',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # a new report is picked up once the badge is checked again
+        CIGWServer.badge_cache.recheck_secs = 0
+        report = build_dir / 'report.json'
+        report.write_text(json.dumps({'results': [
+            {'provider': 'aws', 'test_outcome': 'FAIL'}]}))
+        os.utime(str(report), (1, 1))
+        response = self.client.get('/job/build-badge.svg',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_badge_results_override(self):
+        response = self.client.get('/job/build-badge.svg?results=aws-PASS')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response.headers)
+        self.assertIn(b'aws', response.data)
+        # made up results are never cached
+        self.assertEqual(CIGWServer.badge_cache._badges, {})
+
+    def test_artifact_range(self):
+        self.make_build('job', 1, {'cwr.log': b'0123456789'})
+        response = self.client.get('/job/1/cwr.log',
+                                   headers={'Range': 'bytes=2-5'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b'2345')
+        self.assertEqual(self.client.get('/job/1/missing').status_code, 404)
+        self.assertEqual(self.client.get('/job/1/../../etc/passwd')
+                         .status_code, 404)
+
+    def test_precompressed_artifact(self):
+        self.make_build('job', 1, {'cwr.log': b'plain',
+                                   'cwr.log.gz': gzip.compress(b'plain')})
+        response = self.client.get('/job/1/cwr.log',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(gzip.decompress(response.data), b'plain')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+        response = self.client.get('/job/1/cwr.log')
+        self.assertIsNone(response.content_encoding)
+        self.assertEqual(response.data, b'plain')
+
+    def test_progressive_output(self):
+        self.progressive.return_value = ('line\n', 5, True)
+        response = self.client.get(
+            CIGWServer.rest_path + '/build-output/job/1/progressive?start=0')
+        self.assertEqual(json.loads(response.get_data(as_text=True)),
+                         {'text': 'line\n', 'next': 5, 'more': True})
+        self.progressive.assert_called_once_with(self.jenkins, 'job', 1, 0)
+
+    def test_stream_output(self):
+        self.progressive.side_effect = [
+            ('one\ntw', 6, True),
+            ('o\n', 8, False),
+        ]
+        response = self.client.get(
+            CIGWServer.rest_path + '/build-output/job/1/stream',
+            headers={'Last-Event-ID': '0'})
+        self.assertEqual(response.content_type,
+                         'text/event-stream; charset=utf-8')
+        # the unfinished line is held back, and the ids are the offsets
+        # of what was sent
+        self.assertEqual(response.get_data(as_text=True),
+                         'id: 4\ndata: one\n\n'
+                         'id: 8\ndata: two\n\n'
+                         'event: end\nid: 8\ndata: \n\n')
+        self.assertEqual([c[0][3] for c in self.progressive.call_args_list],
+                         [0, 6])
+
+    def test_manifest_pages(self):
+        self.make_build('job', 1, {'a': b'a', 'b/c': b'c', 'd': b'd'})
+        url = CIGWServer.rest_path + '/build-artifacts/job/1/'
+        page = json.loads(self.client.get(url + '?limit=2')
+                          .get_data(as_text=True))
+        self.assertEqual([f['path'] for f in page['files']], ['a', 'b/c'])
+        self.assertEqual((page['total'], page['next']), (3, 2))
+        self.assertIn('sha256', page['files'][0])
+
+        page = json.loads(self.client.get(url + '?offset=2&limit=2')
+                          .get_data(as_text=True))
+        self.assertEqual([f['path'] for f in page['files']], ['d'])
+        self.assertIsNone(page['next'])
+        self.assertEqual(
+            self.client.get(url.replace('/1/', '/2/')).status_code, 404)
+
+    def test_offloaded_artifact(self):
+        build_dir = self.make_build('job', 1, {'logs/a b.txt': b'a'})
+        self.make_build('job', 2, {'report.json': b'{}'})
+        rmtree(str(build_dir))
+        artifacts.write_offloaded('job', 1, {
+            'bucket': 'bucket',
+            'key': 'cwr/job/1',
+            'url': 'https://s3.example.com/bucket/cwr/job/1',
+        }, root=self.root)
+
+        response = self.client.get('/job/1/logs/a b.txt')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.headers['Location'],
+                         'https://s3.example.com/bucket/cwr/job/1/logs/'
+                         'a%20b.txt')
+        self.assertEqual(self.client.get('/job/3/logs/a').status_code, 404)
+
+        # the manifest of the removed build is still served
+        page = json.loads(self.client.get(
+            CIGWServer.rest_path + '/build-artifacts/job/1/')
+            .get_data(as_text=True))
+        self.assertEqual([f['path'] for f in page['files']],
+                         ['logs/a b.txt'])
+
+
+class TestJenkinsClientCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.addCleanup(rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'CIGWServer.properties')
+
+    def write_properties(self, url, mtime):
+        Path(self.path).write_text('{}\nadmin\nsecret\n'.format(url))
+        os.utime(self.path, (mtime, mtime))
+
+    @mock.patch.object(CIGWServer, 'InstrumentedJenkins')
+    def test_client_reused_until_properties_change(self, jenkins_mock):
+        jenkins_mock.side_effect = lambda url, *args, **kwargs: mock.Mock(
+            server=url)
+        cache = CIGWServer.JenkinsClientCache(self.path)
+        self.write_properties('http://jenkins-a/', 1)
+        client = cache.get()
+        self.assertIs(cache.get(), client)
+        self.assertEqual(jenkins_mock.call_args[0],
+                         ('http://jenkins-a/', 'admin', 'secret'))
+        # one session, with a pool for the concurrent workers
+        client._session.mount.assert_called_once_with(
+            'http://jenkins-a/', mock.ANY)
+
+        self.write_properties('http://jenkins-b/', 2)
+        self.assertEqual(cache.get().server, 'http://jenkins-b/')
+        self.assertEqual(jenkins_mock.call_count, 2)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from shutil import rmtree
+from subprocess import CalledProcessError
+from tempfile import mkdtemp
+
+from lib.containerpool import ContainerPool
+
+
+class FakeLxc:
+    """Stand-in for the lxc CLI, keeping track of containers."""
+
+    def __init__(self, fingerprint='abc'):
+        self.fingerprint = fingerprint
+        self.containers = set()
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append(args)
+        if args[:2] == ('image', 'info'):
+            if not self.fingerprint:
+                raise CalledProcessError(1, 'lxc', 'not found')
+            return 'Fingerprint: {}\nSize: 200MB\n'.format(self.fingerprint)
+        if args[0] == 'init':
+            self.containers.add(args[2])
+        elif args[0] == 'delete':
+            self.containers.discard(args[2])
+        elif args[0] == 'info':
+            return 'Ips:\n  eth0:\tinet\t10.0.0.2\n'
+        return ''
+
+
+class TestContainerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        self.lxc = FakeLxc()
+        self.pool = ContainerPool(self.path, lxc=self.lxc)
+        os.makedirs(os.path.join(self.path, 'ready'))
+        os.makedirs(os.path.join(self.path, 'preparing'))
+        self.set_size(2)
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def set_size(self, size):
+        with open(os.path.join(self.path, 'size'), 'w') as fp:
+            fp.write(str(size))
+
+    def refill(self):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            return [f.result() for f in self.pool.refill(executor)]
+
+    def test_claim_empty_pool(self):
+        self.assertIsNone(self.pool.claim())
+        self.assertEqual(self.lxc.calls, [])
+
+    def test_refill_and_claim(self):
+        names = self.refill()
+        self.assertEqual(len(names), 2)
+        self.assertEqual(self.lxc.containers, set(names))
+        self.assertEqual(sorted(self.pool.ready()), sorted(names))
+        self.assertIn(('init', 'abc', names[0], '--ephemeral'),
+                      self.lxc.calls)
+        # the pool is full
+        self.assertEqual(self.refill(), [])
+
+        claimed = self.pool.claim()
+        self.assertIn(claimed, names)
+        self.assertNotIn(claimed, self.pool.ready())
+        self.assertIn(claimed, self.lxc.containers)
+        self.assertEqual(len(self.refill()), 1)
+
+    def test_claim_once(self):
+        self.set_size(1)
+        self.refill()
+        name = self.pool.claim()
+        self.assertIsNotNone(name)
+        self.assertFalse(self.pool.take(name))
+        self.assertIsNone(self.pool.claim())
+
+    def test_image_changed(self):
+        old = self.refill()
+        self.lxc.fingerprint = 'def'
+        # containers made from the old image are never handed out
+        self.assertIsNone(self.pool.claim())
+        self.assertEqual(self.lxc.containers, set())
+
+        self.refill()
+        self.lxc.fingerprint = 'ghi'
+        new = self.refill()
+        self.assertEqual(len(new), 2)
+        self.assertEqual(set(self.pool.ready()), set(new))
+        self.assertEqual(self.lxc.containers, set(new))
+        self.assertFalse(set(old) & set(new))
+
+    def test_too_old(self):
+        self.set_size(1)
+        name = self.refill()[0]
+        ready_file = os.path.join(self.path, 'ready', name)
+        with open(ready_file, 'w') as fp:
+            json.dump({'image': 'abc', 'ready': time.time() - 7 * 3600}, fp)
+        new = self.refill()
+        self.assertEqual(len(new), 1)
+        self.assertNotIn(name, self.lxc.containers)
+        self.assertEqual(list(self.pool.ready()), new)
+
+    def test_failed_prepare(self):
+        def lxc(*args):
+            if args[0] == 'start':
+                raise CalledProcessError(1, 'lxc', 'no space left')
+            return self.lxc(*args)
+        self.pool.lxc = lxc
+        with self.assertRaises(CalledProcessError):
+            self.refill()
+        self.assertEqual(self.lxc.containers, set())
+        self.assertEqual(self.pool.ready(), {})
+        self.assertEqual(os.listdir(os.path.join(self.path, 'preparing')), [])
+
+    def test_disabled(self):
+        self.refill()
+        self.set_size(0)
+        self.pool.cleanup()
+        self.assertEqual(self.pool.ready(), {})
+        self.assertEqual(self.lxc.containers, set())
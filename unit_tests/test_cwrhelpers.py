@@ -17,9 +17,11 @@ sys.modules['charms.layer'] = layer_mock
 sys.modules['charms.layer.basic'] = layer_mock
 sys.modules['charms.layer.basic.activate_venv'] = layer_mock
 
+from actions.cwrhelpers import ActionError             # noqa: E402
 from actions.cwrhelpers import get_s3_credentials      # noqa: E402
 from actions.cwrhelpers import get_s3_options          # noqa: E402
 from actions.cwrhelpers import create_s3_config_file   # noqa: E402
+from actions.cwrhelpers import wait_result             # noqa: E402
 
 
 class TestS3Credentials(TestCase):
@@ -101,42 +103,39 @@ class TestS3Credentials(TestCase):
     def test_get_s3_credentials_empty(self):
         with patch('subprocess.check_output', autospec=True,
                    return_value=self.fake_creds_empty) as co_mock:
-            with patch('actions.cwrhelpers.fail_action', autospec=True,
-                       side_effect=SystemExit) as fa_mock:
-                with self.assertRaises(SystemExit):
-                    get_s3_credentials()
+            with self.assertRaises(ActionError) as cm:
+                get_s3_credentials()
         co_mock.assert_called_once_with(
             ['sudo', '-H', '-u', 'jenkins', '--', 'juju', 'credentials', 'aws',
              '--format', 'yaml', '--show-secrets'])
-        fa_mock.assert_called_once_with(
+        self.assertEqual(
+            str(cm.exception),
             'AWS credentials not found. Set AWS credentials by running '
             '"set-credentials" action.')
 
     def test_get_s3_credentials_no_aws(self):
         with patch('subprocess.check_output', autospec=True,
                    return_value=self.fake_creds_no_aws) as co_mock:
-            with patch('actions.cwrhelpers.fail_action', autospec=True,
-                       side_effect=SystemExit) as fa_mock:
-                with self.assertRaises(SystemExit):
-                    get_s3_credentials()
+            with self.assertRaises(ActionError) as cm:
+                get_s3_credentials()
         co_mock.assert_called_once_with(
             ['sudo', '-H', '-u', 'jenkins', '--', 'juju', 'credentials', 'aws',
              '--format', 'yaml', '--show-secrets'])
-        fa_mock.assert_called_once_with(
+        self.assertEqual(
+            str(cm.exception),
             'AWS credentials not found. Set AWS credentials by running '
             '"set-credentials" action.')
 
     def test_get_s3_credentials_no_default(self):
         with patch('subprocess.check_output', autospec=True,
                    return_value=self.fake_creds_no_default) as co_mock:
-            with patch('actions.cwrhelpers.fail_action', autospec=True,
-                       side_effect=SystemExit) as fa_mock:
-                with self.assertRaises(SystemExit):
-                    get_s3_credentials()
+            with self.assertRaises(ActionError) as cm:
+                get_s3_credentials()
         co_mock.assert_called_once_with(
             ['sudo', '-H', '-u', 'jenkins', '--', 'juju', 'credentials', 'aws',
              '--format', 'yaml', '--show-secrets'])
-        fa_mock.assert_called_once_with(
+        self.assertEqual(
+            str(cm.exception),
             'Credentials not found. Set AWS credentials by running '
             '"set-credentials" action.')
 
@@ -193,6 +192,11 @@ class TestGetS3Options(TestCase):
              '--format', 'yaml', '--show-secrets'])
         sc_mock.assert_called_once_with(s3_config.name, 'jenkins', 'jenkins')
 
+    def test_get_s3_options_no_results_dir(self):
+        params = {'bucket': 'bucket-foo', 'results-dir': ''}
+        with self.assertRaises(ActionError):
+            get_s3_options(None, None, params.get)
+
     def test_get_s3_options_no_bucket(self):
         with patch('actions.cwrhelpers.hookenv', autospec=True) as ch_mock:
             ch_mock.action_get.return_value = ''
@@ -200,6 +204,56 @@ class TestGetS3Options(TestCase):
         self.assertEqual(s3_option, '')
 
 
+class TestWaitResult(TestCase):
+
+    def test_wait_from_queue(self):
+        jclient = Mock()
+        jclient.get_queue_item.side_effect = [
+            {'why': 'Waiting for next available executor'},
+            {'executable': {'number': 7}},
+        ]
+        jclient.get_build_info.return_value = {'building': False,
+                                               'result': 'SUCCESS'}
+        console = [('a' * 10, 10, True), ('', 10, True), ('b' * 5, 15, False)]
+        with patch('actions.cwrhelpers.get_progressive_console',
+                   side_effect=console) as console_mock, \
+                patch('actions.cwrhelpers.time.sleep') as sleep_mock:
+            outcome, output = wait_result(jclient, 'job', queue_item=3,
+                                          tail_chars=8)
+        self.assertEqual(outcome, 'success')
+        self.assertEqual(output, 'aaabbbbb')
+        jclient.get_queue_item.assert_called_with(3)
+        self.assertEqual([c[0][3] for c in console_mock.call_args_list],
+                         [0, 10, 10])
+        # backs off while idle, polls again quickly on new output
+        self.assertEqual([c[0][0] for c in sleep_mock.call_args_list],
+                         [0.5, 0.5, 1])
+
+    def test_running_build_is_not_success(self):
+        jclient = Mock()
+        jclient.get_build_info.side_effect = [
+            {'building': True, 'result': None},
+            {'building': False, 'result': 'FAILURE'},
+        ]
+        with patch('actions.cwrhelpers.get_progressive_console',
+                   return_value=('done', 4, False)), \
+                patch('actions.cwrhelpers.time.sleep'):
+            outcome, output = wait_result(jclient, 'job', 7)
+        self.assertEqual(outcome, 'fail')
+        self.assertEqual(output, 'done')
+
+    def test_timeout(self):
+        jclient = Mock()
+        with patch('actions.cwrhelpers.get_progressive_console',
+                   return_value=('', 0, True)), \
+                patch('actions.cwrhelpers.time.time',
+                      side_effect=[0, 1, 100]), \
+                patch('actions.cwrhelpers.time.sleep'):
+            with self.assertRaises(Exception) as cm:
+                wait_result(jclient, 'job', 7, secs_to_wait=60)
+        self.assertIn('Job timeout', str(cm.exception))
+
+
 def fake_action_get(key):
     if key == "credential-name":
         return "cred1"
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import os
+import stat
+import sys
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest.mock import Mock, patch
+
+from jenkins import JenkinsException
+
+# jenkinsjobs imports its siblings the way the actions do
+sys.path.append('lib')
+from lib.jenkinsjobs import (  # noqa: E402
+    JobSpec,
+    normalize_config,
+    reconcile_jobs,
+    record_job,
+    recorded_jobs,
+)
+
+
+CONFIG = """<?xml version='1.1' encoding='UTF-8'?>
+<project>
+  <description>Test a charm</description>
+  <builders>
+    <hudson.tasks.Shell plugin="shell" id="1">
+      <command>run-tests</command>
+    </hudson.tasks.Shell>
+  </builders>
+</project>
+"""
+
+
+class TestNormalizeConfig(unittest.TestCase):
+
+    def test_formatting_is_ignored(self):
+        other = ('<project><description>Test a charm  </description>'
+                 '<builders><hudson.tasks.Shell id="1" plugin="shell">'
+                 '<command>run-tests</command></hudson.tasks.Shell>'
+                 '</builders></project>')
+        self.assertEqual(normalize_config(CONFIG), normalize_config(other))
+
+    def test_changes_are_detected(self):
+        other = CONFIG.replace('run-tests', 'run-other-tests')
+        self.assertNotEqual(normalize_config(CONFIG), normalize_config(other))
+        other = CONFIG.replace('id="1"', 'id="2"')
+        self.assertNotEqual(normalize_config(CONFIG), normalize_config(other))
+
+
+class TestReconcileJobs(unittest.TestCase):
+
+    def test_reconcile_jobs(self):
+        jclient = Mock()
+        jclient.get_jobs.return_value = [
+            {'name': 'unchanged'}, {'name': 'changed'}, {'name': 'broken'},
+            {'name': 'unmanaged'}]
+        configs = {
+            'unchanged': CONFIG.replace('\n', ''),
+            'changed': CONFIG.replace('run-tests', 'old-tests'),
+        }
+        jclient.get_job_config.side_effect = lambda name: configs[name]
+
+        results = reconcile_jobs(jclient, {
+            'unchanged': CONFIG,
+            'changed': CONFIG,
+            'broken': CONFIG,
+            'new': CONFIG,
+        })
+
+        self.assertEqual(results['unchanged'], 'unchanged')
+        self.assertEqual(results['changed'], 'updated')
+        self.assertEqual(results['new'], 'created')
+        self.assertIsInstance(results['broken'], KeyError)
+        jclient.reconfig_job.assert_called_once_with('changed', CONFIG)
+        jclient.create_job.assert_called_once_with('new', CONFIG)
+        jclient.delete_job.assert_not_called()
+
+    def test_failures_are_reported_per_job(self):
+        jclient = Mock()
+        jclient.get_jobs.return_value = []
+        jclient.create_job.side_effect = JenkinsException('boom')
+        results = reconcile_jobs(jclient, {'a': CONFIG}, max_workers=1)
+        self.assertIsInstance(results['a'], JenkinsException)
+
+
+class TestJobRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.path = os.path.join(self.tempdir, 'jobs.json')
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_missing_registry(self):
+        self.assertEqual(recorded_jobs(self.path), [])
+
+    def test_record_job(self):
+        record_job(JobSpec('b', 'BuildMyBundle/config-build.xml',
+                           {'repo': 'old'}), self.path)
+        record_job(JobSpec('a', 'BuildMyCharm/config.xml',
+                           {'gitrepo': 'repo'}), self.path)
+        record_job(JobSpec('b', 'BuildMyBundle/config-build.xml',
+                           {'repo': 'new'}), self.path)
+        self.assertEqual(recorded_jobs(self.path), [
+            JobSpec('a', 'BuildMyCharm/config.xml', {'gitrepo': 'repo'}),
+            JobSpec('b', 'BuildMyBundle/config-build.xml', {'repo': 'new'}),
+        ])
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+    def test_render(self):
+        job = JobSpec('a', 'BuildMyCharm/config.xml', {'gitrepo': 'repo'})
+        with patch('lib.jenkinsjobs.templating.render',
+                   return_value=CONFIG) as render, \
+                patch('lib.jenkinsjobs.get_output_scenarios',
+                      return_value='--scenarios'):
+            self.assertEqual(job.render(), CONFIG)
+        render.assert_called_once_with(
+            source='BuildMyCharm/config.xml', target=None,
+            context={'gitrepo': 'repo', 'output_scenarios': '--scenarios'})
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from lib.metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.describe('hits_total', 'Hits.')
+        metrics.inc('hits_total', route='/a')
+        metrics.inc('hits_total', 2, route='/a')
+        metrics.observe('latency_seconds', 0.5)
+        metrics.observe('latency_seconds', 5)
+        lines = metrics.render().splitlines()
+        self.assertIn('# HELP hits_total Hits.', lines)
+        self.assertIn('hits_total{route="/a"} 3', lines)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('latency_seconds_sum 5.5', lines)
+        self.assertIn('latency_seconds_count 2', lines)
+
+    def test_render_sums_worker_snapshots(self):
+        snapshot_dir = mkdtemp()
+        try:
+            other_worker = Metrics(snapshot_dir)
+            other_worker.inc('hits_total')
+            other_worker.write_snapshot()
+            own_snapshot = '{}.json'.format(os.getpid())
+            os.rename(os.path.join(snapshot_dir, own_snapshot),
+                      os.path.join(snapshot_dir, '1.json'))
+
+            metrics = Metrics(snapshot_dir)
+            metrics.inc('hits_total')
+            self.assertIn('hits_total 2', metrics.render().splitlines())
+        finally:
+            rmtree(snapshot_dir)
+
+    def test_render_without_snapshot_dir(self):
+        snapshot_dir = mkdtemp()
+        rmtree(snapshot_dir)
+        metrics = Metrics(snapshot_dir)
+        metrics.inc('hits_total')
+        self.assertIn('hits_total 1', metrics.render().splitlines())
+
+    def test_counters_survive_recycled_workers(self):
+        snapshot_dir = mkdtemp()
+        try:
+            metrics = Metrics(snapshot_dir, buckets=(1.0,))
+            metrics.inc('hits_total', 2)
+            old = time.time() - 60
+            for pid in (1, 2):
+                path = os.path.join(snapshot_dir, '{}.json'.format(pid))
+                with open(path, 'w') as fp:
+                    json.dump({
+                        'counters': [['hits_total', [], pid]],
+                        'histograms': [['latency_seconds', [], [1, 0, 0.5]]],
+                    }, fp)
+                os.utime(path, (old, old))
+            lines = metrics.render().splitlines()
+            self.assertIn('hits_total 5', lines)
+            self.assertIn('latency_seconds_count 2', lines)
+            self.assertEqual(sorted(os.listdir(snapshot_dir)),
+                             ['.retired.lock', 'retired.json'])
+
+            # and again, once the retired totals are all that is left
+            lines = metrics.render().splitlines()
+            self.assertIn('hits_total 5', lines)
+            self.assertIn('latency_seconds_sum 1.0', lines)
+        finally:
+            rmtree(snapshot_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
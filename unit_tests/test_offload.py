@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp
+from uuid import uuid4
+
+# offload imports its siblings the way the gateway does
+sys.path.append('lib')
+from lib.artifacts import read_offloaded, write_manifest  # noqa: E402
+from lib.offload import (  # noqa: E402
+    Offloader,
+    OffloadError,
+    get_bucket_url,
+    read_config,
+    write_config,
+)
+
+
+class FakeS3:
+    """In-memory stand-in for the part of the S3 API the offloader uses."""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.calls = []
+        self.fail_parts = set()
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        with self.lock:
+            self.calls.append(('put_object', Key))
+            self.objects[(Bucket, Key)] = Body.read()
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = uuid4().hex
+        with self.lock:
+            self.calls.append(('create_multipart_upload', Key))
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self.lock:
+            self.calls.append(('upload_part', Key, PartNumber))
+            if PartNumber in self.fail_parts:
+                self.fail_parts.remove(PartNumber)
+                raise IOError('Connection reset')
+            self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': '"{}"'.format(PartNumber)}
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0):
+        parts = self.uploads[UploadId]
+        return {'Parts': [{'PartNumber': n, 'ETag': '"{}"'.format(n)}
+                          for n in sorted(parts) if n > PartNumberMarker]}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [p['PartNumber'] for p in MultipartUpload['Parts']]
+        self.objects[(Bucket, Key)] = b''.join(parts[n] for n in numbers)
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+
+class TestOffloader(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.state_dir = mkdtemp()
+        self.s3 = FakeS3()
+        self.offloader = Offloader(self.s3, 'bucket', prefix='cwr/',
+                                   root=self.root, state_dir=self.state_dir,
+                                   workers=4, part_size=10, retention_days=1,
+                                   url='https://s3.example.com/bucket')
+
+    def tearDown(self):
+        rmtree(self.root)
+        rmtree(self.state_dir)
+
+    def make_build(self, job, build, files, latest=True):
+        build_dir = Path(self.root) / job / str(build)
+        for path, content in files.items():
+            (build_dir / path).parent.mkdir(parents=True, exist_ok=True)
+            (build_dir / path).write_bytes(content)
+        if latest:
+            link = Path(self.root) / job / 'latest'
+            if os.path.lexists(str(link)):
+                link.unlink()
+            link.symlink_to(str(build))
+            write_manifest(job, build, self.root)
+        return build_dir
+
+    def test_pending_builds(self):
+        self.make_build('job', 1, {'report.json': b'{}'})
+        self.make_build('job', 2, {'report.json': b'{}'})
+        self.make_build('job', 3, {'report.json': b'{}'}, latest=False)
+        self.assertEqual(self.offloader.pending_builds(),
+                         [('job', 1), ('job', 2)])
+        self.offloader.offload_build('job', 1)
+        self.assertEqual(self.offloader.pending_builds(), [('job', 2)])
+
+    def test_offload_build(self):
+        big = bytes(range(25))
+        self.make_build('job', 1, {'report.json': b'{}', 'logs/big': big})
+        self.offloader.offload_build('job', 1)
+        self.assertEqual(self.s3.objects, {
+            ('bucket', 'cwr/job/1/report.json'): b'{}',
+            ('bucket', 'cwr/job/1/logs/big'): big,
+        })
+        parts = sorted(c[2] for c in self.s3.calls if c[0] == 'upload_part')
+        self.assertEqual(parts, [1, 2, 3])
+
+    def test_resume(self):
+        big = bytes(range(45))
+        self.make_build('job', 1, {'report.json': b'{}', 'big': big})
+        self.s3.fail_parts = {2, 4}
+        with self.assertRaises(OffloadError):
+            self.offloader.offload_build('job', 1)
+        self.assertNotIn(('bucket', 'cwr/job/1/big'), self.s3.objects)
+        self.assertEqual(self.offloader.pending_builds(), [('job', 1)])
+
+        self.s3.calls = []
+        self.offloader.offload_build('job', 1)
+        self.assertEqual(self.s3.objects[('bucket', 'cwr/job/1/big')], big)
+        # only the parts that failed are uploaded again, and the small
+        # file that made it is not
+        self.assertEqual(sorted(self.s3.calls), [
+            ('upload_part', 'cwr/job/1/big', 2),
+            ('upload_part', 'cwr/job/1/big', 4),
+        ])
+        self.assertEqual(self.offloader.pending_builds(), [])
+
+    def test_resume_unknown_upload(self):
+        self.make_build('job', 1, {'big': bytes(range(25))})
+        self.s3.fail_parts = {3}
+        with self.assertRaises(OffloadError):
+            self.offloader.offload_build('job', 1)
+        # the upload expired on the S3 side
+        self.s3.uploads.clear()
+        self.offloader.offload_build('job', 1)
+        self.assertEqual(self.s3.objects[('bucket', 'cwr/job/1/big')],
+                         bytes(range(25)))
+
+    def test_retention(self):
+        self.make_build('job', 1, {'report.json': b'{}'})
+        self.make_build('job', 2, {'report.json': b'{}'})
+        self.make_build('job', 3, {'report.json': b'{}'})
+        self.make_build('job', 4, {'report.json': b'{}'}, latest=False)
+        for build in (1, 2, 3):
+            self.offloader.offload_build('job', build)
+        old = time.time() - 2 * 24 * 3600
+        os.utime(os.path.join(self.state_dir, 'builds', 'job', '1.done'),
+                 (old, old))
+        os.utime(os.path.join(self.state_dir, 'builds', 'job', '3.done'),
+                 (old, old))
+
+        self.assertEqual(self.offloader.apply_retention(), [('job', 1)])
+        # build 2 was uploaded recently, build 3 is the latest one and
+        # build 4 is not uploaded yet
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'job'))),
+                         ['.1.manifest.json', '.1.offloaded.json',
+                          '.2.manifest.json', '.3.manifest.json',
+                          '2', '3', '4', 'latest'])
+        self.assertNotIn(('job', 1), self.offloader.pending_builds())
+        # the gateway redirects to where the removed build went
+        self.assertEqual(read_offloaded('job', 1, self.root), {
+            'bucket': 'bucket',
+            'key': 'cwr/job/1',
+            'url': 'https://s3.example.com/bucket/cwr/job/1',
+        })
+        self.assertIsNone(read_offloaded('job', 2, self.root))
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_config(self):
+        self.assertIsNone(read_config(self.path))
+        write_config({'bucket': ''}, self.path)
+        self.assertIsNone(read_config(self.path))
+        write_config({'bucket': 'b', 'secret-key': 's'}, self.path)
+        self.assertEqual(read_config(self.path)['bucket'], 'b')
+        mode = os.stat(os.path.join(self.path, 'config.json')).st_mode
+        self.assertEqual(mode & 0o777, 0o600)
+
+    def test_bucket_url(self):
+        self.assertEqual(get_bucket_url({'bucket': 'b'}),
+                         'https://s3.amazonaws.com/b')
+        self.assertEqual(get_bucket_url({'bucket': 'b',
+                                         'region': 'eu-west-1'}),
+                         'https://s3.eu-west-1.amazonaws.com/b')
+        self.assertEqual(get_bucket_url({'bucket': 'b',
+                                         'endpoint': 'http://minio:9000/'}),
+                         'http://minio:9000/b')
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest.mock import MagicMock, patch
+
+from lib.storecache import StoreCache
+
+
+class TestStoreCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_revision_ttl(self):
+        cache = StoreCache(self.path, ttl=60)
+        fetch = MagicMock(side_effect=['cs:foo-1', 'cs:foo-2'])
+        with patch('lib.storecache.time.time', return_value=1000):
+            self.assertEqual(
+                cache.get_revision('cs:foo', 'edge', fetch), 'cs:foo-1')
+            self.assertEqual(
+                cache.get_revision('cs:foo', 'edge', fetch), 'cs:foo-1')
+        self.assertEqual(fetch.call_count, 1)
+        with patch('lib.storecache.time.time', return_value=1061):
+            self.assertEqual(
+                cache.get_revision('cs:foo', 'edge', fetch), 'cs:foo-2')
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_revision_refresh(self):
+        cache = StoreCache(self.path, ttl=60)
+        cache.get_revision('cs:foo', 'edge', lambda: 'cs:foo-1')
+        self.assertEqual(
+            cache.get_revision('cs:foo', 'edge', lambda: 'cs:foo-2',
+                               refresh=True), 'cs:foo-2')
+        self.assertEqual(
+            cache.get_revision('cs:foo', 'edge', MagicMock()), 'cs:foo-2')
+        self.assertEqual(
+            cache.get_revision('cs:foo', 'stable', lambda: 'cs:foo-0'),
+            'cs:foo-0')
+
+    def test_revisioned_files_are_kept(self):
+        cache = StoreCache(self.path, ttl=0)
+        with patch('lib.storecache.time.time', return_value=1000):
+            cache.get_file('cs:bundle/foo-3', 'bundle.yaml', lambda: 'v3')
+            cache.get_file('cs:bundle/foo', 'bundle.yaml', lambda: 'v3')
+        with patch('lib.storecache.time.time', return_value=2000):
+            self.assertEqual(
+                cache.get_file('cs:bundle/foo-3', 'bundle.yaml', MagicMock()),
+                'v3')
+            self.assertEqual(
+                cache.get_file('cs:bundle/foo', 'bundle.yaml', lambda: 'v4'),
+                'v4')
+
+    def test_errors_are_not_cached(self):
+        cache = StoreCache(self.path)
+        fetch = MagicMock(side_effect=[KeyError('gone'), 'contents'])
+        with self.assertRaises(KeyError):
+            cache.get_file('cs:foo-1', 'tests/tests.yaml', fetch)
+        self.assertEqual(
+            cache.get_file('cs:foo-1', 'tests/tests.yaml', fetch), 'contents')
+
+    def test_missing_dir(self):
+        cache = StoreCache(self.path + '/missing')
+        fetch = MagicMock(return_value='cs:foo-1')
+        cache.get_revision('cs:foo', 'edge', fetch)
+        cache.get_revision('cs:foo', 'edge', fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_ttl_file(self):
+        with open(self.path + '/ttl', 'w') as ttl:
+            ttl.write('42')
+        self.assertEqual(StoreCache(self.path).ttl, 42)
+
+
+if __name__ == "__main__":
+    unittest.main()
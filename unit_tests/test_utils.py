@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from lib.utils import HookTokens
+
+
+class TestHookTokens(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.path = os.path.join(self.tempdir, 'tokens.yaml')
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_missing_file(self):
+        tokens = HookTokens(self.path)
+        self.assertIsNone(tokens.get('job'))
+
+    def test_add(self):
+        tokens = HookTokens(self.path)
+        token = tokens.add('job')
+        self.assertEqual(tokens.add('job'), token)
+        self.assertEqual(HookTokens(self.path).get('job'), token)
+
+    def test_add_keeps_other_writers_tokens(self):
+        first = HookTokens(self.path)
+        second = HookTokens(self.path)
+        token1 = first.add('job1')
+        token2 = second.add('job2')
+        self.assertEqual(first.get('job1'), token1)
+        self.assertEqual(first.get('job2'), token2)
+
+    def test_reload_on_change(self):
+        tokens = HookTokens(self.path)
+        self.assertIsNone(tokens.get('job'))
+        with open(self.path, 'w') as fp:
+            fp.write('job: abc\n')
+        self.assertEqual(tokens.get('job'), 'abc')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import json
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import mock
+
+from jenkins import NotFoundException
+
+from lib.webhooks import WebhookDispatcher, WebhookQueue
+
+
+class FakeJenkins:
+    """Stand-in for the Jenkins client, recording the builds triggered."""
+
+    def __init__(self):
+        self.builds = []
+        self.errors = {}
+
+    def build_job(self, job, params=None):
+        if job in self.errors:
+            raise self.errors[job]
+        self.builds.append((job, params))
+
+
+class TestWebhookQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        self.queue = WebhookQueue(self.path)
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_put(self):
+        first = self.queue.put('cwr_charm_commit_foo', {'RELEASE_TAG': ''})
+        second = self.queue.put('cwr_bundle_bar')
+        self.assertTrue(self.queue.wakeup.is_set())
+        pending = self.queue.pending()
+        self.assertEqual([p.name for p in pending],
+                         ['{}.json'.format(first), '{}.json'.format(second)])
+        event = json.loads(pending[0].read_text())
+        self.assertEqual(event['job'], 'cwr_charm_commit_foo')
+        self.assertEqual(event['params'], {'RELEASE_TAG': ''})
+        self.assertEqual(json.loads(pending[1].read_text())['params'], {})
+
+
+class TestWebhookDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        self.queue = WebhookQueue(self.path)
+        self.jenkins = FakeJenkins()
+        self.dispatcher = WebhookDispatcher(self.queue, lambda: self.jenkins)
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_drain(self):
+        self.queue.put('cwr_bundle_bar')
+        self.queue.put('cwr_charm_pr_foo', {'PR_ID': 1})
+        self.dispatcher.drain()
+        self.assertEqual(self.jenkins.builds, [
+            ('cwr_bundle_bar', None),
+            ('cwr_charm_pr_foo', {'PR_ID': 1}),
+        ])
+        self.assertEqual(self.queue.pending(), [])
+
+    def test_drain_merges_identical_events(self):
+        for _ in range(3):
+            self.queue.put('cwr_charm_pr_foo', {'PR_ID': 1})
+        self.queue.put('cwr_charm_pr_foo', {'PR_ID': 2})
+        self.dispatcher.drain()
+        self.assertEqual(self.jenkins.builds, [
+            ('cwr_charm_pr_foo', {'PR_ID': 1}),
+            ('cwr_charm_pr_foo', {'PR_ID': 2}),
+        ])
+        self.assertEqual(self.queue.pending(), [])
+
+    def test_backoff(self):
+        self.queue.put('cwr_bundle_bar')
+        self.queue.put('cwr_bundle_baz')
+        self.jenkins.errors['cwr_bundle_bar'] = IOError('Connection refused')
+        with mock.patch('lib.webhooks.time.time', return_value=1000):
+            self.dispatcher.drain()
+            self.assertEqual(self.jenkins.builds, [('cwr_bundle_baz', None)])
+            self.assertEqual(len(self.queue.pending()), 1)
+
+            # still backing off
+            del self.jenkins.errors['cwr_bundle_bar']
+            self.dispatcher.drain()
+            self.assertEqual(len(self.jenkins.builds), 1)
+
+        with mock.patch('lib.webhooks.time.time', return_value=1002):
+            self.dispatcher.drain()
+        self.assertEqual(self.jenkins.builds[-1], ('cwr_bundle_bar', None))
+        self.assertEqual(self.queue.pending(), [])
+
+    def test_backoff_grows(self):
+        self.queue.put('cwr_bundle_bar')
+        self.jenkins.errors['cwr_bundle_bar'] = IOError('Connection refused')
+        for now in (1000, 1001, 1003):
+            with mock.patch('lib.webhooks.time.time', return_value=now):
+                self.dispatcher.drain()
+        key = ('cwr_bundle_bar', '{}')
+        self.assertEqual(self.dispatcher._failures[key], (3, 1003 + 4))
+        self.assertEqual(len(self.queue.pending()), 1)
+
+    def test_missing_job(self):
+        self.queue.put('cwr_bundle_gone')
+        self.jenkins.errors['cwr_bundle_gone'] = NotFoundException()
+        self.dispatcher.drain()
+        self.assertEqual(self.queue.pending(), [])
+
+    def test_malformed_event(self):
+        self.queue.put('cwr_bundle_bar')
+        (self.queue.path / '0-broken.json').write_text('{')
+        self.dispatcher.drain()
+        self.assertEqual(self.jenkins.builds, [('cwr_bundle_bar', None)])
+        self.assertEqual(self.queue.pending(), [])